@@ -0,0 +1,202 @@
+"""
+Benchmarks of the parser and evaluator hot paths.
+
+    python benchmarks.py                          run everything and print ops/sec and peak memory
+    python benchmarks.py --save baseline.json     also save the results as a baseline
+    python benchmarks.py --compare baseline.json  exit with status 1 if a benchmark regressed
+
+Each benchmark is timed by calling it repeatedly for at least --min-time seconds, --repeat times, keeping
+the best rate; peak memory is measured with tracemalloc over one extra call, so tracing does not slow
+the timed calls. A result regresses when its ops/sec falls, or its peak memory grows, by more than
+--threshold (a fraction of the baseline).
+"""
+import sys, os, json, time, atexit, random, argparse, tempfile, tracemalloc
+from primitive_lisp import Lisp, iter_forms, paper_examples
+
+#name: function(size,options) returning the callable to time
+benchmarks = {}
+
+def benchmark(name):
+    def register(make):
+        benchmarks[name] = make
+        return make
+    return register
+
+def symbols(count,prefix='a'):
+    return ' '.join([f'{prefix}{i}' for i in range(count)])
+
+def generated_source(size,seed=0):
+    """
+    Lisp source of size random top level forms: nested lists of symbols, numbers and quoted data.
+    """
+    rng = random.Random(seed)
+    def form(depth):
+        if depth == 0 or rng.random() < 0.3:
+            return rng.choice([f'x{rng.randrange(100)}',str(rng.randrange(1000)),f"'y{rng.randrange(10)}"])
+        return '(' + ' '.join([form(depth-1) for _ in range(rng.randrange(1,5))]) + ')'
+    return '\n'.join([form(6) for _ in range(size)])
+
+def deep_tree(depth):
+    return '(a b '*depth + 'c' + ')'*depth
+
+@benchmark('parse')
+def parse_string(size,options):
+    source = generated_source(size)
+    return lambda: sum(1 for form in iter_forms(source))
+
+@benchmark('parse_file')
+def parse_file(size,options):
+    file = tempfile.NamedTemporaryFile('w',suffix='.lisp',delete=False)
+    with file:
+        file.write(generated_source(size))
+    atexit.register(os.remove,file.name)
+    def parse():
+        with open(file.name) as source:
+            return sum(1 for form in iter_forms(source))
+    return parse
+
+@benchmark('startup')
+def startup(size,options):
+    return lambda: Lisp(**options)
+
+@benchmark('paper_examples')
+def run_paper_examples(size,options):
+    lisp = Lisp(**options)
+    sources = paper_examples()
+    return lambda: [lisp(source) for source in sources]
+
+def prelude_call(setup,call):
+    """
+    A benchmark of the form call(size), on the globals set by the forms setup(size).
+    """
+    def make(size,options):
+        lisp = Lisp(**options)
+        lisp(setup(size))
+        form = next(iter_forms(call(size)))
+        return lambda: form(lisp.evaluator)
+    return make
+
+def two_lists(size):
+    return f"(setq xs '({symbols(size)})) (setq ys '({symbols(size,'b')}))"
+
+benchmark('concat')(prelude_call(two_lists,lambda size: '(concat xs ys)'))
+benchmark('zip')(prelude_call(two_lists,lambda size: '(zip xs ys)'))
+#the last key, so the whole table is walked
+benchmark('assoc')(prelude_call(lambda size: two_lists(size)+' (setq table (zip xs ys))',lambda size: f"(assoc 'a{size-1} table)"))
+benchmark('subst')(prelude_call(lambda size: f"(setq tree '{deep_tree(size)})",lambda size: "(subst 'm 'b tree)"))
+benchmark('eval_label')(prelude_call(lambda size: f"(setq tree '{deep_tree(size)})",
+    lambda size: "(eval '((label firstatom (lambda (x) (cond ((atom x) x) ('#t (firstatom (car x)))))) tree) (list (list 'tree tree)))"))
+benchmark('eval_lambda')(prelude_call(lambda size: f"(setq xs '({symbols(size)}))",
+    lambda size: "(eval '((lambda (f) (f f xs)) '(lambda (self x) (cond ((atom x) x) ('t (self self (cdr x)))))) (list (list 'xs xs)))"))
+
+def measure(function,min_time=0.2,repeat=3):
+    """
+    The best calls per second over repeat rounds of at least min_time seconds, and the peak memory
+    in bytes that tracemalloc sees during one more call.
+    """
+    best = 0.0
+    for _ in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            function()
+            calls += 1
+            elapsed = time.perf_counter()-start
+            if elapsed >= min_time:
+                break
+        best = max(best,calls/elapsed)
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    function()
+    peak = tracemalloc.get_traced_memory()[1]-base
+    if not tracing:
+        tracemalloc.stop()
+    return {'ops_per_sec':best,'peak_memory':peak}
+
+def run(names=None,size=200,min_time=0.2,repeat=3,**options):
+    """
+    Measure each benchmark in names (all by default) and return {name:result}. options are passed to Lisp.
+    """
+    results = {}
+    for name in names or benchmarks:
+        if name not in benchmarks:
+            raise Exception(f'Unknown benchmark: {name}')
+        results[name] = measure(benchmarks[name](size,options),min_time,repeat)
+    return results
+
+def compare(results,baseline,threshold=0.2):
+    """
+    The regressions of results against baseline: a (name,metric,baseline value,value) for each ops/sec
+    that fell, or peak memory that grew, by more than threshold. Benchmarks missing from either are skipped.
+
+    >>> compare({'zip':{'ops_per_sec':70.0,'peak_memory':1000}},{'zip':{'ops_per_sec':100.0,'peak_memory':1000}})
+    [('zip', 'ops_per_sec', 100.0, 70.0)]
+    >>> compare({'zip':{'ops_per_sec':90.0,'peak_memory':1500}},{'zip':{'ops_per_sec':100.0,'peak_memory':1000}},threshold=0.6)
+    []
+    """
+    regressions = []
+    for name,result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        if result['ops_per_sec'] < old['ops_per_sec']*(1-threshold):
+            regressions.append((name,'ops_per_sec',old['ops_per_sec'],result['ops_per_sec']))
+        if result['peak_memory'] > old['peak_memory']*(1+threshold):
+            regressions.append((name,'peak_memory',old['peak_memory'],result['peak_memory']))
+    return regressions
+
+def report(results,baseline=None):
+    lines = [f'{"benchmark":<16}{"ops/sec":>14}{"peak memory":>14}{"vs baseline":>14}']
+    for name,result in results.items():
+        change = ''
+        if baseline is not None and name in baseline:
+            change = f'{result["ops_per_sec"]/baseline[name]["ops_per_sec"]-1:+.1%}'
+        lines.append(f'{name:<16}{result["ops_per_sec"]:>14.1f}{result["peak_memory"]:>14d}{change:>14}')
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the primitive_lisp parser and evaluator.')
+    parser.add_argument('names',nargs='*',help='benchmarks to run: '+', '.join(benchmarks))
+    parser.add_argument('--size',type=int,default=200,help='list length, tree depth or form count of the workloads')
+    parser.add_argument('--min-time',type=float,default=0.2,help='seconds each timing round lasts at least')
+    parser.add_argument('--repeat',type=int,default=3,help='timing rounds, the best one counts')
+    parser.add_argument('--backend',choices=['tree','vm'],default=None)
+    parser.add_argument('--lisp-prelude',action='store_true',help='run the lisp definitions of the prelude instead of the python ones')
+    parser.add_argument('--optimize',action='store_true',help='fold constants and inline small functions when compiling')
+    parser.add_argument('--indexed-assoc',action='store_true',help='look keys up in association lists through a hash index')
+    parser.add_argument('--save',metavar='PATH',help='write the results as a JSON baseline')
+    parser.add_argument('--compare',metavar='PATH',help='JSON baseline to check the results against')
+    parser.add_argument('--threshold',type=float,default=0.2,help='allowed regression, as a fraction of the baseline')
+    args = parser.parse_args(argv)
+    options = {'backend':args.backend}
+    if args.lisp_prelude:
+        options['native_prelude'] = False
+    if args.optimize:
+        options['optimize'] = True
+    if args.indexed_assoc:
+        options['indexed_assoc'] = True
+    results = run(args.names,args.size,args.min_time,args.repeat,**options)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            saved = json.load(file)
+        if saved['size'] != args.size or saved['options'] != options:
+            print(f'warning: the baseline was run with size {saved["size"]} and options {saved["options"]}')
+        baseline = saved['results']
+    print(report(results,baseline))
+    if args.save:
+        with open(args.save,'w') as file:
+            json.dump({'size':args.size,'options':options,'results':results},file,indent=2)
+    if baseline is not None:
+        regressions = compare(results,baseline,args.threshold)
+        for name,metric,old,new in regressions:
+            print(f'REGRESSION {name} {metric}: {old:.1f} -> {new:.1f}')
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,311 @@
+"""
+Evaluation server: an asyncio server on a Unix socket or a localhost TCP port that evaluates Lisp
+programs on a pool of warm interpreters.
+
+    python lisp_server.py serve --port 8765                  (or --unix /tmp/lisp.sock)
+    python lisp_server.py eval --port 8765 "(car '(a b))"
+    python lisp_server.py load --port 8765 --connections 8 --requests 2000
+
+Every message is a frame: a 4 byte big-endian length, then that many bytes of UTF-8 JSON.
+A request is {"id": any, "source": text} or {"id": any, "op": "metrics"}; the reply carries the same id.
+Source is read incrementally, as the repl reads lines: a request whose text leaves a list open gets
+{"incomplete": true}, and the next request on the connection continues it. A complete program replies
+{"values": [exprs]} or {"error": "Type: message"}, plus "time", the seconds it spent queued and running.
+A program that passes the server's limits (see Budget) replies its error with "stats", the counts it reached.
+"""
+import sys, json, time, socket, asyncio, argparse, collections, concurrent.futures
+from primitive_lisp import Lisp, Expression, Budget, BudgetExceeded, value_expr
+
+max_frame = 1<<24
+
+def encode_frame(message):
+    data = json.dumps(message).encode('utf-8')
+    return len(data).to_bytes(4,'big')+data
+
+def decode_length(header):
+    length = int.from_bytes(header,'big')
+    if length > max_frame:
+        raise Exception(f'Frame of {length} bytes is over the {max_frame} byte limit')
+    return length
+
+async def read_frame(reader):
+    length = decode_length(await reader.readexactly(4))
+    return json.loads(await reader.readexactly(length))
+
+async def exchange(reader,writer,message):
+    """
+    Send a request on an asyncio connection and wait for its reply.
+    """
+    writer.write(encode_frame(message))
+    await writer.drain()
+    return await read_frame(reader)
+
+def evaluate_parsed(lisp,parsed,limits=None):
+    if limits:
+        #the session is dropped afterwards, so the budget is not reset
+        lisp.evaluator.budget = Budget(**limits)
+    return [value_expr(value) for value in parsed(lisp.evaluator)]
+
+class Server():
+    """
+    Evaluates each complete program on an interpreter from a pool of sessions over one frozen Image,
+    in a thread of its executor, so the event loop keeps serving other connections meanwhile. A used
+    interpreter is replaced by a fresh session, so programs never see each other's defuns or setqs.
+    limits ({'steps':..., 'seconds':..., 'conses':...}) is the Budget of every program, so a runaway
+    one cannot hold an executor thread for long.
+
+    >>> async def demo():
+    ...     server = Server(pool_size=2,limits={'steps':1000})
+    ...     await server.start(port=0)
+    ...     reader,writer = await asyncio.open_connection('127.0.0.1',server.port)
+    ...     replies = [await exchange(reader,writer,{'id':1,'source':"(defun f (x) (cons x"}),
+    ...         await exchange(reader,writer,{'id':2,'source':"'(b))) (f 'a)"}),
+    ...         await exchange(reader,writer,{'id':3,'source':"(f 'a)"}),
+    ...         await exchange(reader,writer,{'id':4,'op':'metrics'}),
+    ...         await exchange(reader,writer,{'id':5,'source':"(defun loop (x) (loop x)) (loop 'a)"})]
+    ...     writer.close()
+    ...     await server.close()
+    ...     return replies
+    >>> replies = asyncio.run(demo())
+    >>> [{key:value for key,value in reply.items() if key not in ('time','metrics','stats')} for reply in replies[:4]]
+    [{'id': 1, 'incomplete': True}, {'id': 2, 'values': ["(defun f (x) (cons x '(b)))", '(a b)']}, {'id': 3, 'error': 'Exception: Unbounded variable name: f'}, {'id': 4}]
+    >>> {key:replies[3]['metrics'][key] for key in ('completed','errors','queue_depth','idle_interpreters')}
+    {'completed': 2, 'errors': 1, 'queue_depth': 0, 'idle_interpreters': 2}
+    >>> replies[4]['stats']['steps']
+    1001
+    """
+    def __init__(self,image=None,pool_size=4,executor=None,window=1000,limits=None):
+        self.image = image if image is not None else Lisp().freeze()
+        self.pool_size = pool_size
+        self.limits = limits
+        self.executor = executor if executor is not None else concurrent.futures.ThreadPoolExecutor(pool_size)
+        self.pool = None
+        self.server = None
+        self.port = None
+        #handler task: writer, of the open connections
+        self.connections = {}
+        #requests waiting for an interpreter, and being evaluated
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=window)
+
+    async def start(self,path=None,host='127.0.0.1',port=0):
+        """
+        Fill the pool and listen on the Unix socket path, or else on host:port (port 0 picks a free one, see self.port).
+        """
+        self.pool = asyncio.Queue()
+        for _ in range(self.pool_size):
+            self.pool.put_nowait(self.image.session())
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle,path)
+        else:
+            self.server = await asyncio.start_server(self.handle,host,port)
+            self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def close(self):
+        """
+        Stop listening, close the open connections and wait for their handlers to finish.
+        """
+        self.server.close()
+        handlers = list(self.connections)
+        for writer in self.connections.values():
+            writer.close()
+        await asyncio.gather(*handlers,return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def handle(self,reader,writer):
+        parsed = None
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            while True:
+                try:
+                    request = await read_frame(reader)
+                except (asyncio.IncompleteReadError,ConnectionError):
+                    break
+                reply = {'id':request.get('id')}
+                if request.get('op') == 'metrics':
+                    reply['metrics'] = self.metrics()
+                else:
+                    try:
+                        if parsed is None:
+                            parsed = Expression(request['source'])
+                        else:
+                            parsed.resume(request['source'])
+                    except Exception as e:
+                        parsed = None
+                        self.errors += 1
+                        reply['error'] = f'{type(e).__name__}: {e}'
+                    else:
+                        if parsed.complete:
+                            reply.update(await self.evaluate(parsed))
+                            parsed = None
+                        else:
+                            reply['incomplete'] = True
+                writer.write(encode_frame(reply))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        except Exception as e:
+            #an oversized or malformed frame ends only this connection
+            writer.write(encode_frame({'id':None,'error':f'{type(e).__name__}: {e}'}))
+        finally:
+            del self.connections[task]
+            writer.close()
+
+    async def evaluate(self,parsed):
+        start = time.perf_counter()
+        self.waiting += 1
+        lisp = await self.pool.get()
+        self.waiting -= 1
+        self.running += 1
+        try:
+            result = {'values':await asyncio.get_running_loop().run_in_executor(self.executor,evaluate_parsed,lisp,parsed,self.limits)}
+        except BudgetExceeded as e:
+            self.errors += 1
+            result = {'error':f'{type(e).__name__}: {e}','stats':e.stats}
+        except Exception as e:
+            self.errors += 1
+            result = {'error':f'{type(e).__name__}: {e}'}
+        finally:
+            self.running -= 1
+            self.pool.put_nowait(self.image.session())
+        latency = time.perf_counter()-start
+        self.latencies.append(latency)
+        self.completed += 1
+        result['time'] = latency
+        return result
+
+    def metrics(self):
+        """
+        queue_depth: requests waiting for an interpreter, running: requests being evaluated, latency: seconds
+        from a program being complete to its values, over the last window programs.
+        """
+        latencies = sorted(self.latencies)
+        def percentile(fraction):
+            return latencies[min(len(latencies)-1,int(fraction*len(latencies)))] if latencies else None
+        return {
+            'queue_depth':self.waiting,
+            'running':self.running,
+            'idle_interpreters':self.pool.qsize(),
+            'completed':self.completed,
+            'errors':self.errors,
+            'latency':{'mean':sum(latencies)/len(latencies) if latencies else None,'p50':percentile(0.5),'p99':percentile(0.99),'max':percentile(1.0)},
+            }
+
+class Client():
+    """
+    Blocking client for one connection to a Server.
+    """
+    def __init__(self,path=None,host='127.0.0.1',port=None):
+        if path is not None:
+            self.socket = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+            self.socket.connect(path)
+        else:
+            self.socket = socket.create_connection((host,port))
+        self.next_id = 0
+    def request(self,message):
+        self.next_id += 1
+        message = dict(message,id=self.next_id)
+        self.socket.sendall(encode_frame(message))
+        length = decode_length(self.receive(4))
+        return json.loads(self.receive(length))
+    def receive(self,count):
+        data = b''
+        while len(data) < count:
+            chunk = self.socket.recv(count-len(data))
+            if not chunk:
+                raise ConnectionError('Server closed the connection')
+            data += chunk
+        return data
+    def eval(self,source):
+        return self.request({'source':source})
+    def metrics(self):
+        return self.request({'op':'metrics'})['metrics']
+    def close(self):
+        self.socket.close()
+    def __enter__(self):
+        return self
+    def __exit__(self,*exc_info):
+        self.close()
+
+async def load_test(programs,connections=8,requests=1000,path=None,host='127.0.0.1',port=None):
+    """
+    Send requests programs, cycling through programs, over connections concurrent connections, and
+    return the throughput, the client side latencies and the server's metrics.
+    """
+    async def connect():
+        if path is not None:
+            return await asyncio.open_unix_connection(path)
+        return await asyncio.open_connection(host,port)
+    latencies = []
+    errors = 0
+    async def run(index):
+        nonlocal errors
+        reader,writer = await connect()
+        for number in range(index,requests,connections):
+            start = time.perf_counter()
+            reply = await exchange(reader,writer,{'id':number,'source':programs[number%len(programs)]})
+            latencies.append(time.perf_counter()-start)
+            if 'error' in reply:
+                errors += 1
+        writer.close()
+    start = time.perf_counter()
+    await asyncio.gather(*[run(index) for index in range(connections)])
+    seconds = time.perf_counter()-start
+    reader,writer = await connect()
+    metrics = (await exchange(reader,writer,{'id':None,'op':'metrics'}))['metrics']
+    writer.close()
+    latencies.sort()
+    return {
+        'requests':len(latencies),
+        'errors':errors,
+        'seconds':seconds,
+        'requests_per_sec':len(latencies)/seconds,
+        'p50':latencies[len(latencies)//2],
+        'p99':latencies[min(len(latencies)-1,int(0.99*len(latencies)))],
+        'server':metrics,
+        }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Lisp evaluation server, client and load test.')
+    parser.add_argument('command',choices=['serve','eval','load'])
+    parser.add_argument('source',nargs='?',help='program to evaluate, for eval')
+    parser.add_argument('--unix',metavar='PATH',help='Unix socket path instead of TCP')
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=8765)
+    parser.add_argument('--pool-size',type=int,default=4,help='warm interpreters, and executor threads')
+    parser.add_argument('--backend',choices=['tree','vm'],default=None)
+    parser.add_argument('--optimize',action='store_true',help='fold constants and inline small functions when compiling')
+    parser.add_argument('--max-steps',type=int,help='function bodies a program may run')
+    parser.add_argument('--max-seconds',type=float,help='seconds a program may run')
+    parser.add_argument('--max-conses',type=int,help='list cells a program may build')
+    parser.add_argument('--connections',type=int,default=8,help='concurrent connections of the load test')
+    parser.add_argument('--requests',type=int,default=1000,help='requests of the load test')
+    args = parser.parse_intermixed_args(argv)
+    if args.command == 'serve':
+        async def serve():
+            limits = {'steps':args.max_steps,'seconds':args.max_seconds,'conses':args.max_conses}
+            server = Server(Lisp(backend=args.backend,optimize=args.optimize).freeze(),args.pool_size,limits=limits)
+            await server.start(args.unix,args.host,args.port)
+            print(f'serving on {args.unix or f"{args.host}:{server.port}"}',flush=True)
+            await server.server.serve_forever()
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'eval':
+        with Client(args.unix,args.host,args.port) as client:
+            print(json.dumps(client.eval(args.source if args.source is not None else sys.stdin.read())))
+    else:
+        from primitive_lisp import paper_examples, random_programs
+        #some random programs fail by design, so the load includes error replies
+        programs = paper_examples()+random_programs(200)
+        print(json.dumps(asyncio.run(load_test(programs,args.connections,args.requests,args.unix,args.host,args.port)),indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
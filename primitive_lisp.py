@@ -128,16 +128,18 @@
 ... ''')
 [Atom('a'), Atom('#t'), List('(a b c)'), Quote("'list"), List("('a b c)"), Atom('a'), List("('a c d)")]
 """
-import re, traceback, pdb, sys, readline, logarhythm
+import re, io, os, ast, copy, json, math, mmap, time, types, array, struct, marshal, inspect, operator, threading, multiprocessing, fractions, functools, pickle, hashlib, collections, weakref, random, doctest, traceback, pdb, sys, readline, logarhythm
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 logger = logarhythm.get_logger()
 logger.level = logarhythm.INFO
 auto_debug = True
 
 class Lisp():
-    def __init__(self,variables=None):
-        self.evaluator = Evaluator(variables)
-        self('''
+    prelude = '''
 (defun subst (x y z)
     (cond ((atom z)
         (cond ((eq z y) x)
@@ -206,10 +208,298 @@ class Lisp():
     (cond ((null m) '())
         ('#t (cons (eval (car m) a)
             (evlis (cdr m) a)))))
-               ''')
+'''
+    images = None
+    images_lock = threading.RLock()
+    #prelude functions with a python version native_<name>, used in place of the lisp definitions when native_prelude is set
+    natives = ('subst','null','and','or','not','concat','zip','assoc','eval','evcon','evlis')
+    native_prelude = True
+    #'tree' runs the closures compiled by Evaluator, 'vm' the bytecode of VMEvaluator
+    backend = 'tree'
+    #compile with the optimizations of Evaluator.optimize
+    optimize = False
+    #look keys up in association lists through an AlistIndex
+    indexed_assoc = False
+    #the Profiler recording between start_profile and stop_profile
+    profiler = None
+    #the Budget of the last call with limits, whose counts show what it used
+    budget = None
+
+    def __init__(self,variables=None,hash_cons=False,native_prelude=None,backend=None,image=None,optimize=None,primitives=(),indexed_assoc=None):
+        """
+        With hash_cons, lists are hash-consed (see HashConsEvaluator) and cons_table.stats() reports the sharing.
+        native_prelude (default Lisp.native_prelude) picks the python versions of the prelude functions over the lisp ones.
+        backend (default Lisp.backend) is 'tree' or 'vm'.
+        optimize (default Lisp.optimize) folds constants, prunes cond clauses and inlines small functions, see Evaluator.inline.
+        primitives are Primitive objects to register, as Lisp.register does.
+        indexed_assoc (default Lisp.indexed_assoc) makes assoc, and eval's variable lookups, use an AlistIndex;
+        with the lisp prelude, assoc is then the python one.
+        With image (see Lisp.freeze), this is a session over the image's globals, with the image's options.
+        """
+        if image is not None:
+            self.options = image.options
+            self.evaluator = evaluator_types[(image.options['backend'],image.options['hash_cons'])](image.globals())
+            self.evaluator.optimize = image.options['optimize']
+            for primitive in image.options['primitives']:
+                self.evaluator.register(primitive)
+            if image.options['indexed_assoc']:
+                self.evaluator.alist_index = AlistIndex()
+            return
+        if native_prelude is None:
+            native_prelude = self.native_prelude
+        if backend is None:
+            backend = self.backend
+        optimize = bool(self.optimize if optimize is None else optimize)
+        indexed_assoc = bool(self.indexed_assoc if indexed_assoc is None else indexed_assoc)
+        if (backend,hash_cons) not in evaluator_types:
+            raise Exception(f'Unknown backend: {backend}')
+        evaluator_type = evaluator_types[(backend,bool(hash_cons))]
+        #what another process needs to build the same interpreter, see map_eval
+        self.options = {'hash_cons':bool(hash_cons),'native_prelude':native_prelude,'backend':backend,'optimize':optimize,'primitives':tuple(primitives),'indexed_assoc':indexed_assoc}
+        self.evaluator = evaluator_type(variables)
+        self.evaluator.optimize = optimize
+        self.evaluator.variables.update(self.prelude_image(evaluator_type,native_prelude,optimize))
+        if indexed_assoc:
+            self.evaluator.alist_index = AlistIndex()
+            if not native_prelude:
+                self.evaluator.variables['assoc'] = Primitive('assoc',native_assoc)
+        for primitive in primitives:
+            self.evaluator.register(primitive)
+
+    @classmethod
+    def prelude_image(cls,evaluator_type=None,native_prelude=False,optimize=False):
+        """
+        The globals defined by the prelude, built once per process, evaluator type, prelude flavor and optimize flag.
+        Each Lisp starts from a copy of this dict: the prelude's Function objects are shared and a defun
+        or setq only replaces the entry in that instance's own dict, so construction parses nothing.
+        """
+        if evaluator_type is None:
+            evaluator_type = Evaluator
+        with cls.images_lock:
+            if cls.__dict__.get('images') is None:
+                cls.images = {}
+            key = (evaluator_type,native_prelude,optimize)
+            if key not in cls.images:
+                if native_prelude:
+                    image = dict(cls.prelude_image(evaluator_type))
+                    image.update({name:Primitive(name,globals()['native_'+name],pure='native_'+name in Evaluator.foldable) for name in cls.natives})
+                else:
+                    evaluator = evaluator_type()
+                    evaluator.optimize = optimize
+                    for form in iter_forms(cls.prelude):
+                        form(evaluator)
+                    image = dict(evaluator.variables)
+                cls.images[key] = image
+            return cls.images[key]
+
+    def __call__(self,expr,steps=None,seconds=None,conses=None):
+        """
+        Evaluate each top level form of expr as soon as it has been read and return the values.
+        expr can be a string, a text file object or an iterable of string chunks.
+        steps, seconds and conses limit the whole call, see Budget: passing one raises BudgetExceeded.
+        """
+        if steps is not None or seconds is not None or conses is not None:
+            self.budget = self.evaluator.budget = Budget(steps,seconds,conses)
+        try:
+            if self.profiler is not None:
+                return self.profiler.run(iter_forms(expr),lambda form: form(self.evaluator))
+            return [form(self.evaluator) for form in iter_forms(expr)]
+        finally:
+            self.evaluator.budget = None
+
+    def register(self,name,function,arity=None,pure=False):
+        """
+        Make a python function callable from lisp as (name values...): it is called as function(*values) and
+        returns the value of the call. Its arity is read from its signature now (or given, when there is none),
+        so a call with the wrong number of values fails as a lisp error instead of a TypeError inside python.
+        Calls compiled from now on are resolved to the function when they are compiled, so running them looks
+        nothing up. With pure, the optimizer may call it on constants at compile time. Sessions and map_eval
+        workers of this Lisp have it too. Returns the registered Primitive.
+
+        >>> lisp = Lisp()
+        >>> lisp.register('hypot',lambda x,y: math.sqrt(x*x+y*y),pure=True)
+        Primitive('hypot')
+        >>> lisp.register('upcase',str.upper,1)
+        Primitive('upcase')
+        >>> lisp('(hypot 3 4) (map hypot (quote (5 8)) (quote (12 15))) (upcase "abc")')
+        [5.0, List('(13.0 17.0)'), 'ABC']
+        >>> lisp.session()('(hypot 3)')
+        Traceback (most recent call last):
+        ...
+        Exception: hypot expects 2 arguments, got 1
+        >>> lisp.register('cond',print)
+        Traceback (most recent call last):
+        ...
+        Exception: cond is a special form
+        >>> lisp.register('py-types',lambda x: [x > 0,None,(x,'s')])
+        Primitive('py-types')
+        >>> lisp('(py-types 1) (map py-types (quote (-1)))')
+        [List('(#t () (1 "s"))'), List('((#f () (-1 "s")))')]
+
+        A name that a global already binds can't be registered, as code compiled before would go on calling the global:
+
+        >>> _ = lisp('(defun sq (x) (list x x)) (defun use (y) (sq y))')
+        >>> lisp.register('sq',lambda x: x*x)
+        Traceback (most recent call last):
+        ...
+        Exception: Cannot register sq: a global of that name is defined
+        >>> Lisp(native_prelude=False).register('null',lambda x: x is NIL)
+        Traceback (most recent call last):
+        ...
+        Exception: Cannot register null: a global of that name is defined
+        >>> lisp('(sq 3) (use 3)')
+        [List('(3 3)'), List('(3 3)')]
+        """
+        primitive = Primitive(name,function,arity,'python',pure)
+        self.evaluator.register(primitive)
+        self.options = dict(self.options,primitives=self.options['primitives']+(primitive,))
+        return primitive
+
+    def load(self,path):
+        """
+        Evaluate each top level form of a source file and return the values.
+        The forms are read through a cache file next to the source, see load_forms.
+
+        >>> import tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(),'square.lisp')
+        >>> def write(text,mtime_ns=None):
+        ...     with open(path,'w') as f:
+        ...         f.write(text)
+        ...     if mtime_ns is not None:
+        ...         os.utime(path,ns=(mtime_ns,mtime_ns))
+        >>> write("(defun sq (x) (* x x)) (sq 3)")
+        >>> Lisp().load(path)[1],os.path.exists(path+'.cache')
+        (9, True)
+
+        A source with the mtime and size the cache was written for is not read again, so the cached forms are used:
+
+        >>> write("(defun sq (x) (+ x x)) (sq 3)",os.stat(path).st_mtime_ns)
+        >>> Lisp().load(path)[1]
+        9
+
+        Once the source changes, it is parsed again and the cache rewritten:
+
+        >>> write("(defun sq (x) (+ x x)) (sq 30)")
+        >>> Lisp().load(path)[1],Lisp().load(path)[1]
+        (60, 60)
+        """
+        if self.profiler is not None:
+            return self.profiler.run(load_forms(path),self.evaluator)
+        return [self.evaluator(form) for form in load_forms(path)]
+
+    def freeze(self):
+        """
+        An Image of the current globals, for sessions that share them: see Image.
+        """
+        return Image(self.evaluator.variables,self.options)
+
+    def session(self):
+        """
+        A new Lisp over a frozen Image of the current globals. To start many sessions, freeze once and use Image.session.
+        """
+        return self.freeze().session()
+
+    def map_eval(self,programs,workers=None,chunksize=None,setup=None,stream=False):
+        """
+        Evaluate many independent programs in a pool of worker processes and return a BatchResult per program.
+        Each worker builds an interpreter with this one's options (or inherits the prelude already built
+        here, where processes are forked), runs setup in it once and freezes its globals into an Image, and
+        evaluates each program of its chunks in a session of that image, so programs cannot see each other's
+        defuns or setqs. What setup made is read-only to them, as it is shared: a table-put into one of its
+        tables or a setq of a variable its closures captured raises, and streams can't be made by setup.
+        The results are in program order, or with stream, an iterator of them in the order they finish.
+        An error in a program is recorded in its result and the batch goes on; an error in setup is recorded
+        in the result of every program.
+
+        >>> results = Lisp().map_eval(["(cons 'a '(b))","(car 'a)","(defun f (x) x) (f 'b)"],workers=2)
+        >>> [(result.index,result.values,result.error) for result in results]
+        [(0, ['(a b)'], None), (1, None, 'Exception: car arg must be list'), (2, ['(defun f (x) x)', 'b'], None)]
+        >>> Lisp().map_eval(["'a","'b"],workers=1,setup="(car 'a)")
+        [BatchResult(0, error='setup: Exception: car arg must be list'), BatchResult(1, error='setup: Exception: car arg must be list')]
+        >>> sorted([result.index for result in Lisp().map_eval(["'a","'b"],workers=2,stream=True)])
+        [0, 1]
+        >>> setup = "(setq t (make-table)) (table-put t 'a 1) (setq count (label c (lambda (n) (cond ((= n 0) 'done) ('#t (c (- n 1)))))))"
+        >>> Lisp().map_eval(["(table-put t 'b 2)","(table-get (table-with t 'b 2) 'b)","(table-keys t)","(count 3)"],workers=1,setup=setup)
+        [BatchResult(0, error='Exception: Cannot table-put: the table is in a frozen Image'), BatchResult(1, ['2']), BatchResult(2, ['(a)']), BatchResult(3, ['done'])]
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if chunksize is None:
+            #as multiprocessing.Pool.map does: about four chunks per worker
+            chunksize = max(1,-(-len(programs)//(workers*4))) if hasattr(programs,'__len__') else 1
+        if stream:
+            return self.stream_batch(programs,workers,chunksize,setup)
+        with multiprocessing.Pool(workers,batch_worker_init,(self.options,setup)) as pool:
+            return list(pool.imap(batch_eval,enumerate(programs),chunksize))
+
+    def stream_batch(self,programs,workers,chunksize,setup):
+        #the pool is only made once the results are asked for, so an iterator that is never read leaks nothing
+        with multiprocessing.Pool(workers,batch_worker_init,(self.options,setup)) as pool:
+            yield from pool.imap_unordered(batch_eval,enumerate(programs),chunksize)
+
+    def disassemble(self,source):
+        """
+        The VM instructions of the first form of source, or of the global function named source, as text.
+        Functions compiled by another backend are compiled again for the listing, outside their lexical scope.
+        """
+        evaluator = self.evaluator
+        if not isinstance(evaluator,VMEvaluator):
+            evaluator = VMEvaluator(dict(self.evaluator.variables))
+            evaluator.optimize = self.evaluator.optimize
+            evaluator.primitives = self.evaluator.primitives
+            evaluator.alist_index = self.evaluator.alist_index
+        function = self.evaluator.variables.get(source)
+        if isinstance(function,Primitive):
+            raise Exception(f'{source} is implemented in python')
+        if isinstance(function,Function):
+            if type(function.body_node) is CodeNode:
+                return function.body_node.code.disassemble()
+            code = Code(source)
+            evaluator.emit(function.body,Scope(function.arg_expr_list),True,code)
+            code.emit(OP_RETURN)
+            return code.disassemble()
+        return evaluator.compile(next(iter_forms(source))).code.disassemble()
+
+    def start_profile(self,profiler=None):
+        """
+        Evaluate with a ProfilingEvaluator over the same globals until stop_profile, and return the
+        Profiler it records into (a new one unless given). See Profiler for the reports.
+        """
+        if self.profiler is not None:
+            raise Exception('Already profiling')
+        self.profiler = profiler if profiler is not None else Profiler()
+        evaluator = profiling_types[type(self.evaluator)](self.evaluator.variables)
+        evaluator.generation = self.evaluator.generation
+        evaluator.optimize = self.evaluator.optimize
+        evaluator.primitives = self.evaluator.primitives
+        evaluator.alist_index = self.evaluator.alist_index
+        evaluator.profiler = self.profiler
+        self.plain_evaluator,self.evaluator = self.evaluator,evaluator
+        return self.profiler
 
-    def __call__(self,expr):
-        return Expression(expr)(self.evaluator)
+    def stop_profile(self):
+        """
+        Go back to the plain evaluator and return the Profiler.
+        """
+        if self.profiler is None:
+            raise Exception('Not profiling')
+        self.plain_evaluator.generation = self.evaluator.generation
+        self.evaluator = self.plain_evaluator
+        profiler,self.profiler = self.profiler,None
+        return profiler
+
+    def memoize(self,name,maxsize=None):
+        """
+        Replace the global function name with a MemoFunction of the same definition and return it.
+        Its hits, misses and evictions counters, or stats(), show how the cache is doing.
+        """
+        function = self.evaluator.variables.get(name)
+        if not isinstance(function,Function):
+            raise Exception(f'{name} is not a function')
+        memo = MemoFunction(function.arg_expr_list,function.body,function,function.env,maxsize)
+        memo.body_node = function.body_node
+        self.evaluator.variables[name] = memo
+        return memo
 
     def repl(self):
         while True:
@@ -228,43 +518,60 @@ class Lisp():
                 if auto_debug:
                     pdb.post_mortem(t)
 
-class Expression():
-    def __init__(self,expr,parent=None,**kwargs):
-        self.subexpressions = []
-        self.consumed_chars = 0
-        self.complete = False
-        self.parent = parent
-        self.current_child = None
-        self.expr = expr
-        self.__dict__.update(kwargs)
-        self.parse(expr)
-        self.expr = expr[:self.consumed_chars]
+class Source():
+    """
+    The text of a top level form (of everything read, for a root), shared by its parse nodes: each node
+    holds its (start,end) span into text and slices it only for its repr and error messages. While the form
+    is being read, text holds what has been read so far, and a root made from text keeps its Reader here.
+    The text is kept as the pieces the Reader read it in, and only joined when it is asked for.
+    """
+    __slots__ = ('parts','reader')
+    def __init__(self,text=''):
+        self.parts = [text]
+        self.reader = None
+    @property
+    def text(self):
+        if len(self.parts) > 1:
+            self.parts = [''.join(self.parts)]
+        return self.parts[0]
+    def append(self,text):
+        self.parts.append(text)
+
+class ParseNode():
+    """
+    A node of the parse tree: its span is source.text[start:end], where end is None until the node is complete.
+    compiled caches the node's closure, see Evaluator.compile. Nodes have __slots__ and keep no parser state,
+    and no node holds a copy of its text, so memory grows with the size of the source and not with how
+    deeply it nests: the bytes per source character stay flat, for wide lists and for deep ones.
+
+    >>> import tracemalloc
+    >>> def parsed_size(source):
+    ...     tracemalloc.start()
+    ...     forms = list(iter_forms(source))
+    ...     size = tracemalloc.get_traced_memory()[0]
+    ...     tracemalloc.stop()
+    ...     return size/len(source)
+    >>> parsed_size('('+' '.join([f'(f{i} (g x{i}) "s" 1.5)' for i in range(5000)])+')') < 50,parsed_size('(a '*2000+')'*2000) < 100
+    (True, True)
+    >>> form = next(iter_forms("  (f (g x) 'y)"))
+    >>> form.subexpressions[1],form.subexpressions[1].start,form.subexpressions[1].end,form.source.text
+    (List('(g x)'), 3, 8, "(f (g x) 'y)")
+    """
+    __slots__ = ('source','start','end','compiled')
+    @property
+    def expr(self):
+        return self.source.text[self.start:self.end]
+    @property
+    def complete(self):
+        return self.end is not None
     def resume(self,expr):
-        original_length = self.consumed_chars
-        self.parse(expr,resume=True)
-        self.expr += expr[:self.consumed_chars-original_length]
-    def parse_start_trace(self):
-        if logger.level > logarhythm.DEBUG:
-            return
-        ancestry = [self]
-        parent = self.parent
-        while parent is not None:
-            ancestry.insert(0,parent)
-            parent = parent.parent
-        indent = ' '*4
-        lines = ['','Parse Start Trace:']
-        for i,parsed in enumerate(ancestry,1):
-            lines.append(indent*i+repr(parsed))
-        logger.debug('\n'.join(lines))
+        reader = self.source.reader
+        if reader is not None and reader.root is self:
+            reader.resume(expr)
 
     def parse_end_trace(self):
         if logger.level > logarhythm.DEBUG:
             return
-        ancestry = [self]
-        parent = self.parent
-        while parent is not None:
-            ancestry.insert(0,parent)
-            parent = parent.parent
         indent = ' '*4
         lines = ['','Parse End Trace:',indent+repr(self)]
         indent_level = 1
@@ -278,134 +585,401 @@ class Expression():
         if not self.complete:
             lines.append(indent*(indent_level+1)+'...')
 
-    def parse(self,expr,single=False,resume=False):
-        self.parse_start_trace()
-        while len(expr) > 0:
-            #remove leading whitespace
-            new_expr = expr.lstrip()
-            self.consumed_chars += len(expr) - len(new_expr)
-            expr = new_expr
-            if len(expr) == 0:
-                break
-
-            if expr[0] == '(' or (resume and isinstance(self.current_child,List)):
-                if not resume or self.current_child is None:
-                    self.current_child = List(expr,self)
-                else:
-                    self.current_child.resume(expr)
-                expr = self.consume(self.current_child,expr)
-            elif expr[0] == "'" or (resume and isinstance(self.current_child,Quote)):
-                if not resume or self.current_child is None:
-                    self.current_child = Quote(expr)
-                else:
-                    self.current_child.resume(expr)
-                expr = self.consume(self.current_child,expr)
-            elif expr[0] == ')':
-                expr = self.close(expr)
-                break
-            elif expr[0] == ';':
-                #comment
-                m = re.match(';.+?\n',expr)
-                self.consumed_chars += len(m.group(0))
-                expr = expr[m.end(0):]
-                continue
-            else:
-                if resume and (type(self) is Expression or isinstance(self,List)):
-                    if len(self.subexpressions) > 0 and isinstance(self.subexpressions[-1],Atom):
-                        if not self.expr.endswith(' '):
-                            self.expr += ' '
-                            self.consumed_chars += 1
-                            parent = self.parent
-                            while parent is not None:
-                                parent.expr += ' '
-                                parent.consumed_chars += 1
-                                parent = parent.parent
-
-                self.current_child = Atom(expr)
-                expr = self.consume(self.current_child,expr)
-            if single:
-                expr = self.close(expr)
-                break
-        if type(self) is Expression and self.current_child is None:
-            expr = self.close(expr)
-        self.parse_end_trace()
-        return expr
-
-    def consume(self,subexpression,expr):
-        if not (len(self.subexpressions) > 0 and self.current_child is self.subexpressions[-1]):
-            self.subexpressions.append(subexpression)
-            self.consumed_chars += subexpression.consumed_chars
-        if self.current_child.complete:
-            self.current_child = None
-        return expr[subexpression.consumed_chars:]
-
-    def close(self,expr):
-        self.complete = True
-        return expr
-
     def __repr__(self):
         if self.complete:
-            return f'{type(self).__name__}({repr(self.expr[:self.consumed_chars])})'
+            return f'{type(self).__name__}({repr(self.expr)})'
         else:
-            return f'{type(self).__name__}({repr(self.expr[:self.consumed_chars])},complete=False)'
-    def __call__(self,evaluator=None,quoted=False,local_variables=None):
+            return f'{type(self).__name__}({repr(self.expr)},complete=False)'
+
+class Expression(ParseNode):
+    """
+    The root that reads every top level form of its text into subexpressions. More text can be added with
+    resume, as the repl and the server do; it is complete while no form is left open.
+    """
+    __slots__ = ('subexpressions',)
+    def __init__(self,expr=''):
+        self.subexpressions = []
+        self.source = Source()
+        self.start = 0
+        self.end = None
+        self.compiled = None
+        Reader(self).feed(expr,boundary=True)
+    def __call__(self,evaluator=None,quoted=False,env=None):
         if quoted:
             results = list(self.subexpressions)
         else:
             results = []
             for subexpression in self.subexpressions:
-                results.append(subexpression(evaluator,quoted,local_variables))
+                results.append(subexpression(evaluator,quoted,env))
         return results
     def is_atomic(self):
         return len(self.subexpressions) == 0
 
-class Atom(Expression):
-    def __init__(self,expr,parent=None,**kwargs):
-        self.expr = re.match("[^(') \t\n\r;]+",expr).group(0)
-        self.consumed_chars = len(self.expr)
-        self.current_child = None
-        self.parent = parent
-        self.complete = True
-        self.__dict__.update(kwargs)
-    def resume(self,expr,parent=None):
-        raise Exception('Not valid to resume on an atom')
+atom_pattern = re.compile(r'''"(?:[^"\\\n]|\\.)*"|[^(')`, \t\n\r;]+''')
+string_pattern = re.compile(r'''"(?:[^"\\\n]|\\.)*("?)''')
+whitespace_pattern = re.compile(r'\s+')
+int_pattern = re.compile('[+-]?[0-9]+$')
+float_pattern = re.compile('[+-]?([0-9]+[.]?[0-9]*|[.][0-9]+)([eE][+-]?[0-9]+)?$')
+ratio_pattern = re.compile('[+-]?[0-9]+/[0-9]+$')
+not_literal = object()
+number_types = (int,float,fractions.Fraction)
+
+def read_literal(text):
+    """
+    Classify the text of an atom: returns its int, float, Fraction or string value, or not_literal for a symbol.
+    """
+    if int_pattern.match(text) is not None:
+        return int(text)
+    elif float_pattern.match(text) is not None:
+        return float(text)
+    elif ratio_pattern.match(text) is not None:
+        try:
+            return normalize(fractions.Fraction(text))
+        except ZeroDivisionError:
+            return not_literal
+    elif len(text) >= 2 and text[0] == '"' and text[-1] == '"':
+        try:
+            value = ast.literal_eval(text)
+        except (ValueError,SyntaxError):
+            return not_literal
+        if isinstance(value,str):
+            return value
+    return not_literal
+
+def read_atom(token,source=None,start=0):
+    value = read_literal(token)
+    if value is not_literal:
+        return Atom(token,source,start)
+    return Literal(token,source,start,value)
+
+class Reader():
+    """
+    Incremental tokenizer and parser over a single text buffer.
+    Tokens are matched in place by index, so reading is linear in the size of the input. Text can be fed
+    in chunks of any size: a token cut off at the end of a chunk waits for the next chunk, unless the
+    chunk ends on a boundary. The buffer only holds the chunk and such a token; the text read is added
+    to the Source of the form it belongs to, one piece per chunk, so no text is copied again per chunk.
+
+    The root is the node being read into: an Expression collects every top level form and a List or
+    Quote stops after its own closing token; their nodes are spans of the root's Source. Without a root,
+    finished forms are collected for take(), each with a Source of its own text.
+
+    >>> import time
+    >>> def feed_time(size):
+    ...     text = '(list (f "s" 1.5)'+' '*size+'x)'
+    ...     start = time.perf_counter()
+    ...     forms = list(iter_forms([text[i:i+64] for i in range(0,len(text),64)]))
+    ...     return time.perf_counter()-start,forms[0].expr == text
+    >>> (small,_),(large,same) = feed_time(400000),feed_time(3200000)
+    >>> large < 30*small,same
+    (True, True)
+    """
+    def __init__(self,root=None):
+        self.root = root
+        #the text from position on, and while feeding the whole buffer and where it starts
+        self.buffer = ''
+        self.position = 0
+        self.offset = 0
+        #the last character read, which resume separates from the next line
+        self.last = ''
+        self.stack = []
+        self.forms = []
+        self.done = False
+        #the Source of the nodes being read, whose text starts at the offset base
+        self.source = None
+        self.base = 0
+        if root is not None:
+            self.source = root.source
+            self.source.reader = self
+        if isinstance(root,(List,Quote,Quasiquote)):
+            #the root's text starts as its opening token
+            self.stack.append((root,0))
+            self.position = len(root.source.text)
+            self.last = root.source.text[-1:]
+
+    def resume(self,expr):
+        """
+        Feed another line of input. As in the repl, the line break always separates tokens.
+        """
+        if self.last.strip() and expr[:1].strip():
+            expr = ' '+expr
+        self.feed(expr,boundary=True)
+
+    def feed(self,text,boundary=False):
+        if self.done:
+            return
+        buffer = self.buffer = self.buffer+text
+        offset = self.offset = self.position
+        pos = 0
+        end = len(buffer)
+        stack = self.stack
+        while pos < end and not self.done:
+            char = buffer[pos]
+            if char == '(':
+                self.open(List,offset+pos)
+                pos += 1
+            elif char == "'":
+                self.open(Quote,offset+pos)
+                pos += 1
+            elif char == '`':
+                self.open(Quasiquote,offset+pos)
+                pos += 1
+            elif char == ',':
+                if pos+1 == end and not boundary:
+                    break
+                if buffer.startswith(',@',pos):
+                    self.open(UnquoteSplicing,offset+pos)
+                    pos += 2
+                else:
+                    self.open(Unquote,offset+pos)
+                    pos += 1
+            elif char == ')':
+                if not stack or not isinstance(stack[-1][0],List):
+                    if stack:
+                        raise Exception(f'Nothing to quote before ) at offset {offset+pos}')
+                    raise Exception(f'Unexpected ) at offset {offset+pos}')
+                pos += 1
+                self.deliver(stack.pop(),offset+pos)
+            elif char.isspace():
+                pos = whitespace_pattern.match(buffer,pos).end()
+            elif char == ';':
+                newline = buffer.find('\n',pos)
+                if newline >= 0:
+                    pos = newline+1
+                elif boundary:
+                    pos = end
+                else:
+                    break
+            else:
+                match = None
+                if char == '"':
+                    match = string_pattern.match(buffer,pos)
+                    if not match.group(1):
+                        #still open at the end of the chunk, possibly cut off right after a backslash
+                        if (match.end() == end or buffer[match.end():] == '\\') and not boundary:
+                            break
+                        match = None
+                if match is None:
+                    match = atom_pattern.match(buffer,pos)
+                if match.end() == end and not boundary:
+                    break
+                token = match.group(0)
+                if not stack and self.root is None:
+                    self.source,self.base = Source(token),offset+pos
+                self.deliver((read_atom(token,self.source,offset+pos-self.base),None),offset+match.end())
+                pos = match.end()
+        self.position = offset+pos
+        if pos:
+            self.last = buffer[pos-1]
+        root = self.root
+        if root is not None:
+            root.source.append(buffer[:pos])
+        elif stack:
+            self.source.append(buffer[max(self.base-offset,0):pos])
+        if type(root) is Expression:
+            #the root's text is all that was read, from offset 0
+            root.end = None if stack else self.position
+            root.parse_end_trace()
+        self.buffer = buffer[pos:]
+
+    def open(self,node_type,start):
+        if not self.stack and self.root is None:
+            self.source,self.base = Source(),start
+        node = node_type()
+        node.source,node.start = self.source,start-self.base
+        self.stack.append((node,start))
+
+    def deliver(self,item,end):
+        """
+        Attach a finished node to the node that contains it, finishing any quotes it completes.
+        """
+        node,start = item
+        while True:
+            if start is not None:
+                node.end = end-self.base
+                if type(node) is List:
+                    #a finished list's items are fixed, and a tuple has no room to grow
+                    node.subexpressions = tuple(node.subexpressions)
+                if node is self.root:
+                    #the root's reader is only needed to resume it
+                    self.source.reader = None
+                    self.done = True
+                    return
+            if not self.stack:
+                break
+            parent,start = self.stack[-1]
+            if not isinstance(parent,(Quote,Quasiquote)):
+                parent.subexpressions.append(node)
+                return
+            parent.subexpression = node
+            self.stack.pop()
+            node = parent
+        if self.root is None:
+            if start is not None:
+                self.source.append(self.buffer[max(self.base-self.offset,0):end-self.offset])
+            self.forms.append(node)
+        else:
+            self.root.subexpressions.append(node)
+
+    def take(self):
+        forms = self.forms
+        self.forms = []
+        return forms
+
+    def close(self):
+        self.feed('',boundary=True)
+        if self.stack:
+            raise Exception('Unexpected end of input inside an unfinished list or quote')
+
+def iter_forms(source,chunk_size=1<<16):
+    """
+    Yield each top level form of source as soon as it has been read.
+    source can be a string, a file object opened in text mode or an iterable of string chunks.
+    A file is read chunk_size characters at a time, doubling while a single form is still open.
 
-    def __call__(self,evaluator=None,quoted=False,local_variables=None):
+    >>> text = '(list "esc \\\\\\\\ \\\\" q" "tab\\\\t") ; note\\n\\'a'
+    >>> [value_expr(value) for value in next(iter_forms(text)).as_value()]
+    ['list', '"esc \\\\\\\\ \\\\" q"', '"tab\\\\t"']
+    >>> lisp = Lisp()
+    >>> expected = lisp(text)
+    >>> all([lisp([text[:i],text[i:j],text[j:]]) == expected for i in range(len(text)) for j in range(i,len(text))])
+    True
+    >>> [[form(lisp.evaluator) for form in iter_forms(io.StringIO(text),size)] == expected for size in (1,2,3,5)]
+    [True, True, True, True]
+    >>> Lisp()(['(list "esc ','\\\\','" q")'])
+    [List('("esc \\\\" q")')]
+    """
+    reader = Reader()
+    if isinstance(source,str):
+        source = io.StringIO(source)
+    if hasattr(source,'read'):
+        chunks = read_chunks(source,chunk_size,reader)
+    else:
+        chunks = source
+    for chunk in chunks:
+        reader.feed(chunk)
+        yield from reader.take()
+    reader.close()
+    yield from reader.take()
+
+def read_chunks(file,chunk_size,reader):
+    size = chunk_size
+    while True:
+        chunk = file.read(size)
+        if not chunk:
+            return
+        yield chunk
+        if reader.stack:
+            size *= 2
+        else:
+            size = chunk_size
+
+class Symbol():
+    """
+    Runtime value of an atom. Symbols are interned, so there is one Symbol per name and eq on atoms
+    is an identity check. Reprs match the Atom parse node.
+
+    >>> lisp = Lisp()
+    >>> quoted,read,built = lisp("'sym (car '(other sym)) (car (cdr (list 'x (car '(sym)))))")
+    >>> quoted is Symbol('sym'),read is Symbol('other'),built is quoted,lisp("(eq 'sym (car '(sym))) (eq 'sym 'other)")
+    (True, True, True, [Atom('#t'), Atom('#f')])
+    >>> lisp("(eq 'a 'a)")[0] is TRUE,[type(node).__name__ for node in next(iter_forms('(f 1 1.5 "s" x)')).subexpressions]
+    (True, ['Atom', 'Literal', 'Literal', 'Literal', 'Atom'])
+    """
+    __slots__ = ('name',)
+    table = {}
+    def __new__(cls,name):
+        symbol = cls.table.get(name)
+        if symbol is None:
+            symbol = object.__new__(cls)
+            symbol.name = name
+            symbol = cls.table.setdefault(name,symbol)
+        return symbol
+    def __call__(self,evaluator=None,quoted=False,env=None):
         if quoted:
             return self
-        elif local_variables is not None and self.expr in local_variables:
-            return local_variables[self.expr]
+        else:
+            return evaluator(self,env)
+    def __reduce__(self):
+        return (Symbol,(self.name,))
+    def as_value(self):
+        return self
+    def is_atomic(self):
+        return True
+    @property
+    def expr(self):
+        return self.name
+    def __repr__(self):
+        return f'Atom({repr(self.name)})'
+
+TRUE = Symbol('#t')
+FALSE = Symbol('#f')
+QUOTE = Symbol('quote')
+QUASIQUOTE,UNQUOTE,UNQUOTE_SPLICING = map(Symbol,('quasiquote','unquote','unquote-splicing'))
+ATOM,EQ,CAR,CDR,CONS,COND,LABEL,LAMBDA = map(Symbol,('atom','eq','car','cdr','cons','cond','label','lambda'))
+
+class Atom(ParseNode):
+    """
+    A symbol token. Made from text alone, it is the span of a Source of its own.
+    """
+    __slots__ = ()
+    def __init__(self,expr,source=None,start=0):
+        if source is None:
+            expr = atom_pattern.match(expr).group(0)
+            source = Source(expr)
+        self.source = source
+        self.start = start
+        self.end = start+len(expr)
+        self.compiled = None
+    def resume(self,expr):
+        raise Exception('Not valid to resume on an atom')
 
+    def __call__(self,evaluator=None,quoted=False,env=None):
+        if quoted:
+            return self.as_value()
         else:
-            return evaluator[self.expr]
+            return evaluator(self,env)
 
     def _parse_end_trace(self,indent,indent_level,lines):
         return
     def is_atomic(self):
         return True
+    def as_value(self):
+        return Symbol(self.expr)
     def __eq__(self,other):
         return isinstance(other,Atom) and self.expr == other.expr
 
+class Literal(Atom):
+    """
+    Atom token for a number or string; the tokenizer reads its value once into self.value.
+    """
+    __slots__ = ('value',)
+    def __init__(self,expr,source=None,start=0,value=not_literal):
+        super().__init__(expr,source,start)
+        self.value = read_literal(self.expr) if value is not_literal else value
+    def __call__(self,evaluator=None,quoted=False,env=None):
+        return self.value
+    def as_value(self):
+        return self.value
 
-class Quote(Expression):
-    def __init__(self,expr,parent=None,**kwargs):
+
+class Quote(ParseNode):
+    __slots__ = ('subexpression',)
+    token = "'"
+    def __init__(self,expr=None):
         self.subexpression = None
-        self.consumed_chars = 1
-        self.parent = parent
-        self.current_child = None
-        self.complete = False
-        self.expr = expr
-        self.__dict__.update(kwargs)
-        self.parse(expr[1:],single=True)
-        self.expr = expr[:self.consumed_chars]
-    def consume(self,subexpression,expr):
-        self.subexpression = subexpression
-        self.consumed_chars += subexpression.consumed_chars
-        if self.current_child.complete:
-            self.current_child = None
-        return expr[subexpression.consumed_chars:]
-    def __call__(self,evaluator=None,quoted=True,local_variables=None):
-        return self.subexpression(evaluator,quoted=True,local_variables=local_variables)
+        self.end = None
+        self.compiled = None
+        if expr is not None:
+            self.source = Source(self.token)
+            self.start = 0
+            Reader(self).feed(expr,boundary=True)
+    def __call__(self,evaluator=None,quoted=True,env=None):
+        return self.subexpression.as_value()
+    def as_value(self):
+        return node_value(self)
+    def wrap(self,value):
+        return Quoted(value)
     def _parse_end_trace(self,indent,indent_level,lines):
         if self.complete:
             parsed = self.subexpression
@@ -415,263 +989,4112 @@ class Quote(Expression):
             lines.append(indent*(indent_level+1)+'...')
     def is_atomic(self):
         return self.subexpression.is_atomic()
-    def close(self,expr):
-        self.complete = True
-        return expr
     def as_list(self):
-        if self.complete:
-            return List(f'(quote {self.subexpression.expr})')
-        else:
-            return List('(quote')
+        return self.as_value().as_list()
     def cdr(self):
-        return self.as_list().cdr()
-
-           
+        return self.as_list().cdr
 
     def __eq__(self,other):
         if isinstance(other,Quote) and self.subexpression == other.subexpression:
             return True
-        elif isinstance(other,List) and other  == self.as_list():
+        elif isinstance(other,(List,Pair)) and other  == self.as_list():
             return True
         return False
 
 
-class List(Expression):
-    def __init__(self,expr=None,parent=None,**kwargs):
+class Quasiquote(ParseNode):
+    """
+    `x, read as the form (quasiquote x); its subclasses Unquote and UnquoteSplicing are ,x and ,@x.
+    As a value it is that form, so quoted code and macro expansions hold it as a plain list.
+    """
+    __slots__ = ('subexpression',)
+    operator = 'quasiquote'
+    token = '`'
+    __init__ = Quote.__init__
+    def __call__(self,evaluator=None,quoted=False,env=None):
+        if quoted:
+            return self.as_value()
+        else:
+            return evaluator(self,env)
+    def as_value(self):
+        return node_value(self)
+    def wrap(self,value):
+        return Pair(Symbol(self.operator),Pair(value,NIL))
+    _parse_end_trace = Quote._parse_end_trace
+    def is_atomic(self):
+        return False
+    def __eq__(self,other):
+        if isinstance(other,Quasiquote):
+            return type(other) is type(self) and self.subexpression == other.subexpression
+        elif isinstance(other,(List,Pair)):
+            return other == self.as_value()
+        return False
+
+class Unquote(Quasiquote):
+    __slots__ = ()
+    operator = 'unquote'
+    token = ','
+
+class UnquoteSplicing(Quasiquote):
+    __slots__ = ()
+    operator = 'unquote-splicing'
+    token = ',@'
+
+class List(ParseNode):
+    #expansion is the (macro,expansion) of the last macro expanded at this call site, see Evaluator.expand
+    __slots__ = ('subexpressions','value','expansion')
+    def __init__(self,expr=None):
         self.subexpressions = []
-        self.consumed_chars = 1
-        self.parent = parent
-        self.current_child = None
-        self.complete = False
-        self.expr = expr
-        self.__dict__.update(kwargs)
-        self.parse(expr[1:])
-        self.expr = expr[:self.consumed_chars]
-    def close(self,expr):
-        self.consumed_chars += 1
-        self.complete = True
-        return expr[1:]
-    def consume(self,subexpression,expr):
-        self.subexpressions.append(subexpression)
-        self.consumed_chars += subexpression.consumed_chars
-        if self.current_child.complete:
-            self.current_child = None
-        return expr[subexpression.consumed_chars:]
+        self.value = None
+        self.expansion = None
+        self.end = None
+        self.compiled = None
+        if expr is not None:
+            self.source = Source('(')
+            self.start = 0
+            Reader(self).feed(expr,boundary=True)
     def __iter__(self):
         yield from self.subexpressions
-    def __call__(self,evaluator=None,quoted=False,local_variables=None):
+    def __call__(self,evaluator=None,quoted=False,env=None):
         if quoted:
-            return self
+            return self.as_value()
         else:
-            return evaluator(self,local_variables)
-    def _parse_end_trace(self,indent,indent_level,lines):
-        for parsed in self.subexpressions:
-            lines.append(indent*(indent_level+1)+repr(parsed))
-            parsed._parse_end_trace(indent,indent_level+1,lines)
-        if not self.complete:
-            lines.append(indent*(indent_level+1)+'...')
+            return evaluator(self,env)
+    def as_value(self):
+        #the parse node is never mutated once complete, so its value can be built once and shared
+        if self.value is None:
+            node_value(self)
+        return self.value
     def is_atomic(self):
         return len(self.subexpressions) == 0
     def __eq__(self,other):
         if isinstance(other,List) and self.subexpressions == other.subexpressions:
             return True
-        elif isinstance(other,Quote) and self.subexpressions == other.as_list().subexpressions:
-            return True
+        elif isinstance(other,(Pair,Quote,Quoted)):
+            return self.as_value() == other
         return False
     def cdr(self):
-        return List('('+' '.join([x.expr for x in self.subexpressions[1:]])+')')
+        return self.as_value().cdr
     def cons(self,new_car):
-        return List('('+new_car.expr+' '+' '.join([x.expr for x in self.subexpressions])+')')
+        return Pair(new_car,self.as_value())
 
-class Function(List):
-    
-    def __init__(self,arg_expr_list,body,parsed_list,scoped_variables=None):
-        self.__dict__.update(parsed_list.__dict__)
-        self.arg_expr_list = arg_expr_list
-        self.body = body
-        self.scoped_variables = scoped_variables
-        if self.parent.current_child is parsed_list:
-            self.parent.current_child = self
-    def __call__(self,evaluator=None,quote=False,local_variables=None):
-        raise Exception('Functions don\'t have a direct value')
+def node_value(node):
+    """
+    The value of a parse node. Lists and quotes are built on a stack of partly built lists rather than
+    by recursion, so quoted data nested thousands deep reads at the default recursion limit.
 
-class Evaluator():
-    constants = {
-        '#t':Atom('#t'),
-        '#f':Atom('#f'),
-            }
-    def __init__(self,variables=None):
-        if variables is None:
-            variables = {}
-        self.variables = variables
-        self.variables.update(self.constants)
-    def __getitem__(self,variable_name):
-        try:
-            return int(variable_name)
-        except:
-            pass
+    >>> Lisp()("(car (cdr '(a '"+'(b '*5000+')'*5000+")))")[0].value.car
+    Atom('b')
+    """
+    #entries are [list node,quotes around it,subexpressions left to build,value built so far]
+    stack = []
+    while True:
+        quotes = []
+        while isinstance(node,(Quote,Quasiquote)):
+            quotes.append(node)
+            node = node.subexpression
+        if type(node) is List and node.value is None:
+            stack.append([node,quotes,len(node.subexpressions),NIL])
+        else:
+            value = node.as_value()
+            for quote in reversed(quotes):
+                value = quote.wrap(value)
+            if not stack:
+                return value
+            stack[-1][3] = Pair(value,stack[-1][3])
+        #close every list whose subexpressions are all built
+        while not stack[-1][2]:
+            node,quotes,_,value = stack.pop()
+            node.value = value
+            for quote in reversed(quotes):
+                value = quote.wrap(value)
+            if not stack:
+                return value
+            stack[-1][3] = Pair(value,stack[-1][3])
+        entry = stack[-1]
+        entry[2] -= 1
+        node = entry[0].subexpressions[entry[2]]
+
+class Pair():
+    """
+    Runtime value of a list: an immutable cons cell.
+    All lists end in the shared NIL singleton, so cdr is O(1) and cons allocates a single cell.
+    Reprs match the List parse node so values print the same way the parsed source does.
+    """
+    __slots__ = ('car','cdr')
+    def __init__(self,car,cdr):
+        self.car = car
+        self.cdr = cdr
+    @classmethod
+    def from_iterable(cls,values):
+        result = NIL
+        for value in reversed(list(values)):
+            result = cls(value,result)
+        return result
+    def __iter__(self):
+        cell = self
+        while cell is not NIL:
+            yield cell.car
+            cell = cell.cdr
+    def __len__(self):
+        length = 0
+        cell = self
+        while cell is not NIL:
+            length += 1
+            cell = cell.cdr
+        return length
+    def __call__(self,evaluator=None,quoted=False,env=None):
+        if quoted:
+            return self
+        else:
+            return evaluator(self,env)
+    def as_value(self):
+        return self
+    def is_atomic(self):
+        return False
+    def __eq__(self,other):
+        """
+        Lists nested in the cars are compared from a work stack, so deep trees compare without recursion.
+
+        >>> lisp = Lisp()
+        >>> lisp("(defun nest (n) (cond ((eq n 0) 'b) ('t (list 'a (nest (- n 1)))))) (setq tree (nest 5000)) (eq tree (subst 'b 'b tree)) (eq tree (subst 'c 'b tree))")[-2:]
+        [Atom('#t'), Atom('#f')]
+        """
+        stack = [(self,other)]
+        while stack:
+            cell,other = stack.pop()
+            if isinstance(other,Quoted):
+                other = other.as_list()
+            elif not isinstance(other,Pair):
+                return False
+            while cell is not other:
+                if cell is NIL or other is NIL:
+                    return False
+                car1,car2 = cell.car,other.car
+                if car1 is not car2:
+                    if isinstance(car1,Pair) and not (type(car1) is HashPair and type(car2) is HashPair):
+                        stack.append((car1,car2))
+                    elif isinstance(car1,Quoted) and isinstance(car2,Quoted):
+                        stack.append((Pair(car1.value,NIL),Pair(car2.value,NIL)))
+                    elif not car1 == car2:
+                        return False
+                cell = cell.cdr
+                other = other.cdr
+        return True
+    __hash__ = None
+    @property
+    def expr(self):
+        return value_expr(self)
+    def __reduce__(self):
+        #pickle the cells of a list as one sequence instead of recursing down the cdrs
+        return (Pair.from_iterable,(tuple(self),))
+    def __repr__(self):
+        return f'List({repr(self.expr)})'
+
+class Nil(Pair):
+    __slots__ = ()
+    def __init__(self):
+        pass
+    @property
+    def cdr(self):
+        return self
+    def is_atomic(self):
+        return True
+    def __reduce__(self):
+        return 'NIL'
+
+NIL = Nil()
+
+class HashPair(Pair):
+    """
+    A canonical cons cell made by a ConsTable. Lists built only from HashPairs are shared, so two of
+    them are structurally equal exactly when they are the same object; the hash is computed once.
+    """
+    __slots__ = ('hash','__weakref__')
+    def __eq__(self,other):
+        if type(other) is HashPair:
+            return self is other
+        return Pair.__eq__(self,other)
+    def __hash__(self):
+        return self.hash
+    def __reduce__(self):
+        return (cons_table.from_iterable,(tuple(self),))
+
+class LoosePair(Pair):
+    """
+    A cell made by a ConsTable that is not shared, because eq compares something in it by value
+    rather than by identity. Every cell whose list contains it is loose too.
+    """
+    __slots__ = ()
+    def __reduce__(self):
+        return (cons_table.from_iterable,(tuple(self),))
+
+class ConsTable():
+    """
+    Hash-consing table: cons returns the existing cell for a (car,cdr) pair if there is one.
+    Cells are held weakly, so canonical lists nobody references any more are garbage collected.
+    Quoted values inside lists are made canonical the same way.
+
+    Floats and fractions can be eq to numbers of another type, and vectors are eq by content,
+    so no key can share them the way eq compares them. Cells holding them are LoosePairs, which
+    compare by walking both lists, and eq gives the same answers with or without hash-consing:
+
+    >>> tests = "(eq (list 1) (list 1.0)) (eq (list 1/2) (list 0.5)) (eq (list (vector 1)) (list (vector 1))) (eq (list 1 2) (list 1 2))"
+    >>> Lisp()(tests) == Lisp(hash_cons=True)(tests) == [TRUE]*4
+    True
+    >>> [type(cell).__name__ for cell in Lisp(hash_cons=True)("(list 1.5 2) (cdr (list 1.5 2))")]
+    ['LoosePair', 'HashPair']
+    """
+    def __init__(self):
+        self.cells = weakref.WeakValueDictionary()
+        self.quotes = weakref.WeakValueDictionary()
+        #one canonical cell per key even when threads cons the same pair at once
+        self.lock = threading.RLock()
+        self.requests = 0
+        self.shared = 0
+        self.cell_size = sys.getsizeof(HashPair(NIL,NIL))
+    def cons(self,car,cdr):
+        car,car_key = self.canonical_key(car)
+        cdr,cdr_key = self.canonical_key(cdr)
+        return self.cons_canonical(car,car_key,cdr,cdr_key)
+    def cons_canonical(self,car,car_key,cdr,cdr_key):
+        with self.lock:
+            self.requests += 1
+            if car_key is None or cdr_key is None:
+                return LoosePair(car,cdr)
+            key = (car_key,cdr_key)
+            cell = self.cells.get(key)
+            if cell is None:
+                cell = HashPair(car,cdr)
+                cell.hash = hash(key)
+                self.cells[key] = cell
+            else:
+                self.shared += 1
+        return cell
+    def from_iterable(self,values):
+        result = NIL
+        for value in reversed(list(values)):
+            result = self.cons(value,result)
+        return result
+    def canonical(self,value):
+        return self.canonical_key(value)[0]
+    @staticmethod
+    def compound(value):
+        #a list or quote whose parts have to be made canonical first
+        return isinstance(value,Quoted) or isinstance(value,Pair) and type(value) is not HashPair and type(value) is not LoosePair and value is not NIL
+    def canonical_key(self,value):
+        """
+        The canonical form of value and the key it is shared under: its identity for canonical lists,
+        quotes and symbols, its type and value for ints and strings. The key is None when value can't be shared.
+        Lists and quotes are made canonical from the innermost out with a work stack, so they can nest
+        deeper than the recursion limit.
+
+        >>> deep = "'"+'(a '*5000+')'*5000
+        >>> lisp = Lisp(hash_cons=True)
+        >>> lisp(f"(car {deep}) (eq {deep} (car (list {deep})))")
+        [Atom('a'), Atom('#t')]
+        """
+        if not self.compound(value):
+            return self.atom_key(value)
+        #each entry is a list or quote being made canonical, its parts, and the canonical parts with their keys so far
+        stack = [(value,[value.value] if isinstance(value,Quoted) else list(value),[])]
+        while True:
+            value,parts,done = stack[-1]
+            while len(done) < len(parts):
+                part = parts[len(done)]
+                if self.compound(part):
+                    stack.append((part,[part.value] if isinstance(part,Quoted) else list(part),[]))
+                    break
+                done.append(self.atom_key(part))
+            else:
+                stack.pop()
+                result = self.quote_key(value,*done[0]) if isinstance(value,Quoted) else self.list_key(done)
+                if not stack:
+                    return result
+                stack[-1][2].append(result)
+    def list_key(self,parts):
+        result,key = NIL,id(NIL)
+        for car,car_key in reversed(parts):
+            result = self.cons_canonical(car,car_key,result,key)
+            key = None if type(result) is LoosePair else id(result)
+        return result,key
+    def quote_key(self,value,quoted,key):
+        if quoted is not value.value:
+            value = Quoted(quoted)
+        if key is None:
+            return value,None
+        with self.lock:
+            canonical = self.quotes.get(key)
+            if canonical is None:
+                canonical = self.quotes[key] = value
+        return canonical,id(canonical)
+    def atom_key(self,value):
+        if type(value) is HashPair or value is NIL:
+            return value,id(value)
+        elif type(value) is LoosePair:
+            return value,None
+        elif type(value) is int or type(value) is str:
+            return value,(type(value),value)
+        elif isinstance(value,(float,fractions.Fraction,Vector)):
+            return value,None
+        return value,id(value)
+    def stats(self):
+        """
+        live: canonical cells in the table, requests: cells asked for, shared: requests answered with an
+        existing cell, bytes_saved: memory those shared cells would have taken.
+        """
+        return {'live':len(self.cells),'requests':self.requests,'shared':self.shared,'bytes_saved':self.shared*self.cell_size}
+
+cons_table = ConsTable()
+
+cache_version = 2
+
+def load_forms(path):
+    """
+    Read the top level forms of a source file as data, using a cache stored at path+'.cache': a pickled
+    header, then the forms in the encoding of dump_data, which needs no recursion however deep they nest.
+    The cache is used as is when the source still has the mtime and size it was written for; otherwise
+    the source is hashed, and it is only parsed again if the sha256 differs. The cache is then rewritten.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(),'deep.lisp')
+    >>> with open(path,'w') as f:
+    ...     _ = f.write("(car '"+'(a '*5000+')'*5000+")")
+    >>> Lisp().load(path),Lisp().load(path),os.path.exists(path+'.cache')
+    ([Atom('a')], [Atom('a')], True)
+    """
+    cache_path = path+'.cache'
+    stat = os.stat(path)
+    try:
+        with open(cache_path,'rb') as f:
+            cache = pickle.load(f)
+            if cache['version'] != cache_version:
+                cache = None
+            else:
+                cache['forms'] = list(load_data(f))
+    except Exception:
+        cache = None
+    if cache is not None and cache['mtime'] == stat.st_mtime_ns and cache['size'] == stat.st_size:
+        return cache['forms']
+    with open(path,'rb') as f:
+        source = f.read()
+    digest = hashlib.sha256(source).hexdigest()
+    if cache is not None and cache['sha256'] == digest:
+        forms = cache['forms']
+    else:
+        forms = [form.as_value() for form in iter_forms(source.decode('utf-8'))]
+    cache = {'version':cache_version,'mtime':stat.st_mtime_ns,'size':stat.st_size,'sha256':digest}
+    temp_path = f'{cache_path}.{os.getpid()}'
+    try:
+        with open(temp_path,'wb') as f:
+            pickle.dump(cache,f,pickle.HIGHEST_PROTOCOL)
+            dump_data(Pair.from_iterable(forms),f)
+        os.replace(temp_path,cache_path)
+    except Exception:
+        #like a .pyc, the cache is an optimization: a read only directory, or forms it can't hold, just go without
         try:
-            return float(variable_name)
-        except:
+            os.remove(temp_path)
+        except OSError:
             pass
-        if variable_name.startswith('"'):
-            try:
-                return eval(variable_name)
-            except:
-                pass
-        if variable_name in self.variables:
-            return self.variables[variable_name]
+    return forms
+
+#the binary data format of dump_data: a header, a string table, then one tag byte and one operand per cell, in preorder
+data_magic = b'LISPDAT1'
+data_header = struct.Struct('<8sQQQ')
+(DATA_NIL,DATA_PAIR,DATA_SYMBOL,DATA_INT,DATA_FLOAT,DATA_STRING,DATA_BIGINT,DATA_FRACTION,DATA_QUOTED,DATA_REF) = range(10)
+
+def padded(size):
+    return -(-size//8)*8
+
+def dump_data(value,file):
+    """
+    Write a lisp value made of lists, symbols, quotes, numbers and strings to file (a path or a binary file
+    object) in a compact binary form that load_data reads back and map_data opens lazily. Returns the cell count.
+    Layout, little-endian: the header (magic, cell count, string count, string bytes); the string table, as
+    count+1 uint64 offsets into the UTF-8 bytes of symbol names, strings and big numbers; a uint8 tag per cell;
+    an int64 operand per cell. Cells are in preorder, so a pair's car is the next cell and its operand is the
+    index of its cdr. A list or quote met again (as in hash-consed data) is written as a REF to its first cell.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(),'table.dat')
+    >>> shared = Pair.from_iterable([Symbol('x'),2**70])
+    >>> dump_data(Pair.from_iterable([shared,shared,Quoted(Symbol('q')),'text',fractions.Fraction(1,3),-1.5,NIL]),path)
+    20
+    >>> load_data(path)
+    List('((x 1180591620717411303424) (x 1180591620717411303424) \\'q "text" 1/3 -1.5 ())')
+    >>> table = map_data(path)
+    >>> table.car.cdr.car, load_data(path) == table
+    (1180591620717411303424, True)
+    """
+    strings = {}
+    tags = bytearray()
+    operands = array.array('q')
+    seen = {}
+    def string(text):
+        if text not in strings:
+            strings[text] = len(strings)
+        return strings[text]
+    def cell(tag,operand=0):
+        tags.append(tag)
+        operands.append(operand)
+        return len(tags)-1
+    #("value",value) writes a value, ("cdr",index) points the pair at index to the next cell
+    pending = [('value',value)]
+    while pending:
+        action,item = pending.pop()
+        if action == 'cdr':
+            operands[item] = len(tags)
+            continue
+        if isinstance(item,(Pair,Quoted)) and item is not NIL:
+            if id(item) in seen:
+                cell(DATA_REF,seen[id(item)])
+                continue
+            seen[id(item)] = len(tags)
+        if item is NIL:
+            cell(DATA_NIL)
+        elif isinstance(item,Pair):
+            index = cell(DATA_PAIR)
+            pending.extend([('value',item.cdr),('cdr',index),('value',item.car)])
+        elif isinstance(item,Quoted):
+            cell(DATA_QUOTED)
+            pending.append(('value',item.value))
+        elif isinstance(item,Symbol):
+            cell(DATA_SYMBOL,string(item.name))
+        elif type(item) is int:
+            if -1<<63 <= item < 1<<63:
+                cell(DATA_INT,item)
+            else:
+                cell(DATA_BIGINT,string(str(item)))
+        elif type(item) is float:
+            cell(DATA_FLOAT,struct.unpack('<q',struct.pack('<d',item))[0])
+        elif type(item) is fractions.Fraction:
+            cell(DATA_FRACTION,string(str(item)))
+        elif type(item) is str:
+            cell(DATA_STRING,string(item))
         else:
-            raise Exception(f'Unbound variable: {variable_name}')
-    def __setitem__(self,variable_name,value):
-        if not isinstance(value,Expression):
-            raise Exception('Variables must map to expressions')
+            raise Exception(f'Cannot dump {value_expr(item)}: data can only hold lists, symbols, numbers and strings')
+    encoded = [text.encode('utf-8') for text in strings]
+    offsets = array.array('Q',[0])
+    for data in encoded:
+        offsets.append(offsets[-1]+len(data))
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+        operands.byteswap()
+    blob = b''.join(encoded)
+    parts = [data_header.pack(data_magic,len(tags),len(strings),len(blob)),offsets.tobytes(),blob,bytes(padded(len(blob))-len(blob)),
+        bytes(tags),bytes(padded(len(tags))-len(tags)),operands.tobytes()]
+    if isinstance(file,(str,os.PathLike)):
+        with open(file,'wb') as opened:
+            opened.writelines(parts)
+    else:
+        file.writelines(parts)
+    return len(tags)
+
+class DataFile():
+    """
+    The cells of a file written by dump_data, over a buffer: bytes for load_data or a read-only mmap for
+    map_data. value(index) decodes one cell; a pair is decoded as a MappedPair whose car and cdr are only
+    decoded when first read, so opening a file touches nothing but its header.
+    """
+    def __init__(self,buffer):
+        magic,self.cells,count,size = data_header.unpack_from(buffer,0)
+        if magic != data_magic:
+            raise Exception('Not a lisp data file')
+        self.buffer = buffer
+        self.offsets = data_header.size
+        self.strings_start = self.offsets+8*(count+1)
+        self.tags = self.strings_start+padded(size)
+        self.operands = self.tags+padded(self.cells)
+        if len(buffer) < self.operands+8*self.cells:
+            raise Exception('Truncated lisp data file')
+        #decoded strings, and the values of REF targets so a shared list is decoded once
+        self.strings = {}
+        self.shared = {}
+    def string(self,index):
+        text = self.strings.get(index)
+        if text is None:
+            start,end = struct.unpack_from('<QQ',self.buffer,self.offsets+8*index)
+            text = self.strings[index] = str(self.buffer[self.strings_start+start:self.strings_start+end],'utf-8')
+        return text
+    def value(self,index):
+        tag = self.buffer[self.tags+index]
+        operand, = struct.unpack_from('<q',self.buffer,self.operands+8*index)
+        if tag == DATA_PAIR:
+            return MappedPair(self,index,operand)
+        elif tag == DATA_SYMBOL:
+            return Symbol(self.string(operand))
+        elif tag == DATA_INT:
+            return operand
+        elif tag == DATA_NIL:
+            return NIL
+        elif tag == DATA_STRING:
+            return self.string(operand)
+        elif tag == DATA_QUOTED:
+            return Quoted(self.value(index+1))
+        elif tag == DATA_REF:
+            if operand not in self.shared:
+                self.shared[operand] = self.value(operand)
+            return self.shared[operand]
+        elif tag == DATA_FLOAT:
+            return struct.unpack_from('<d',self.buffer,self.operands+8*index)[0]
+        elif tag == DATA_BIGINT:
+            return int(self.string(operand))
+        elif tag == DATA_FRACTION:
+            return normalize(fractions.Fraction(self.string(operand)))
+        raise Exception(f'Bad lisp data tag {tag} at cell {index}')
+
+pair_car = Pair.car
+pair_cdr = Pair.cdr
+
+class MappedPair(Pair):
+    """
+    A cell of a DataFile: car and cdr are decoded the first time they are read, then kept.
+    """
+    __slots__ = ('data','index','cdr_index')
+    def __init__(self,data,index,cdr_index):
+        self.data = data
+        self.index = index
+        self.cdr_index = cdr_index
+    @property
+    def car(self):
+        try:
+            return pair_car.__get__(self)
+        except AttributeError:
+            value = self.data.value(self.index+1)
+            pair_car.__set__(self,value)
+            return value
+    @property
+    def cdr(self):
+        try:
+            return pair_cdr.__get__(self)
+        except AttributeError:
+            value = self.data.value(self.cdr_index)
+            pair_cdr.__set__(self,value)
+            return value
+
+def load_data(file):
+    """
+    Read the value that dump_data wrote to file (a path or a binary file object), decoding every cell now.
+    """
+    if isinstance(file,(str,os.PathLike)):
+        with open(file,'rb') as opened:
+            data = DataFile(opened.read())
+    else:
+        data = DataFile(file.read())
+    #the cells are built from the last one back, so the car and cdr of a pair already exist when it is made;
+    #only a REF points back, to a cell built later: it is filled in at the end
+    tags = data.buffer[data.tags:data.tags+data.cells]
+    operands = array.array('q')
+    operands.frombytes(data.buffer[data.operands:data.operands+8*data.cells])
+    if sys.byteorder != 'little':
+        operands.byteswap()
+    values = [None]*data.cells
+    fixes = []
+    for index in range(data.cells-1,-1,-1):
+        tag = tags[index]
+        if tag == DATA_PAIR:
+            values[index] = Pair(values[index+1],values[operands[index]])
+            if tags[index+1] == DATA_REF:
+                fixes.append((values[index],'car',operands[index+1]))
+            if tags[operands[index]] == DATA_REF:
+                fixes.append((values[index],'cdr',operands[operands[index]]))
+        elif tag == DATA_QUOTED:
+            values[index] = Quoted(values[index+1])
+            if tags[index+1] == DATA_REF:
+                fixes.append((values[index],'value',operands[index+1]))
+        elif tag == DATA_NIL:
+            values[index] = NIL
+        elif tag == DATA_SYMBOL:
+            values[index] = Symbol(data.string(operands[index]))
+        elif tag == DATA_INT:
+            values[index] = operands[index]
+        elif tag != DATA_REF:
+            values[index] = data.value(index)
+    for target,attribute,index in fixes:
+        setattr(target,attribute,values[index])
+    return values[0] if data.cells else NIL
+
+def map_data(path):
+    """
+    The value that dump_data wrote to path, over a read-only mmap of the file: cells are decoded as they
+    are reached, so a large file opens at once and only the pages that are read are loaded from disk.
+    """
+    with open(path,'rb') as opened:
+        buffer = mmap.mmap(opened.fileno(),0,access=mmap.ACCESS_READ)
+    data = DataFile(buffer)
+    return data.value(0) if data.cells else NIL
+
+class Quoted():
+    """
+    Runtime value of a quote nested inside quoted data, e.g. the 'b in '(a 'b).
+    It is atomic when the quoted value is atomic, and behaves as (quote value) under car/cdr.
+    """
+    __slots__ = ('value','__weakref__')
+    def __init__(self,value):
+        self.value = value
+    def __call__(self,evaluator=None,quoted=False,env=None):
+        return self.value
+    def as_value(self):
+        return self
+    def as_list(self):
+        return Pair(QUOTE,Pair(self.value,NIL))
+    def is_atomic(self):
+        return is_atomic(self.value)
+    def __eq__(self,other):
+        if isinstance(other,Quoted):
+            return self.value == other.value
+        elif isinstance(other,Pair):
+            return other == self.as_list()
+        return False
+    __hash__ = None
+    @property
+    def expr(self):
+        return value_expr(self)
+    def __repr__(self):
+        return f'Quote({repr(self.expr)})'
+
+def value_expr(value):
+    """
+    The printed form of a value. Nested lists and quotes are written from a stack of pending values,
+    with their punctuation pushed as (text,) tuples, so deep trees print without recursion.
+
+    >>> tree = Lisp()("'"+'(a '*5000+')'*5000)[0]
+    >>> len(value_expr(tree)),value_expr(tree)[:9],repr(tree)[-9:]
+    (19999, '(a (a (a ', ")))))))')")
+    """
+    parts = []
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if type(value) is tuple:
+            parts.append(value[0])
+        elif isinstance(value,Pair):
+            parts.append('(')
+            stack.append((')',))
+            items = list(value)
+            for index in range(len(items)-1,-1,-1):
+                stack.append(items[index])
+                if index:
+                    stack.append((' ',))
+        elif isinstance(value,Quoted):
+            parts.append("'")
+            stack.append(value.value)
+        elif isinstance(value,str):
+            parts.append(json.dumps(value,ensure_ascii=False))
+        elif isinstance(value,(int,float)):
+            parts.append(repr(value))
+        elif isinstance(value,fractions.Fraction):
+            parts.append(str(value))
         else:
-            self.variables[variable_name] = value
-    def trace(self,parsed_list,local_variables):
-        if logger.level > logarhythm.DEBUG+5:
-            return
-        logger.log(logarhythm.DEBUG+5,'Eval trace: ' + repr(parsed_list))
+            parts.append(value.expr)
+    return ''.join(parts)
+
+def normalize(value):
+    """
+    Numeric tower: int, Fraction, float. A Fraction that is a whole number becomes an int.
+    """
+    if type(value) is fractions.Fraction and value.denominator == 1:
+        return value.numerator
+    return value
 
+class Vector():
+    """
+    A vector of numbers. Ints that all fit in 64 bits are packed into int64s and floats into float64s, in a
+    numpy array when numpy is installed and an array.array otherwise; any other mix of numbers (bigger ints,
+    fractions, ints with floats) is kept as a list of the numbers themselves, so a vector holds exactly what
+    it was made of. map with + - * / runs over packed vectors as one batched operation, and sum and dot over
+    the whole buffer, whenever that gives what the scalar operations give; otherwise they run on python
+    numbers, with the same exact results and errors as the scalar operations.
 
-    def __call__(self,parsed_list,local_variables=None):
+    >>> lisp = Lisp()
+    >>> lisp("(map + (vector 9223372036854775807) (vector 1)) (vector 1/3 1) (map / (vector 1 2) (vector 2 4)) (map / (vector 1.0) (vector 4))")
+    [Vector('#(9223372036854775808)'), Vector('#(1/3 1)'), Vector('#(1/2 1/2)'), Vector('#(0.25)')]
+    >>> lisp("(map * (vector 4294967296 -3) (vector 4294967296 2)) (sum (vector 9223372036854775807 1)) (dot (vector 1/2 3) (vector 2 1))")
+    [Vector('#(18446744073709551616 -6)'), 9223372036854775808, 4]
+    >>> lisp("(map / (vector 1) (vector 0))")
+    Traceback (most recent call last):
+    ...
+    Exception: Division by zero
+    >>> lisp("(map / (vector 1.5 2.5) (vector 2.0 0.0))")
+    Traceback (most recent call last):
+    ...
+    Exception: Division by zero
+    """
+    __slots__ = ('data',)
+    #primitive name: (elementwise python function, numpy ufunc name)
+    batched = {
+        '+':(operator.add,'add'),
+        '-':(operator.sub,'subtract'),
+        '*':(operator.mul,'multiply'),
+        '/':(operator.truediv,'true_divide'),
+        }
+    #packed ints are in [-int_limit,int_limit)
+    int_limit = 2**63
+    def __init__(self,data):
+        self.data = data
+    @classmethod
+    def from_values(cls,values):
+        values = list(values)
+        for value in values:
+            if type(value) not in number_types:
+                raise Exception(f'Vectors can only hold numbers, not {value_expr(value)}')
+        if all([type(value) is int and -cls.int_limit <= value < cls.int_limit for value in values]):
+            typecode = 'q'
+        elif all([type(value) is float for value in values]):
+            typecode = 'd'
+        else:
+            return cls(values)
+        if numpy is not None:
+            return cls(numpy.array(values,dtype=numpy.int64 if typecode == 'q' else numpy.float64))
+        return cls(array.array(typecode,values))
+    @property
+    def kind(self):
+        """
+        'q' for packed ints, 'd' for packed floats, None for a list of python numbers.
         """
-        Variable scoping:
-            global: Evaluator.variables
-            function scoped: specific to function, present in all calls to that function
-            local scoped: the argument substitutions when calling a function
+        if type(self.data) is list:
+            return None
+        elif numpy is not None:
+            return 'q' if self.data.dtype == numpy.int64 else 'd'
+        return self.data.typecode
+    def bound(self):
+        #the largest absolute value of packed ints, to tell whether int64 arithmetic on them could overflow
+        if not len(self):
+            return 0
+        elif numpy is not None:
+            return max(self.data.max().item(),-self.data.min().item())
+        return max(max(self.data),-min(self.data))
+    @classmethod
+    def batch(cls,name,vectors):
         """
-        self.trace(parsed_list,local_variables)
+        Apply the primitive name elementwise over equal length vectors as one packed operation; one vector means
+        negation or reciprocal for - and /. None when that could differ from the scalar operation: for vectors
+        that are not packed, / of ints, which is exact, division by zero, and ints that could overflow 64 bits.
+        """
+        if len({len(vector) for vector in vectors}) > 1:
+            raise Exception('map over vectors of different lengths')
+        kinds = {vector.kind for vector in vectors}
+        if None in kinds:
+            return None
+        elif 'd' not in kinds:
+            if name == '/':
+                return None
+            bounds = [vector.bound() for vector in vectors]
+            if (math.prod(bounds) if name == '*' else sum(bounds)) >= cls.int_limit:
+                return None
+        elif name == '/' and any([0 in vector.data for vector in (vectors[1:] or vectors)]):
+            return None
+        function,ufunc = cls.batched[name]
+        datas = [vector.data for vector in vectors]
+        if len(datas) == 1 and name in ('-','/'):
+            datas.insert(0,[0 if name == '-' else 1]*len(datas[0]) if numpy is None else (0 if name == '-' else 1))
+        if numpy is not None:
+            return cls(functools.reduce(getattr(numpy,ufunc),datas))
+        typecode = 'd' if 'd' in kinds else 'q'
+        return cls(functools.reduce(lambda x,y: array.array(typecode,map(function,x,y)),datas))
+    def sum(self):
+        kind = self.kind
+        if kind is None or (kind == 'q' and len(self)*self.bound() >= self.int_limit):
+            return normalize(sum(self))
+        elif numpy is not None:
+            return self.data.sum().item()
+        elif kind == 'd':
+            return math.fsum(self.data)
+        return sum(self.data)
+    def dot(self,other):
+        if len(self) != len(other):
+            raise Exception('dot of vectors of different lengths')
+        kinds = {self.kind,other.kind}
+        if None in kinds or (kinds == {'q'} and len(self)*self.bound()*other.bound() >= self.int_limit):
+            return normalize(sum(map(operator.mul,self,other)))
+        elif numpy is not None:
+            return numpy.dot(self.data,other.data).item()
+        elif 'd' in kinds:
+            return math.fsum(map(operator.mul,self.data,other.data))
+        return sum(map(operator.mul,self.data,other.data))
+    def __len__(self):
+        return len(self.data)
+    def __iter__(self):
+        return iter(self.data if type(self.data) is list else self.data.tolist())
+    def __getitem__(self,index):
+        return self.data[index] if numpy is None or type(self.data) is list else self.data[index].item()
+    def __eq__(self,other):
+        return isinstance(other,Vector) and len(self) == len(other) and list(self) == list(other)
+    __hash__ = None
+    def is_atomic(self):
+        return True
+    @property
+    def expr(self):
+        return '#('+' '.join([value_expr(value) for value in self])+')'
+    def __repr__(self):
+        return f'Vector({repr(self.expr)})'
 
-        subexpressions = parsed_list
-        operator,*args = subexpressions
-        if isinstance(operator,Atom):
-            operator_name = operator.expr
-            method_name = f'op_{operator_name}'
-            if hasattr(self,method_name):
-                return getattr(self,method_name)(parsed_list,local_variables,*args)
-            else:
-                if local_variables is not None and operator_name in local_variables:
-                    operator = local_variables[operator_name]
-                else:
-                    if operator_name in self.variables:
-                        operator = self.variables[operator_name]
-                    else:
-                        if re.search('^c[ad]{2,4}r$',operator_name) is not None:
-                            if len(args) != 1:
-                                raise Exception("car/cdr variants require a single list argument")
-                            result = args[0](self,local_variables=local_variables)
-                            for charac in operator_name[-2:0:-1]:
-                                if charac == 'a':
-                                    result = result.subexpressions[0]
-                                elif charac == 'd':
-                                    result = result.cdr()
-                                else:
-                                    assert (False)
-                            return result
-                            
-                        else:
-                            raise Exception('Unbounded variable name: %s' % operator_name)
-                    
-        if isinstance(operator,List):
-            if not isinstance(operator,Function):
-                operator = operator(self,local_variables=local_variables)
-            if isinstance(operator,Function):
-                if local_variables is None:
-                    function_variables = {}
-                else:
-                    function_variables = dict(local_variables)
-                if operator.scoped_variables is not None:
-                    function_variables.update(operator.scoped_variables)
-                apply_values = []
-                for apply_arg in args:
-                    apply_value = apply_arg(self,local_variables=local_variables)
-                    apply_values.append(apply_value)
-                function_variables.update(dict(zip(operator.arg_expr_list,apply_values)))
-                return operator.body(self,local_variables=function_variables)
+class Table():
+    """
+    A hash table value, made by make-table. Keys match as eq matches them: entries maps the eq_key of a key
+    to its (key,value), so a symbol key is found by identity in O(1) and a list key by a hash of its structure.
+    table-put changes a table in place, table-with returns a changed table and leaves the table as it was.
+    Tables among the globals of an Image are frozen, so sessions can read them but not put into them.
+
+    A table made by table-with shares the entries of the one it was made from instead of copying them:
+    layers is a tuple of older dicts that no table changes any more, and entries the table's own newest
+    ones. A layer absorbs the layer after it when that one is at least half its size, so there are only
+    logarithmically many, and a chain of table-with calls copies each entry a logarithmic number of times.
+
+    >>> lisp = Lisp()
+    >>> len(lisp("(defun fill (t n) (cond ((= n 0) t) ('#t (fill (table-with t n (* n n)) (- n 1))))) (setq t (fill (make-table) 20000))")[1].layers) < 16
+    True
+    >>> lisp("(setq u (table-with t 'a 1)) (setq v (table-with t 'a 2)) (table-put t 'a 3) (list (table-get t 'a) (table-get u 'a) (table-get v 'a) (table-get v 7))")[-1]
+    List('(3 1 2 49)')
+    """
+    __slots__ = ('entries','layers','frozen')
+    def __init__(self,entries=None,frozen=False,layers=()):
+        self.entries = {} if entries is None else entries
+        self.layers = layers
+        self.frozen = frozen
+    @staticmethod
+    def key(key):
+        key = eq_key(key)
+        try:
+            hash(key)
+        except TypeError:
+            raise Exception(f'A table key must be hashable, got {type(key).__name__}') from None
+        return key
+    def get(self,key,default):
+        key = self.key(key)
+        entry = self.entries.get(key)
+        if entry is None:
+            for layer in reversed(self.layers):
+                entry = layer.get(key)
+                if entry is not None:
+                    break
             else:
-                pdb.set_trace()
-        else:
-            pdb.set_trace()
-
-    def op_quote(self,parsed_list,local_variables,arg):
-        return arg
-    def op_atom(self,parsed_list,local_variables,arg):
-        value = arg(self,local_variables=local_variables)
-        if value.is_atomic():
-            return self['#t']
-        else:
-            return self['#f']
-    def op_eq(self,parsed_list,local_variables,arg1,arg2):
-        value1 = arg1(self,local_variables=local_variables)
-        value2 = arg2(self,local_variables=local_variables)
-        if value1 == value2:
-            return self['#t']
-        else:
-            return self['#f']
-    def op_car(self,parsed_list,local_variables,arg):
-        value = arg(self,local_variables=local_variables)
-        if isinstance(value,Quote):
-            value = value.as_list()
-        if not isinstance(value,List):
-            raise Exception('car arg must be list')
-        return value.subexpressions[0]
+                return default
+        return entry[1]
+    def put(self,key,value):
+        if self.frozen:
+            raise Exception('Cannot table-put: the table is in a frozen Image')
+        self.entries[self.key(key)] = (key,value)
+    def with_entry(self,key,value):
+        """
+        A new table of these entries with key mapped to value. Unless this table is frozen, its own entries
+        become a layer it shares with the new one, and it goes on putting into a dict of its own.
+        """
+        layers = self.layers
+        if self.entries:
+            layers += (self.entries,)
+            while len(layers) > 1 and 2*len(layers[-1]) >= len(layers[-2]):
+                merged = dict(layers[-2])
+                merged.update(layers[-1])
+                layers = layers[:-2]+(merged,)
+            if not self.frozen:
+                self.entries,self.layers = {},layers
+        table = Table(None,False,layers)
+        table.put(key,value)
+        return table
+    def merged(self):
+        #every entry in one dict, in the order the keys were first put
+        merged = {}
+        for layer in self.layers:
+            merged.update(layer)
+        merged.update(self.entries)
+        return merged
+    def keys(self):
+        return [key for key,value in self.merged().values()]
+    def is_atomic(self):
+        return True
+    @property
+    def expr(self):
+        return '#<table'+''.join([f' ({value_expr(key)} {value_expr(value)})' for key,value in self.merged().values()])+'>'
+    def __repr__(self):
+        return f'Table({repr(self.expr)})'
 
-    def op_cdr(self,parsed_list,local_variables,arg):
-        value = arg(self,local_variables=local_variables)
-        if isinstance(value,Quote):
-            value = value.as_list()
-        if not isinstance(value,List):
-            raise Exception('cdr arg must be list')
-        return value.cdr()
-
-    def op_cons(self,parsed_list,local_variables,arg1,arg2):
-        value1 = arg1(self,local_variables=local_variables)
-        value2 = arg2(self,local_variables=local_variables)
-        if isinstance(value2,Quote):
-            value2 = value2.as_list()
-        if not isinstance(value2,List):
-            raise Exception('cons second arg must be list')
-        return value2.cons(value1)
-    def op_cond(self,parsed_list,local_variables,*args):
-        for p,e in args:
-            pval = p(self,local_variables=local_variables)
-            if pval != self['#f']:
-                return e(self,local_variables=local_variables)
-        return List('()')
-    def op_lambda(self,parsed_list,local_variables,arglist, body):
-        arg_expr_list = []
-        for arg in arglist:
-            if not isinstance(arg,Atom):
-                raise Exception('Function arguments must be Atoms')
-            arg_expr_list.append(arg.expr)
-        return Function(arg_expr_list,body,parsed_list)
-    def op_label(self,parsed_list,local_variables,func_name,func_list):
-        func = func_list(self,local_variables=local_variables)
-        label_func = Function(func.arg_expr_list,func.body,parsed_list)
-        if label_func.scoped_variables is None:
-            label_func.scoped_variables = {}
-        label_func.scoped_variables[func_name.expr] = label_func
-        return label_func
-
-    def op_defun(self,parsed_list,local_variables,func_name,arglist,body):
-        arg_expr_list = []
-        for arg in arglist:
-            if not isinstance(arg,Atom):
-                raise Exception('Function arguments must be Atoms')
-            arg_expr_list.append(arg.expr)
-        func = Function(arg_expr_list,body,parsed_list)
-        if func.scoped_variables is None:
-            func.scoped_variables = {}
-        func.scoped_variables[func_name.expr] = func
-        self.variables[func_name.expr] = func
-        return func
-    def op_setq(self,parsed_list,local_variables,variable_name,parsed_value):
-        value = parsed_value(self,local_variables=local_variables)
-        self.variables[variable_name.expr] = value
-        return value
-    def op_list(self,parsed_list,local_variables,*args):
-        return List(f'({" ".join([arg(self,local_variables=local_variables).expr for arg in args])})')
+class Promise():
+    """
+    A delayed evaluation, made by (delay form) or by the stream functions: node(evaluator,env) runs once,
+    on the first force, and its value is kept. The node and env are dropped then, so a forced promise
+    holds nothing but its value.
+    """
+    __slots__ = ('node','env','value')
+    def __init__(self,node,env=None):
+        self.node = node
+        self.env = env
+        self.value = None
+    def force(self,evaluator):
+        node = self.node
+        if node is not None:
+            if evaluator.budget is not None:
+                #the tail of a stream over a python iterator or a file runs no lisp, so forcing it is a step of its own
+                evaluator.budget.step()
+            self.value = evaluator.execute(node,self.env)
+            self.node = self.env = None
+        return self.value
+    def is_atomic(self):
+        return True
+    @property
+    def expr(self):
+        return '#<promise>' if self.node is not None else f'#<promise {value_expr(self.value)}>'
+    def __repr__(self):
+        return f'Promise({repr(self.expr)})'
+
+class Stream():
+    """
+    A lazy sequence: a cell of head, the first element, and tail, a Promise of the rest of the stream,
+    which is another Stream or '() at the end. A cell is only made when the tail before it is forced,
+    so streams can be infinite or come from inputs larger than memory: as long as nothing keeps the first
+    cells, the ones already walked are freed. Forcing memoizes in place, so a stream over a python
+    iterator or a file reads each item once and should be walked by one thread.
+
+    >>> lisp = Lisp()
+    >>> lisp('''
+    ... (defun ints (n) (stream-cons n (ints (+ n 1))))
+    ... (setq squares (stream-map (lambda (x) (* x x)) (ints 1)))
+    ... (to-list (stream-take squares 5))
+    ... (to-list (stream-take (stream-filter (lambda (x) (> x 10)) squares) 3))
+    ... squares
+    ... (setq p (delay (cons 'a '(b))))
+    ... (force p)
+    ... (force 'c)
+    ... ''')[2:]
+    [List('(1 4 9 16 25)'), List('(16 25 36)'), Stream('#<stream 1 4 9 16 25 36 ...>'), Promise('#<promise (a b)>'), List('(a b)'), Atom('c')]
+    >>> lisp.evaluator['numbers'] = Stream.from_iterable(range(10000))
+    >>> lisp('''
+    ... (defun count (s n) (cond ((stream-null s) n) ('#t (count (stream-cdr s) (+ n 1)))))
+    ... (count (stream-filter (lambda (x) (< x 100)) numbers) 0)
+    ... ''')[1]
+    100
+    """
+    __slots__ = ('head','tail')
+    def __init__(self,head,tail):
+        self.head = head
+        self.tail = tail
+    @classmethod
+    def from_iterable(cls,iterable):
+        """
+        A stream of the items of a python iterable, which must be lisp values (numbers, strings, symbols, lists...).
+        Items are pulled from the iterator as the stream is walked.
+        """
+        iterator = iter(iterable)
+        def rest(evaluator=None,env=None):
+            for item in iterator:
+                return cls.cell(evaluator,item,Promise(rest))
+            return NIL
+        return rest()
+    @classmethod
+    def cell(cls,evaluator,head,tail):
+        """
+        A cell made by python code while evaluator runs, counted against its budget as stream-cons counts its cells.
+        """
+        if evaluator is not None and evaluator.budget is not None:
+            evaluator.budget.allocate(1)
+        return cls(head,tail)
+    @classmethod
+    def from_file(cls,file):
+        """
+        A stream of the lines of a text file (a path or a file object), without their line ends.
+        A path is opened when the stream is made and closed when its last line has been read.
+        """
+        def lines():
+            with (open(file) if isinstance(file,(str,os.PathLike)) else file) as opened:
+                for line in opened:
+                    yield line.rstrip('\r\n')
+        return cls.from_iterable(lines())
+    def is_atomic(self):
+        return True
+    @property
+    def expr(self):
+        #the elements that have been forced already
+        items = []
+        cell = self
+        while type(cell) is Stream and len(items) < 20:
+            items.append(value_expr(cell.head))
+            if cell.tail.node is not None:
+                break
+            cell = cell.tail.value
+        if type(cell) is Stream:
+            items.append('...')
+        return '#<stream '+' '.join(items)+'>'
+    def __repr__(self):
+        return f'Stream({repr(self.expr)})'
+
+def is_atomic(value):
+    if isinstance(value,(ParseNode,Pair,Quoted)):
+        return value.is_atomic()
+    return True
+
+def as_data(form):
+    """
+    A form as quoted data: the value of a parse node, or the form itself when it already is a value.
+    """
+    if isinstance(form,(ParseNode,Pair,Quoted,Symbol)):
+        return form.as_value()
+    return form
+
+def substitute(form,replacements):
+    """
+    form with each symbol named in replacements replaced by its replacement, except inside quoted data.
+    """
+    name = symbol_name(form)
+    if name is not None:
+        return replacements.get(name,form)
+    if isinstance(form,Pair) and form is not NIL and symbol_name(form.car) != 'quote':
+        return Pair.from_iterable([substitute(item,replacements) for item in form])
+    return form
+
+#what constant_value returns for a node that is not a constant
+not_constant = object()
+
+def constant_value(node):
+    """
+    The value that a compiled node always returns, when it was made by Evaluator.constant; otherwise not_constant.
+    """
+    return getattr(node,'constant',not_constant)
+
+def arity_error(name,least,most,count):
+    if most is None:
+        expected = f'at least {least}'
+    elif most != least:
+        expected = f'{least} to {most}'
+    else:
+        expected = least
+    return Exception(f'{name} expects {expected} arguments, got {count}')
+
+def symbol_name(parsed):
+    """
+    The name of a symbol in code, whether it is a parse node or a runtime value; None for anything else.
+    """
+    if isinstance(parsed,Symbol):
+        return parsed.name
+    elif isinstance(parsed,Atom) and not isinstance(parsed,Literal):
+        return parsed.expr
+    return None
+
+class Function(List):
+    """
+    A closure: argument names, the body to run and the frame the function was defined in.
+    name is the defun or label name, body_scope the Scope the body was compiled in.
+    """
+    name = 'lambda'
+    body_scope = None
+    def __init__(self,arg_expr_list,body,parsed_list,env=None):
+        if isinstance(parsed_list,Pair):
+            self.subexpressions = tuple(parsed_list)
+            self.source = Source(parsed_list.expr)
+            self.start,self.end = 0,len(self.source.text)
+        else:
+            self.subexpressions = parsed_list.subexpressions
+            self.source,self.start,self.end = parsed_list.source,parsed_list.start,parsed_list.end
+        self.value = None
+        self.expansion = None
+        self.compiled = None
+        self.arg_expr_list = arg_expr_list
+        self.body = body
+        self.body_node = None
+        self.env = env
+    def __call__(self,evaluator=None,quote=False,env=None):
+        raise Exception('Functions don\'t have a direct value')
+    def as_value(self):
+        return self
+    #a closure is only eq to itself, whatever its text, so it can key tables and association lists
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+    def apply(self,evaluator,values):
+        """
+        Bind the argument values in a new frame and return a TailCall of the body for Evaluator.execute to run.
+        """
+        if len(values) != len(self.arg_expr_list):
+            raise Exception(f'{self.expr} expects {len(self.arg_expr_list)} arguments, got {len(values)}')
+        return TailCall(self.body_node,Frame(values,self.env))
+
+class MemoFunction(Function):
+    """
+    A Function whose results are cached by the structure of its argument values.
+    The cache keeps at most maxsize entries, evicting the least recently used one. It is emptied whenever
+    a defun, setq or table-put has run since it was filled, since a result may depend on any global. A body
+    that runs setq, defun or table-put itself is refused when the function is created.
+    """
+    default_maxsize = 1024
+    #a frozen MemoFunction is reached through an Image, and each evaluator calling it fills a copy of its own
+    frozen = False
+    def __init__(self,arg_expr_list,body,parsed_list,env=None,maxsize=None):
+        super().__init__(arg_expr_list,body,parsed_list,env)
+        if maxsize is None:
+            maxsize = self.default_maxsize
+        if mutates(body):
+            raise Exception(f'Cannot memoize {self.expr}: its body uses setq, defun or table-put')
+        if maxsize < 1:
+            raise Exception('Memoized functions need a maxsize of at least 1')
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    def apply(self,evaluator,values):
+        if self.frozen:
+            copy = evaluator.memo_copies.get(self)
+            if copy is None:
+                copy = evaluator.memo_copies[self] = self.empty_copy()
+            return copy.apply(evaluator,values)
+        if self.generation != evaluator.generation:
+            self.cache.clear()
+            self.generation = evaluator.generation
+        key = tuple([memo_key(value) for value in values])
+        try:
+            hash(key)
+        except TypeError:
+            #a value that can't be hashed can't be looked up, so the call just runs
+            return super().apply(evaluator,values)
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.misses += 1
+        generation = evaluator.generation
+        def store(result):
+            if evaluator.generation == generation:
+                self.cache[key] = result
+                if len(self.cache) > self.maxsize:
+                    self.cache.popitem(last=False)
+                    self.evictions += 1
+            return result
+        return super().apply(evaluator,values).suspend(store)
+    def empty_copy(self):
+        """
+        A MemoFunction of the same definition and maxsize with an empty cache, for another session.
+        """
+        memo = MemoFunction(self.arg_expr_list,self.body,self,self.env,self.maxsize)
+        memo.body_node = self.body_node
+        return memo
+    def stats(self):
+        return {'hits':self.hits,'misses':self.misses,'evictions':self.evictions,'size':len(self.cache),'maxsize':self.maxsize}
+
+class Primitive():
+    """
+    A function implemented in python: the descriptor the primitive registry of an evaluator maps a
+    symbol to (see Evaluator.registry), and the value of its name. Calls are resolved to it when they are
+    compiled, so its name can't be defined again. strategy is how it is called: 'evaluator' as
+    function(evaluator,*values), like the op_ methods, or 'python' as function(*values), for functions given
+    to Lisp.register, whose results are converted by lisp_value. pure primitives may be run
+    on constants when code is compiled with optimize. It takes from arity to max_arity values (no
+    limit when max_arity is None), read from the signature when the primitive is made, unless given.
+    """
+    __slots__ = ('name','function','strategy','pure','arity','max_arity')
+    strategies = ('evaluator','python')
+    def __init__(self,name,function,arity=None,strategy='evaluator',pure=False):
+        if strategy not in self.strategies:
+            raise Exception(f'Unknown primitive strategy: {strategy}')
+        if not callable(function):
+            raise Exception(f'Primitive {name} must be callable')
+        self.name = name
+        self.function = function
+        self.strategy = strategy
+        self.pure = pure
+        self.arity,self.max_arity = self.signature_arity(arity)
+        if strategy == 'python':
+            self.function = PythonFunction(function)
+    def signature_arity(self,arity):
+        """
+        The least and most values the function takes, as its signature says; arity, if given, must fit it.
+        """
+        try:
+            signature = inspect.signature(self.function)
+        except (TypeError,ValueError):
+            if arity is None:
+                raise Exception(f'Cannot read the signature of {self.name}: give its arity') from None
+            return arity,arity
+        parameters = list(signature.parameters.values())
+        if self.strategy == 'evaluator':
+            if not parameters or parameters[0].kind not in (inspect.Parameter.POSITIONAL_ONLY,inspect.Parameter.POSITIONAL_OR_KEYWORD,inspect.Parameter.VAR_POSITIONAL):
+                raise Exception(f'Primitive {self.name} must take the evaluator first')
+            if parameters[0].kind != inspect.Parameter.VAR_POSITIONAL:
+                parameters = parameters[1:]
+        least,most = 0,0
+        for parameter in parameters:
+            if parameter.kind == inspect.Parameter.VAR_POSITIONAL:
+                most = None
+            elif parameter.kind == inspect.Parameter.KEYWORD_ONLY:
+                if parameter.default is inspect.Parameter.empty:
+                    raise Exception(f'Primitive {self.name} has a required keyword-only argument {parameter.name}')
+            elif parameter.kind != inspect.Parameter.VAR_KEYWORD:
+                if parameter.default is inspect.Parameter.empty:
+                    least += 1
+                if most is not None:
+                    most += 1
+        if arity is None:
+            return least,most
+        if arity < least or (most is not None and arity > most):
+            raise Exception(f'{self.name} cannot take {arity} arguments')
+        return arity,arity
+    @property
+    def variadic(self):
+        return self.max_arity is None
+    def accepts(self,count):
+        return self.arity <= count and (self.max_arity is None or count <= self.max_arity)
+    def arity_error(self,count):
+        return arity_error(self.name,self.arity,self.max_arity,count)
+    def apply(self,evaluator,values):
+        if not self.accepts(len(values)):
+            raise self.arity_error(len(values))
+        if self.strategy == 'python':
+            return self.function(*values)
+        return self.function(evaluator,*values)
+    def is_atomic(self):
+        return True
+    @property
+    def expr(self):
+        return f'#<primitive {self.name}>'
+    def __repr__(self):
+        return f'Primitive({repr(self.name)})'
+
+class PythonFunction():
+    """
+    A function given to Lisp.register, returning lisp values. It pickles as the function does, so map_eval
+    workers can have it.
+    """
+    __slots__ = ('function',)
+    def __init__(self,function):
+        self.function = function
+    def __call__(self,*values):
+        return lisp_value(self.function(*values))
+
+def lisp_value(value):
+    """
+    A value returned by python as lisp sees it: True and False are #t and #f, None is (), and lists and
+    tuples are lists of the lisp values of their items.
+    """
+    if value is True:
+        return TRUE
+    elif value is False:
+        return FALSE
+    elif value is None:
+        return NIL
+    elif isinstance(value,(list,tuple)):
+        return Pair.from_iterable([lisp_value(item) for item in value])
+    return value
+
+class Macro():
+    """
+    Defined by defmacro: function takes the unevaluated argument forms of a call, as data, and returns the
+    form the call is replaced with. Calls are expanded when they are compiled, see Evaluator.expand.
+    """
+    __slots__ = ('name','function')
+    def __init__(self,name,function):
+        self.name = name
+        self.function = function
+    def expand(self,evaluator,args):
+        return evaluator.call(self.function,[as_data(arg) for arg in args])
+    def is_atomic(self):
+        return True
+    @property
+    def expr(self):
+        return self.function.expr
+    def __repr__(self):
+        return f'Macro({repr(self.name)})'
+
+#around the keys of the items of a list in a structure_key; no atom key is a tuple that starts with Pair
+LIST_OPEN,LIST_CLOSE = (Pair,'('),(Pair,')')
+
+def structure_key(value,atom_key):
+    """
+    A hashable key for the structure of a value: a list is keyed by the keys of its items between LIST_OPEN
+    and LIST_CLOSE and a vector by (Vector, keys of its items), with atom_key(value) for anything else. The
+    key is one flat tuple built with a work stack, so lists nested deeper than the recursion limit can be
+    keyed, and the key hashed and compared.
+    """
+    if isinstance(value,Quoted):
+        value = value.as_list()
+    if not isinstance(value,Pair):
+        return (Vector,tuple([atom_key(item) for item in value])) if isinstance(value,Vector) else atom_key(value)
+    key = [LIST_OPEN]
+    stack = [iter(value)]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item,Quoted):
+                item = item.as_list()
+            if isinstance(item,Pair):
+                key.append(LIST_OPEN)
+                stack.append(iter(item))
+                break
+            key.append((Vector,tuple([atom_key(x) for x in item])) if isinstance(item,Vector) else atom_key(item))
+        else:
+            stack.pop()
+            key.append(LIST_CLOSE)
+    return tuple(key)
+
+def memo_atom_key(value):
+    return (type(value),value) if type(value) in number_types else value
+
+def memo_key(value):
+    """
+    A hashable key for an argument of a memoized function. Numbers of different types get different keys:
+    eq finds 1 and 1.0 equal, but a function can tell them apart, as / does. Functions are keyed by identity.
+
+    >>> lisp = Lisp()
+    >>> deep = NIL
+    >>> for _ in range(5000):
+    ...     deep = Pair(deep,NIL)
+    >>> lisp.evaluator['deep'] = deep
+    >>> lisp("(defun-memo id (x) 'ok) (id deep) (id deep) (id '((1))) (id '((1.0)))")[1:]
+    [Atom('ok'), Atom('ok'), Atom('ok'), Atom('ok')]
+    >>> lisp.evaluator['id'].stats()['hits'],memo_key(deep) == memo_key(Pair(deep.car,NIL))
+    (1, True)
+    """
+    if type(value) in number_types:
+        return (type(value),value)
+    return structure_key(value,memo_atom_key)
+
+def eq_atom_key(value):
+    return value
+
+def eq_key(value):
+    """
+    A hashable key that is equal for values that eq considers equal, for tables and the assoc index.
+
+    >>> lisp = Lisp(indexed_assoc=True)
+    >>> deep = NIL
+    >>> for _ in range(5000):
+    ...     deep = Pair(deep,NIL)
+    >>> lisp.evaluator['deep'],lisp.evaluator['copy'] = deep,Pair(deep.car,NIL)
+    >>> lisp("(setq t (make-table)) (table-put t deep 1) (table-get t copy)")[2:]
+    [1]
+    >>> lisp("(setq env (zip '(a b c d e f g h i j) '(1 2 3 4 5 6 7 8 9 10))) (assoc copy (concat env (list (list deep 'found))))")[1:]
+    [Atom('found')]
+    """
+    if type(value) is Symbol:
+        return value
+    return structure_key(value,eq_atom_key)
+
+def mutates(form):
+    """
+    Whether a form, outside of quoted data, contains a setq, defun or table-put.
+    """
+    forms = [form]
+    while forms:
+        form = forms.pop()
+        if isinstance(form,(List,Pair)) and not isinstance(form,Function) and not form.is_atomic():
+            operator_name = symbol_name(next(iter(form)))
+            if operator_name in ('setq','defun','defun-memo','defmacro','table-put'):
+                return True
+            elif operator_name != 'quote':
+                forms.extend(form)
+    return False
+
+def label_lambda(func_list):
+    """
+    The argument list and body of a (lambda (args) body) form given to label, or None for any other form,
+    so the function can be created under the label's name.
+    """
+    if isinstance(func_list,(List,Pair)) and not func_list.is_atomic() and symbol_name(next(iter(func_list))) == 'lambda':
+        return list(func_list)[1:]
+    return None
+
+class Frame():
+    """
+    Runtime lexical environment: one slot per argument of the function call, linked to the
+    frame the function was defined in. Global variables live in Evaluator.variables, not in frames.
+    The frames of an Image hold their slots in a tuple, so setq cannot change them.
+
+    A closure sees the frame it was made in, not the frame of its caller, and setq writes to the frame
+    that binds the variable, which the closures made in that frame share:
+
+    >>> for backend in ('tree','vm'):
+    ...     Lisp(backend=backend)('''
+    ...     (defun adder (n) (lambda (x) (+ x n)))
+    ...     (list ((adder 1) 10) ((adder 5) 10))
+    ...     (setq x 'global)
+    ...     (defun getx () x)
+    ...     ((lambda (x) (getx)) 'caller)
+    ...     (defun counter (n) ((lambda (inc get) (list (inc) (inc) (get))) (lambda () (setq n (+ n 1))) (lambda () n)))
+    ...     (setq n 'global)
+    ...     (list (counter 10) n)
+    ...     ''')[1::3]
+    [List('(11 15)'), Atom('global'), List('((11 12 12) global)')]
+    [List('(11 15)'), Atom('global'), List('((11 12 12) global)')]
+    """
+    __slots__ = ('slots','parent')
+    def __init__(self,slots,parent=None):
+        self.slots = slots
+        self.parent = parent
+
+class Scope():
+    """
+    Compile time mirror of Frame: the variable names of each enclosing function, innermost first.
+    """
+    __slots__ = ('names','parent')
+    def __init__(self,names,parent=None):
+        self.names = names
+        self.parent = parent
+    def resolve(self,variable_name):
+        depth = 0
+        scope = self
+        while scope is not None:
+            if variable_name in scope.names:
+                return depth,scope.names.index(variable_name)
+            scope = scope.parent
+            depth += 1
+        return None
+
+class Globals(dict):
+    """
+    The global variables of a session: a dict of the session's own defuns and setqs over the frozen
+    globals of an Image, which other sessions share. Reads fall through to the image, writes stay here.
+    """
+    __slots__ = ('base',)
+    def __init__(self,base):
+        super().__init__()
+        self.base = base
+    def __missing__(self,name):
+        return self.base[name]
+    def __contains__(self,name):
+        return dict.__contains__(self,name) or name in self.base
+    def get(self,name,default=None):
+        if dict.__contains__(self,name):
+            return dict.__getitem__(self,name)
+        return self.base.get(name,default)
+    def keys(self):
+        return dict.keys(self) | self.base.keys()
+    def __iter__(self):
+        return iter(self.keys())
+    def __len__(self):
+        return len(self.keys())
+    def items(self):
+        return [(name,self[name]) for name in self.keys()]
+    def values(self):
+        return [self[name] for name in self.keys()]
+
+class Image():
+    """
+    Frozen global variables shared by reference by any number of sessions, each a Lisp with its own
+    Globals overlay and evaluator, so threads can evaluate in their own sessions at once.
+    Freezing copies the closures among the globals with frames whose slots are tuples, so nothing a
+    session can reach through the image can be changed: defun and setq of globals go to the session's
+    overlay, and setq of a variable a frozen closure captured raises. Memoized functions keep per-call
+    caches, so each session gets its own empty copy of them, wherever they are held. Streams and promises
+    change in place when they are forced, so an image cannot hold them.
+
+    >>> image = Lisp().freeze()
+    >>> def worker(name,results):
+    ...     session = image.session()
+    ...     results[name] = session(f"(defun who () '{name}) (setq mine (cons (who) '())) (concat mine '(shared))")[-1]
+    >>> results = {}
+    >>> threads = [threading.Thread(target=worker,args=(name,results)) for name in ('a','b','c')]
+    >>> for thread in threads: thread.start()
+    >>> for thread in threads: thread.join()
+    >>> sorted([value_expr(value) for value in results.values()])
+    ['(a shared)', '(b shared)', '(c shared)']
+    >>> 'who' in image.variables
+    False
+    >>> counter = Lisp()
+    >>> counter("(setq count ((lambda (n) (lambda () (setq n (cons 'i n)))) '()))")[0].expr
+    "(lambda () (setq n (cons 'i n)))"
+    >>> counter('(count)')
+    [List('(i)')]
+    >>> counter.session()('(count)')
+    Traceback (most recent call last):
+    ...
+    Exception: Cannot setq n: it is bound in a frozen Image
+    >>> memo = Lisp()
+    >>> memo("(defun-memo sq (x) (* x x)) (setq holder ((lambda (m) (lambda (x) (m x))) sq))")[0]
+    MemoFunction('(defun-memo sq (x) (* x x))')
+    >>> image = memo.freeze()
+    >>> held = image.variables['holder'].env.slots[0]
+    >>> def worker(n,results):
+    ...     session = image.session()
+    ...     results[n] = session(f'(holder {n}) (holder {n})'),session.evaluator.memo_copies[held].stats()['hits']
+    >>> results = {}
+    >>> threads = [threading.Thread(target=worker,args=(n,results)) for n in range(4)]
+    >>> for thread in threads: thread.start()
+    >>> for thread in threads: thread.join()
+    >>> [results[n] for n in range(4)],held.stats()['size'],held is memo.evaluator.variables['sq']
+    ([([0, 0], 1), ([1, 1], 1), ([4, 4], 1), ([9, 9], 1)], 0, False)
+    >>> memo.evaluator['numbers'] = Stream.from_iterable(range(10))
+    >>> memo.freeze()
+    Traceback (most recent call last):
+    ...
+    Exception: Cannot freeze numbers: a stream or promise is changed when it is forced, so sessions cannot share it
+    """
+    def __init__(self,variables,options):
+        frames = {}
+        frozen = {}
+        for name,value in dict(variables).items():
+            try:
+                frozen[name] = freeze_value(value,frames)
+            except Unfreezable:
+                raise Exception(f'Cannot freeze {name}: a stream or promise is changed when it is forced, so sessions cannot share it') from None
+        self.variables = types.MappingProxyType(frozen)
+        self.options = dict(options)
+        self.memo_names = [name for name,value in self.variables.items() if isinstance(value,MemoFunction)]
+    def globals(self):
+        variables = Globals(self.variables)
+        for name in self.memo_names:
+            variables[name] = self.variables[name].empty_copy()
+        return variables
+    def session(self):
+        return Lisp(image=self)
+
+class Unfreezable(Exception):
+    """
+    Raised by freeze_value for a value that can't be shared between sessions.
+    """
+
+def freeze_value(value,frames):
+    """
+    value, or for a closure a copy of it whose frames are frozen, for a memoized function a frozen copy that
+    fills a cache per evaluator, or for a table a frozen copy. frames maps the id of each frame, table or
+    memoized function already frozen to its copy, so frames shared between closures, or holding the closure
+    that captured them as label frames do, are copied once. Streams and promises raise Unfreezable.
+    """
+    if type(value) in (Stream,Promise):
+        raise Unfreezable()
+    if isinstance(value,MemoFunction):
+        if id(value) not in frames:
+            frozen = frames[id(value)] = value.empty_copy()
+            frozen.env = freeze_frame(value.env,frames)
+            frozen.frozen = True
+        return frames[id(value)]
+    if isinstance(value,Macro):
+        function = freeze_value(value.function,frames)
+        return value if function is value.function else Macro(value.name,function)
+    if isinstance(value,Table):
+        if not value.frozen and id(value) not in frames:
+            frames[id(value)] = Table(value.merged(),True)
+        return frames.get(id(value),value)
+    if not isinstance(value,Function) or value.env is None:
+        return value
+    frozen = copy.copy(value)
+    frozen.env = freeze_frame(value.env,frames)
+    return frozen
+
+def freeze_frame(frame,frames):
+    if frame is None:
+        return None
+    if id(frame) not in frames:
+        frozen = frames[id(frame)] = Frame(None)
+        frozen.parent = freeze_frame(frame.parent,frames)
+        frozen.slots = tuple([freeze_value(value,frames) for value in frame.slots])
+    return frames[id(frame)]
+
+class TailCall():
+    """
+    Returned by a compiled node instead of a value when a function body still has to run.
+    Nodes that were waiting on the value attach a resume frame and pass the TailCall up, so
+    Evaluator.execute can run the body from its own loop with an explicit continuation stack.
+    """
+    __slots__ = ('node','env','frames')
+    def __init__(self,node,env):
+        self.node = node
+        self.env = env
+        self.frames = None
+    def suspend(self,frame):
+        if self.frames is None:
+            self.frames = [frame]
+        else:
+            self.frames.append(frame)
+        return self
+
+class BudgetExceeded(Exception):
+    """
+    Raised when an evaluation passes a limit of its Budget. limit is 'steps', 'seconds' or 'conses',
+    stats the counts when it stopped (see Budget.stats).
+    """
+    def __init__(self,limit,budget):
+        self.limit = limit
+        self.stats = budget.stats()
+        super().__init__(f'Evaluation exceeded its budget of {getattr(budget,"max_"+limit)} {limit} '
+            f'(steps={self.stats["steps"]}, conses={self.stats["conses"]}, seconds={self.stats["seconds"]:.3f})')
+
+class Budget():
+    """
+    Limits on one evaluation, see Lisp.__call__: steps counts function bodies run, promises forced (and
+    iterations of the native eval), conses the list and stream cells built by cons, list, the prelude and stream
+    functions, seconds the wall clock time since start. The clock is read every 256 counts, so it costs little to leave a budget on.
+
+    >>> lisp = Lisp()
+    >>> for source,limits in [("(defun loop (x) (loop x)) (loop 'a)",{'steps':1000}),
+    ...         ("(defun grow (x) (grow (cons 'a x))) (grow '())",{'conses':500}),
+    ...         ("(defun loop (x) (loop x)) (loop 'a)",{'seconds':0.05})]:
+    ...     try:
+    ...         lisp(source,**limits)
+    ...     except BudgetExceeded as e:
+    ...         print(e.limit,e.stats['steps'] if e.limit == 'steps' else e.stats['conses'] if e.limit == 'conses' else e.stats['seconds'] >= 0.05)
+    steps 1001
+    conses 501
+    seconds True
+    >>> lisp("(concat '(a b) '(c))",steps=10,conses=10)
+    [List('(a b c)')]
+    >>> lisp.budget.conses
+    2
+    >>> for limits in [{'steps':100},{'conses':100}]:
+    ...     lisp.evaluator['numbers'] = Stream.from_iterable(range(10**9))
+    ...     try:
+    ...         lisp('(to-list numbers)',**limits)
+    ...     except BudgetExceeded as e:
+    ...         print(e.limit)
+    steps
+    conses
+    """
+    __slots__ = ('max_steps','max_seconds','max_conses','steps','conses','started','deadline','ticks')
+    clock_interval = 256
+    def __init__(self,steps=None,seconds=None,conses=None):
+        self.max_steps = math.inf if steps is None else steps
+        self.max_seconds = math.inf if seconds is None else seconds
+        self.max_conses = math.inf if conses is None else conses
+        self.start()
+    def start(self):
+        self.steps = 0
+        self.conses = 0
+        self.started = time.monotonic()
+        self.deadline = self.started+self.max_seconds
+        self.ticks = self.clock_interval
+        return self
+    def step(self):
+        self.steps += 1
+        if self.steps > self.max_steps:
+            raise BudgetExceeded('steps',self)
+        self.ticks -= 1
+        if self.ticks <= 0:
+            self.check_clock()
+    def allocate(self,count):
+        self.conses += count
+        if self.conses > self.max_conses:
+            raise BudgetExceeded('conses',self)
+        self.ticks -= count
+        if self.ticks <= 0:
+            self.check_clock()
+    def check_clock(self):
+        self.ticks = self.clock_interval
+        if time.monotonic() > self.deadline:
+            raise BudgetExceeded('seconds',self)
+    def stats(self):
+        return {'steps':self.steps,'conses':self.conses,'seconds':time.monotonic()-self.started}
+
+class Evaluator():
+    constants = {
+        '#t':TRUE,
+        '#f':FALSE,
+            }
+    cxr_pattern = re.compile('^c[ad]{2,4}r$')
+    #the Profiler of a ProfilingEvaluator
+    profiler = None
+    #the Budget of the running Lisp call, if it has limits
+    budget = None
+    #the AlistIndex of assoc under Lisp(indexed_assoc=True)
+    alist_index = None
+    #with optimize, constants are folded, unreachable cond clauses dropped and small functions inlined, see inline
+    optimize = False
+    #the python functions of the primitives that are pure, so the optimizer may run them on constants when compiling
+    foldable = frozenset(['op_car','op_cdr','op_cons','op_eq','op_atom','op_list','op_add','op_sub','op_mul','op_div',
+        'op_lt','op_gt','op_le','op_ge','op_num_eq','op_length','native_null','native_and','native_or','native_not'])
+    #the most nodes the body of a function can have to be inlined
+    inline_size = 24
+    #op_ method names of primitives whose names are not python identifiers
+    operator_methods = {'+':'add','-':'sub','*':'mul','/':'div','<':'lt','>':'gt','<=':'le','>=':'ge','=':'num_eq'}
+    def __init__(self,variables=None):
+        if variables is None:
+            variables = {}
+        self.variables = variables
+        self.variables.update(self.constants)
+        #counts defun and setq, so memoized functions know when their cached results may be stale
+        self.generation = 0
+        #names of the functions whose bodies are being inlined, see inline_body
+        self.inlining = []
+        #the primitive registry, shared with the class until register adds to it
+        self.primitives = type(self).registry()
+        #this evaluator's copy of each frozen MemoFunction it called, see MemoFunction.apply
+        self.memo_copies = {}
+    def __getitem__(self,variable_name):
+        value = read_literal(variable_name)
+        if value is not not_literal:
+            return value
+        if variable_name in self.variables:
+            return self.variables[variable_name]
+        else:
+            raise Exception(f'Unbound variable: {variable_name}')
+    def __setitem__(self,variable_name,value):
+        self.definable(variable_name)
+        if not isinstance(value,(ParseNode,Pair,Quoted,Symbol,Primitive,Macro,Vector,Table,Promise,Stream,str)+number_types):
+            raise Exception('Variables must map to expressions')
+        else:
+            self.variables[variable_name] = value
+    def trace(self,parsed_list,env):
+        if logger.level > logarhythm.DEBUG+5:
+            return
+        logger.log(logarhythm.DEBUG+5,'Eval trace: ' + repr(parsed_list))
+
+
+    def __call__(self,parsed_list,env=None):
+        """
+        Variable scoping is lexical:
+            global: Evaluator.variables, looked up by name when the form runs
+            local: the arguments of each enclosing lambda/defun and label names, resolved to a
+                (depth,index) slot of a Frame when the form is compiled
+        A function captures the frame it is defined in, so the cost of a call does not depend on
+        how deeply calls are nested.
+        """
+        self.trace(parsed_list,env)
+        return self.execute(self.compile(parsed_list),env)
+
+    def execute(self,node,env):
+        """
+        Run a compiled node to a value.
+        Function bodies are run by this loop rather than by the calling node, so calls in tail position
+        (function bodies and cond clauses) don't grow any stack, and the frames of pending non-tail calls
+        live on a python list instead of the interpreter stack, so recursion is only limited by memory.
+
+        >>> for backend in ('tree','vm'):
+        ...     Lisp(backend=backend,native_prelude=False)('''
+        ...     (defun count (n) (cond ((eq n 0) 0) ('#t (+ 1 (count (- n 1))))))
+        ...     (defun upto (n acc) (cond ((eq n 0) acc) ('#t (upto (- n 1) (cons n acc)))))
+        ...     (count 30000)
+        ...     (length (concat (upto 30000 '()) '(a)))
+        ...     ''')[2:]
+        [30000, 30001]
+        [30000, 30001]
+        """
+        stack = []
+        budget = self.budget
+        value = node(self,env)
+        while True:
+            if type(value) is TailCall:
+                if budget is not None:
+                    budget.step()
+                if value.frames is not None:
+                    stack.extend(reversed(value.frames))
+                value = value.node(self,value.env)
+            elif stack:
+                value = stack.pop()(value)
+            else:
+                return value
+
+    def compile(self,parsed,scope=None):
+        """
+        Analyze a form once into a closure called as closure(evaluator,env).
+        Special forms, primitives and variable references are resolved here instead of on every evaluation.
+        The closure is cached on parse nodes, so a function body is only analyzed the first time it runs.
+        A parse node always sits in the same lexical scope, so the scope does not need to be part of the key;
+        the optimize flag is, since it changes the closure.
+        """
+        if isinstance(parsed,ParseNode):
+            compiled = parsed.compiled
+            if compiled is not None and compiled[0] is type(self) and compiled[1] is self.optimize:
+                return compiled[2]
+            node = self.analyze(parsed,scope)
+            parsed.compiled = (type(self),self.optimize,node)
+            return node
+        return self.analyze(parsed,scope)
+
+    def analyze(self,parsed,scope):
+        if isinstance(parsed,Function):
+            def function_value(evaluator,env):
+                raise Exception('Functions don\'t have a direct value')
+            return function_value
+        elif isinstance(parsed,(List,Pair)):
+            if parsed.is_atomic():
+                raise Exception('Cannot evaluate an empty list')
+            return self.analyze_call(parsed,scope)
+        elif isinstance(parsed,Quasiquote):
+            return self.analyze_call(parsed.as_value(),scope)
+        elif symbol_name(parsed) is not None:
+            return self.analyze_variable(symbol_name(parsed),scope)
+        elif isinstance(parsed,(Quote,Quoted,Literal)):
+            return self.constant(self.intern(parsed(self)))
+        else:
+            return self.constant(parsed)
+
+    def constant(self,value):
+        """
+        A node that returns value, marked with it so that optimizations can see the value, see constant_value.
+        """
+        node = lambda evaluator,env: value
+        node.constant = value
+        return node
+
+    def analyze_variable(self,variable_name,scope):
+        slot = scope.resolve(variable_name) if scope is not None else None
+        if slot is not None:
+            return self.analyze_slot(*slot)
+        #the name of a primitive is the primitive as a function value, as in (map + xs ys), as it is in a call
+        primitive = self.primitive(variable_name)
+        if primitive is not None:
+            return self.constant(primitive)
+        def global_reference(evaluator,env):
+            if variable_name in evaluator.variables:
+                return evaluator.variables[variable_name]
+            raise Exception(f'Unbound variable: {variable_name}')
+        return global_reference
+
+    @classmethod
+    def registry(cls):
+        """
+        The primitive registry of this evaluator class, built once: a Primitive for each op_ method, keyed by
+        the interned Symbol of its lisp name (its operator_methods operator, or its name with - for _).
+        Calls to a primitive are resolved to its Primitive when they are compiled, see analyze_registered.
+        """
+        registry = cls.__dict__.get('primitive_registry')
+        if registry is None:
+            operators = {method:operator for operator,method in cls.operator_methods.items()}
+            registry = {}
+            for attribute in dir(cls):
+                if attribute.startswith('op_'):
+                    name = operators.get(attribute[3:],attribute[3:].replace('_','-'))
+                    function = getattr(cls,attribute)
+                    registry[Symbol(name)] = Primitive(name,function,pure=function.__name__ in cls.foldable)
+            cls.primitive_registry = registry
+        return registry
+
+    def register(self,primitive):
+        """
+        Add a Primitive to the registry of this evaluator, for the code compiled from now on.
+        """
+        if getattr(self,'compile_'+primitive.name.replace('-','_'),None) is not None:
+            raise Exception(f'{primitive.name} is a special form')
+        if primitive.name in self.variables:
+            raise Exception(f'Cannot register {primitive.name}: a global of that name is defined')
+        self.primitives = dict(self.primitives)
+        self.primitives[Symbol(primitive.name)] = primitive
+
+    def primitive(self,operator_name):
+        return self.primitives.get(Symbol(operator_name))
+
+    def definable(self,name):
+        """
+        Raise if name is a primitive: calls to it are resolved to the primitive when they are compiled, so a
+        global of that name would be seen by some uses of the name and not others.
+
+        >>> lisp = Lisp()
+        >>> lisp.register('mine',lambda x: 'python')
+        Primitive('mine')
+        >>> lisp("(defun mine (x) 'lisp)")
+        Traceback (most recent call last):
+        ...
+        Exception: Cannot define mine: it is a primitive
+        >>> lisp("(setq car 1)")
+        Traceback (most recent call last):
+        ...
+        Exception: Cannot define car: it is a primitive
+        >>> lisp("(mine 1) (map mine '(1))")
+        ['python', List('("python")')]
+        """
+        if self.primitive(name) is not None:
+            raise Exception(f'Cannot define {name}: it is a primitive')
+
+    def analyze_slot(self,depth,index):
+        if depth == 0:
+            return lambda evaluator,env: env.slots[index]
+        elif depth == 1:
+            return lambda evaluator,env: env.parent.slots[index]
+        def slot_reference(evaluator,env):
+            for _ in range(depth):
+                env = env.parent
+            return env.slots[index]
+        return slot_reference
+
+    def analyze_call(self,parsed_list,scope,guarded=False):
+        """
+        guarded is true when the call is compiled again by the node of analyze_guarded, which already checks its binding.
+        """
+        operator,*args = parsed_list
+        def apply_operator(evaluator,env,values):
+            return evaluator.apply(evaluator.as_function(values[0]),values[1:])
+        operator_name = symbol_name(operator)
+        if operator_name is None:
+            return self.analyze_sequence([self.compile(operator,scope)]+[self.compile(arg,scope) for arg in args],apply_operator)
+
+        special_form = getattr(self,'compile_'+operator_name.replace('-','_'),None)
+        if special_form is not None:
+            self.check_special_form(operator_name,special_form,args)
+            return special_form(parsed_list,scope,*args)
+        macro = self.macro(operator_name,scope)
+        if macro is not None:
+            node = self.compile(self.expand(parsed_list,macro),scope)
+            return node if guarded else self.analyze_guarded(parsed_list,scope,operator_name,macro,node)
+        arg_nodes = [self.compile(arg,scope) for arg in args]
+        primitive = self.primitive(operator_name)
+        if primitive is not None:
+            return self.analyze_registered(primitive,arg_nodes)
+        if scope is not None and scope.resolve(operator_name) is not None:
+            return self.analyze_sequence([self.analyze_variable(operator_name,scope)]+arg_nodes,apply_operator)
+        if self.optimize:
+            bound = self.variables.get(operator_name)
+            node = self.inline(parsed_list,scope,operator_name,bound,arg_nodes)
+            if node is not None:
+                return node if guarded else self.analyze_guarded(parsed_list,scope,operator_name,bound,node)
+
+        if self.cxr_pattern.search(operator_name) is not None:
+            cxr = operator_name[-2:0:-1]
+        else:
+            cxr = None
+        def apply_global(evaluator,env,values):
+            if operator_name in evaluator.variables:
+                return evaluator.apply(evaluator.as_function(evaluator.variables[operator_name]),values)
+            elif cxr is not None:
+                if len(values) != 1:
+                    raise Exception("car/cdr variants require a single list argument")
+                return evaluator.cxr(operator_name,cxr,values[0])
+            raise Exception('Unbounded variable name: %s' % operator_name)
+        return self.analyze_sequence(arg_nodes,apply_global)
+
+    def macro(self,operator_name,scope):
+        """
+        The Macro a call to operator_name expands with: a global macro that no local variable shadows.
+        """
+        macro = self.variables.get(operator_name)
+        if type(macro) is Macro and (scope is None or scope.resolve(operator_name) is None):
+            return macro
+        return None
+
+    def expand(self,parsed_list,macro):
+        """
+        The expansion of a call to macro. It is cached on the call's List node with the macro that made it,
+        so a macro runs once per call site until it is redefined.
+
+        >>> Lisp()('''
+        ... (setq expanded '())
+        ... (defmacro twice (x) (cond ((setq expanded (cons x expanded)) `(list ,x ,x))))
+        ... (defun f (y) (twice y))
+        ... (f 'a)
+        ... (f 'b)
+        ... expanded
+        ... (defmacro twice (x) `(list ,x))
+        ... (f 'c)
+        ... ''')[3:]
+        [List('(a a)'), List('(b b)'), List('(y)'), Macro('twice'), List('(c)')]
+        """
+        expansion = parsed_list.expansion if isinstance(parsed_list,List) else None
+        if expansion is not None and expansion[0] is macro:
+            return expansion[1]
+        form = macro.expand(self,list(parsed_list)[1:])
+        if isinstance(parsed_list,List):
+            parsed_list.expansion = (macro,form)
+        return form
+
+    def analyze_guarded(self,parsed_list,scope,operator_name,bound,node):
+        """
+        Run node, the code of a call compiled for the value bound to the global operator_name: the expansion
+        of a macro, or when optimizing, the body of an inlined function. Each run checks that the name is still
+        bound to the same value; if a defmacro, defun or setq changed it, the call is compiled again.
+        """
+        state = [(bound,node)]
+        def guarded(evaluator,env):
+            bound,node = state[0]
+            current = evaluator.variables.get(operator_name)
+            if current is not bound:
+                node = evaluator.analyze_call(parsed_list,scope,True)
+                state[0] = (current,node)
+            return node(evaluator,env)
+        return guarded
+
+    def inline(self,parsed_list,scope,operator_name,bound,arg_nodes):
+        """
+        When optimizing, a node for a call to the global operator_name, bound to bound (None when unbound),
+        that does not make the call; None when there is none.
+        An unbound c[ad]+r name, or a foldable primitive such as the native null, on constants is folded.
+        A Function that inline_body accepts is replaced by its body, see inline_call.
+
+        >>> source = "(setq xs '()) (defun both-null (x y) (and (null x) (null y))) (both-null xs '())"
+        >>> plain,optimized = Lisp(native_prelude=False),Lisp(native_prelude=False,optimize=True)
+        >>> plain(source,steps=100)[2],plain.budget.steps,optimized(source,steps=100)[2],optimized.budget.steps
+        (Atom('#t'), 4, Atom('#t'), 0)
+        >>> optimized('''
+        ... (defun null (x) (eq x 'nil))
+        ... (both-null xs '())
+        ... (setq null (lambda (x) '#t))
+        ... (both-null 'a 'b)
+        ... ''')[1::2]
+        [Atom('#f'), Atom('#t')]
+        >>> print(Lisp(backend='vm',optimize=True).disassemble("(cond ((atom '(a)) 'x) ((cadr '(a b)) (car '(y))))"))
+        <form>:
+           0 GUARD            cadr
+           1 CONST            b
+           2 JUMP_IF_FALSE    5
+           3 CONST            y
+           4 RETURN
+           5 CONST            ()
+           6 RETURN
+        """
+        function = self.folder(operator_name,bound)
+        if function is not None:
+            return self.fold(function,arg_nodes)
+        plan = self.inline_plan(operator_name,bound,list(parsed_list)[1:],scope,lambda: [constant_value(node) for node in arg_nodes])
+        if plan is None:
+            return None
+        body,kept,body_scope = plan
+        body_node = self.while_inlining(operator_name,lambda: self.compile(body,body_scope))
+        if not kept:
+            return body_node
+        return self.analyze_sequence([arg_nodes[index] for index in kept],lambda evaluator,env,values: body_node(evaluator,Frame(values,env)))
+
+    #what the optimizer decides about a call is the same for both backends: these methods decide it, and
+    #inline here and VMEvaluator.emit_inline only turn the decision into closures or into instructions
+    def folder(self,operator_name,bound):
+        """
+        The function(evaluator,*values) that a call to the global operator_name, bound to bound (None when
+        unbound), is folded with when its arguments are constants: for an unbound c[ad]+r name or a pure
+        Primitive. None when the call can't be folded.
+        """
+        if bound is None and self.cxr_pattern.search(operator_name) is not None:
+            cxr = operator_name[-2:0:-1]
+            return lambda evaluator,value: evaluator.cxr(operator_name,cxr,value)
+        elif type(bound) is Primitive and bound.pure:
+            return lambda evaluator,*values: bound.apply(evaluator,values)
+        return None
+
+    def fold_value(self,function,constants):
+        """
+        function(evaluator,*constants) computed now; not_constant when one of the constants is not_constant,
+        or when the call raises, so that the error happens when the call runs.
+        """
+        if any(value is not_constant for value in constants):
+            return not_constant
+        try:
+            return function(self,*constants)
+        except Exception:
+            return not_constant
+
+    def inline_plan(self,operator_name,bound,args,scope,constants):
+        """
+        How a call to the global operator_name, bound to bound, with the argument forms args is inlined:
+        (body,kept,body_scope), where body is the data to compile in body_scope, which is scope with a frame for
+        the arguments of the indexes kept, if any (see inline_call). None when it can't be. constants() gives
+        the values of the arguments that are constants; it is only called once the call is known to be inlined.
+
+        >>> evaluator = Lisp(optimize=True).evaluator
+        >>> evaluator.execute(evaluator.compile(next(iter_forms("(defun sq (x) (* x x))"))),None)
+        Function('(defun sq (x) (* x x))')
+        >>> [plan[:2] for plan in (evaluator.inline_plan('sq',evaluator.variables['sq'],[Atom('y')],None,lambda: [value]) for value in (not_constant,3))]
+        [(List('(* x x)'), [0]), (List("(* '3 '3)"), [])]
+        """
+        body = self.inline_body(operator_name,bound,len(args),scope)
+        if body is None:
+            return None
+        body,kept = self.inline_call(bound,body,args,constants(),scope)
+        return body,kept,(Scope([bound.arg_expr_list[index] for index in kept],scope) if kept else scope)
+
+    def while_inlining(self,operator_name,compile_body):
+        #a function is not inlined into its own inlined body
+        self.inlining.append(operator_name)
+        try:
+            return compile_body()
+        finally:
+            self.inlining.pop()
+
+    def inline_body(self,operator_name,function,count,scope):
+        """
+        The body of function as data, if a call to it with count arguments can be replaced by it: a plain
+        defun or lambda (no closure, not memoized) whose body has at most inline_size nodes, uses no special
+        form but cond and quote, calls no macro, does not name operator_name (so it is not recursive), and
+        names no global that a local variable of scope shadows. Functions being inlined are not inlined again.
+        """
+        if (type(function) is not Function or function.env is not None or len(function.arg_expr_list) != count
+                or operator_name in self.inlining):
+            return None
+        body = as_data(function.body)
+        size = 0
+        pending = [body]
+        while pending:
+            form = pending.pop()
+            size += 1
+            if size > self.inline_size:
+                return None
+            name = symbol_name(form)
+            if name is not None:
+                if name == operator_name or (name not in function.arg_expr_list and scope is not None and scope.resolve(name) is not None):
+                    return None
+            elif isinstance(form,Pair) and form is not NIL:
+                head = symbol_name(form.car)
+                if head == 'quote':
+                    continue
+                if head is not None and head != 'cond' and (getattr(self,'compile_'+head.replace('-','_'),None) is not None
+                        or type(self.variables.get(head)) is Macro):
+                    return None
+                pending.extend(form)
+        return body
+
+    def inline_call(self,function,body,args,constants,scope):
+        """
+        The body of an inlined call to function, and the indexes of the arguments it still binds in a frame of
+        their own. constants are the values of the arguments that are constants, or not_constant.
+        Constants are substituted into the body, so the optimizations see them; so are local variables when
+        every argument is one or a constant, leaving no frame. The other arguments are evaluated in order
+        before the body, as for the call.
+        """
+        locals_only = all(value is not not_constant or (symbol_name(arg) is not None and scope is not None and scope.resolve(symbol_name(arg)) is not None)
+            for arg,value in zip(args,constants))
+        replacements = {}
+        kept = []
+        for index,(name,arg,value) in enumerate(zip(function.arg_expr_list,args,constants)):
+            if value is not not_constant:
+                replacements[name] = Quoted(value)
+            elif locals_only:
+                replacements[name] = as_data(arg)
+            else:
+                kept.append(index)
+        return substitute(body,replacements),kept
+
+    def fold(self,function,arg_nodes):
+        """
+        The constant node of function(evaluator,*values) when every argument node is a constant, computed now.
+        None otherwise, or when the call raises, so that the error happens when the call runs.
+        """
+        value = self.fold_value(function,[constant_value(node) for node in arg_nodes])
+        return None if value is not_constant else self.constant(value)
+
+    def analyze_sequence(self,nodes,finish):
+        """
+        Evaluate nodes in order, then return finish(evaluator,env,values).
+        If a node hands back a TailCall, the remaining work is attached to it as a resume frame.
+        """
+        count = len(nodes)
+        def resume(evaluator,env,values,index):
+            while index < count:
+                value = nodes[index](evaluator,env)
+                if type(value) is TailCall:
+                    def frame(result):
+                        values.append(result)
+                        return resume(evaluator,env,values,index+1)
+                    return value.suspend(frame)
+                values.append(value)
+                index += 1
+            return finish(evaluator,env,values)
+        def sequence(evaluator,env):
+            return resume(evaluator,env,[],0)
+        return sequence
+
+    def analyze_registered(self,primitive,arg_nodes):
+        """
+        A call to a Primitive of the registry, resolved when the call site is compiled: its arity is checked
+        now, and the call runs its function directly.
+        """
+        if not primitive.accepts(len(arg_nodes)):
+            return self.analyze_sequence(arg_nodes,lambda evaluator,env,values: primitive.apply(evaluator,values))
+        if self.optimize and primitive.pure:
+            node = self.fold(lambda evaluator,*values: primitive.apply(evaluator,values),arg_nodes)
+            if node is not None:
+                return node
+        function = primitive.function
+        if primitive.strategy == 'python':
+            return self.analyze_sequence(arg_nodes,lambda evaluator,env,values: function(*values))
+        return self.analyze_primitive(function,arg_nodes)
+
+    def analyze_primitive(self,primitive,arg_nodes):
+        if len(arg_nodes) == 1:
+            arg, = arg_nodes
+            def primitive1(evaluator,env):
+                value = arg(evaluator,env)
+                if type(value) is TailCall:
+                    return value.suspend(lambda result: primitive(evaluator,result))
+                return primitive(evaluator,value)
+            return primitive1
+        elif len(arg_nodes) == 2:
+            arg1,arg2 = arg_nodes
+            def second(evaluator,env,value1):
+                value2 = arg2(evaluator,env)
+                if type(value2) is TailCall:
+                    return value2.suspend(lambda result: primitive(evaluator,value1,result))
+                return primitive(evaluator,value1,value2)
+            def primitive2(evaluator,env):
+                value1 = arg1(evaluator,env)
+                if type(value1) is TailCall:
+                    return value1.suspend(lambda result: second(evaluator,env,result))
+                return second(evaluator,env,value1)
+            return primitive2
+        return self.analyze_sequence(arg_nodes,lambda evaluator,env,values: primitive(evaluator,*values))
+
+    def as_function(self,operator):
+        if isinstance(operator,(Function,Primitive)):
+            return operator
+        if isinstance(operator,Macro):
+            raise Exception(f'{operator.name} is a macro: define it before the code that calls it, and do not pass it as a function')
+        if isinstance(operator,(List,Pair)):
+            #a list used as a function is code built at runtime, so it only sees global variables
+            operator = self.execute(self.compile(operator),None)
+            if isinstance(operator,(Function,Primitive)):
+                return operator
+        raise Exception(f'Not a function: {value_expr(operator)}')
+
+    def apply(self,function,values):
+        return function.apply(self,values)
+
+    def call(self,function,values):
+        """
+        Run a function to its value, for python code such as a primitive that takes a function argument.
+        """
+        return self.execute(lambda evaluator,env: evaluator.apply(function,values),None)
+
+    def cxr(self,operator_name,operations,value):
+        for charac in operations:
+            value = self.as_pair(value,operator_name)
+            if charac == 'a':
+                if value is NIL:
+                    raise Exception(f'{operator_name} reached the car of an empty list')
+                value = value.car
+            else:
+                value = value.cdr
+        return value
+
+    #the least and most arguments of each special form, read from its compile_ method
+    special_arities = {}
+    #special forms whose first argument is the name they bind
+    binding_forms = ('setq','defun','defun-memo','defmacro','label')
+    def check_special_form(self,operator_name,special_form,args):
+        """
+        Raise a lisp error, rather than a python one from inside the compiler, for a special form called with
+        the wrong number of arguments or a name to bind that is not a symbol. The arity is read from the
+        signature of its compile_ method, whose arguments the emit_ method of the vm takes too.
+
+        >>> for source in ("(quote)","(quote a b)","(cond (x))","(cond x)","(setq 1 2)","(defun 1 (x) x)","(lambda x x)","(defun-memo f (x) x 1 2)"):
+        ...     messages = set()
+        ...     for backend in ('tree','vm'):
+        ...         try:
+        ...             Lisp(backend=backend)(source)
+        ...         except Exception as e:
+        ...             messages.add(str(e))
+        ...     print(*messages)
+        quote expects 1 arguments, got 0
+        quote expects 1 arguments, got 2
+        cond clauses must be lists of a test and a value
+        cond clauses must be lists of a test and a value
+        setq needs a symbol to bind, got 1
+        defun needs a symbol to bind, got 1
+        Function arguments must be a list of Atoms
+        defun-memo expects 3 to 4 arguments, got 5
+        """
+        arity = self.special_arities.get(operator_name)
+        if arity is None:
+            least,most = 0,0
+            for parameter in list(inspect.signature(special_form).parameters.values())[2:]:
+                if parameter.kind == inspect.Parameter.VAR_POSITIONAL:
+                    most = None
+                elif parameter.kind == inspect.Parameter.POSITIONAL_OR_KEYWORD:
+                    least += 1
+                    most += 1
+            arity = self.special_arities[operator_name] = (least,most)
+        least,most = arity
+        if operator_name == 'defun-memo':
+            #its only optional argument is the maxsize
+            most = least+1
+        if len(args) < least or (most is not None and len(args) > most):
+            raise arity_error(operator_name,least,most,len(args))
+        if operator_name in self.binding_forms and symbol_name(args[0]) is None:
+            raise Exception(f'{operator_name} needs a symbol to bind, got {value_expr(as_data(args[0]))}')
+    def cond_clauses(self,args):
+        clauses = []
+        for clause in args:
+            clause = tuple(clause) if isinstance(clause,(List,Pair)) and not isinstance(clause,Function) else ()
+            if len(clause) != 2:
+                raise Exception('cond clauses must be lists of a test and a value')
+            clauses.append(clause)
+        return clauses
+    def arg_names(self,arglist):
+        if not isinstance(arglist,(List,Pair)) or isinstance(arglist,Function):
+            raise Exception('Function arguments must be a list of Atoms')
+        arg_expr_list = []
+        for arg in arglist:
+            if symbol_name(arg) is None:
+                raise Exception('Function arguments must be Atoms')
+            arg_expr_list.append(symbol_name(arg))
+        return arg_expr_list
+
+    def compile_quote(self,parsed_list,scope,arg):
+        return self.constant(self.intern(arg.as_value()))
+    def compile_cond(self,parsed_list,scope,*args):
+        clauses = [(self.compile(p,scope),self.compile(e,scope)) for p,e in self.cond_clauses(args)]
+        if self.optimize:
+            #clauses after one whose predicate is a constant other than '#f are never reached, nor is a '#f one
+            reachable = []
+            for p,e in clauses:
+                value = constant_value(p)
+                if value is FALSE:
+                    continue
+                reachable.append((p,e))
+                if value is not not_constant:
+                    break
+            if not reachable:
+                return self.constant(NIL)
+            if constant_value(reachable[0][0]) is not not_constant:
+                return reachable[0][1]
+            clauses = reachable
+        def resume(evaluator,env,index):
+            while index < len(clauses):
+                p,e = clauses[index]
+                pval = p(evaluator,env)
+                if type(pval) is TailCall:
+                    return pval.suspend(lambda result: tested(evaluator,env,index,result))
+                if pval is not FALSE:
+                    #the clause value is in tail position, so a TailCall from it is passed straight up
+                    return e(evaluator,env)
+                index += 1
+            return NIL
+        def tested(evaluator,env,index,pval):
+            if pval is not FALSE:
+                return clauses[index][1](evaluator,env)
+            return resume(evaluator,env,index+1)
+        def cond(evaluator,env):
+            return resume(evaluator,env,0)
+        return cond
+    def compile_quasiquote(self,parsed_list,scope,template):
+        """
+        (quasiquote template), or `template: the template as data, except that each (unquote x), or ,x,
+        is replaced by the value of x and each (unquote-splicing x), or ,@x, by the elements of the list x.
+        A nested quasiquote keeps the unquotes inside it as data, one level per quasiquote.
+        """
+        nodes = []
+        build = self.quasiquote_template(as_data(template),scope,1,nodes)
+        if not nodes:
+            return self.constant(self.intern(build(self,None)))
+        return self.analyze_sequence(nodes,lambda evaluator,env,values: build(evaluator,iter(values)))
+    def quasiquote_template(self,template,scope,level,nodes):
+        """
+        A function build(evaluator,values) that makes the data of template, appending the node of each
+        unquoted form to nodes; build takes their values from the iterator values in the same order.
+        """
+        if isinstance(template,Quoted):
+            inner = self.quasiquote_template(template.value,scope,level,nodes)
+            return lambda evaluator,values: Quoted(inner(evaluator,values))
+        elif not isinstance(template,Pair) or template is NIL:
+            return lambda evaluator,values: template
+        operator = template.car
+        if operator is UNQUOTE or operator is QUASIQUOTE or operator is UNQUOTE_SPLICING:
+            if len(template) != 2:
+                raise Exception(f'{operator.name} takes one form')
+            form = template.cdr.car
+            if operator is UNQUOTE_SPLICING and level == 1:
+                raise Exception('unquote-splicing (,@) must be inside a list')
+            if operator is UNQUOTE and level == 1:
+                nodes.append(self.compile(form,scope))
+                return lambda evaluator,values: next(values)
+            inner = self.quasiquote_template(form,scope,level+1 if operator is QUASIQUOTE else level-1,nodes)
+            return lambda evaluator,values: evaluator.op_list(operator,inner(evaluator,values))
+        parts = []
+        for item in template:
+            if level == 1 and isinstance(item,Pair) and item is not NIL and item.car is UNQUOTE_SPLICING and len(item) == 2:
+                nodes.append(self.compile(item.cdr.car,scope))
+                parts.append((True,lambda evaluator,values: next(values)))
+            else:
+                parts.append((False,self.quasiquote_template(item,scope,level,nodes)))
+        def build(evaluator,values):
+            items = []
+            for splice,part in parts:
+                if splice:
+                    items.extend(evaluator.as_pair(part(evaluator,values),'unquote-splicing'))
+                else:
+                    items.append(part(evaluator,values))
+            return evaluator.op_list(*items)
+        return build
+    def compile_unquote(self,parsed_list,scope,*args):
+        raise Exception('unquote (,) outside of a quasiquote')
+    def compile_unquote_splicing(self,parsed_list,scope,*args):
+        raise Exception('unquote-splicing (,@) outside of a quasiquote')
+    def compile_delay(self,parsed_list,scope,form):
+        """
+        (delay form): a Promise to evaluate form, in the current lexical scope, the first time it is forced.
+        """
+        node = self.compile(form,scope)
+        return lambda evaluator,env: Promise(node,env)
+    def compile_stream_cons(self,parsed_list,scope,head,tail):
+        """
+        (stream-cons head tail): a Stream of the value of head, with tail delayed.
+        """
+        tail_node = self.compile(tail,scope)
+        def make(evaluator,env,values):
+            if evaluator.budget is not None:
+                evaluator.budget.allocate(1)
+            return Stream(values[0],Promise(tail_node,env))
+        return self.analyze_sequence([self.compile(head,scope)],make)
+    def compile_defmacro(self,parsed_list,scope,macro_name,arglist,body):
+        """
+        (defmacro name (args) body) defines a Macro: a call (name forms...) is replaced by the value of body
+        with args bound to the forms, unevaluated.
+        """
+        self.definable(macro_name.expr)
+        make_function = self.compile_lambda(parsed_list,scope,arglist,body,name=macro_name.expr)
+        def defmacro(evaluator,env):
+            macro = Macro(macro_name.expr,make_function(evaluator,env))
+            evaluator.variables[macro_name.expr] = macro
+            evaluator.generation += 1
+            return macro
+        return defmacro
+    def compile_lambda(self,parsed_list,scope,arglist,body,*,name='lambda'):
+        arg_expr_list = self.arg_names(arglist)
+        body_scope = Scope(arg_expr_list,scope)
+        body_node = self.compile(body,body_scope)
+        def make_lambda(evaluator,env):
+            func = Function(arg_expr_list,body,parsed_list,env)
+            func.body_node = body_node
+            func.body_scope = body_scope
+            func.name = name
+            return func
+        return make_lambda
+    def compile_label(self,parsed_list,scope,func_name,func_list):
+        #the label name is bound in a frame of its own that encloses the function
+        def bind(evaluator,label_env,values):
+            label_env.slots[0] = values[0]
+            return values[0]
+        label_scope = Scope([func_name.expr],scope)
+        lambda_args = label_lambda(func_list)
+        if lambda_args is not None:
+            func_node = self.compile_lambda(func_list,label_scope,*lambda_args,name=func_name.expr)
+        else:
+            func_node = self.compile(func_list,label_scope)
+        func_sequence = self.analyze_sequence([func_node],bind)
+        def make_label(evaluator,env):
+            return func_sequence(evaluator,Frame([None],env))
+        return make_label
+    def compile_defun(self,parsed_list,scope,func_name,arglist,body,*,function_type=Function,**options):
+        self.definable(func_name.expr)
+        arg_expr_list = self.arg_names(arglist)
+        body_scope = Scope(arg_expr_list,scope)
+        body_node = self.compile(body,body_scope)
+        def defun(evaluator,env):
+            func = function_type(arg_expr_list,body,parsed_list,env,**options)
+            func.body_node = body_node
+            func.body_scope = body_scope
+            func.name = func_name.expr
+            evaluator.variables[func_name.expr] = func
+            evaluator.generation += 1
+            return func
+        return defun
+    def compile_defun_memo(self,parsed_list,scope,func_name,arglist,body,*maxsize):
+        """
+        (defun-memo name (args) body [maxsize]) defines a MemoFunction, keeping up to MemoFunction.default_maxsize results.
+        Arguments are keyed by memo_key, so numbers of different types and distinct functions get results of their own.
+
+        >>> Lisp()("(defun-memo id (x) (list x)) (id 1) (id 1.0) (defun-memo app (f x) (f x)) (app (lambda (y) y) 'a) (app car '(b))")[1:]
+        [List('(1)'), List('(1.0)'), MemoFunction('(defun-memo app (f x) (f x))'), Atom('a'), Atom('b')]
+        """
+        return self.compile_defun(parsed_list,scope,func_name,arglist,body,function_type=MemoFunction,**self.memo_options(func_name,body,maxsize))
+    def memo_options(self,func_name,body,maxsize):
+        if maxsize:
+            maxsize, = maxsize
+            if not isinstance(maxsize,Literal) or not isinstance(maxsize.value,int):
+                raise Exception('defun-memo maxsize must be an integer')
+            maxsize = maxsize.value
+        else:
+            maxsize = None
+        if mutates(body):
+            raise Exception(f'Cannot memoize {func_name.expr}: its body uses setq, defun or table-put')
+        return {'maxsize':maxsize}
+    def compile_setq(self,parsed_list,scope,variable_name,parsed_value):
+        value_node = self.compile(parsed_value,scope)
+        slot = scope.resolve(variable_name.expr) if scope is not None else None
+        if slot is not None:
+            depth,index = slot
+            def assign(evaluator,env,values):
+                for _ in range(depth):
+                    env = env.parent
+                try:
+                    env.slots[index] = values[0]
+                except TypeError:
+                    raise Exception(f'Cannot setq {variable_name.expr}: it is bound in a frozen Image') from None
+                evaluator.generation += 1
+                return values[0]
+            return self.analyze_sequence([value_node],assign)
+        self.definable(variable_name.expr)
+        def assign_global(evaluator,value):
+            evaluator.variables[variable_name.expr] = value
+            evaluator.generation += 1
+            return value
+        return self.analyze_primitive(assign_global,[value_node])
+
+    def intern(self,value):
+        """
+        The value a constant in code evaluates to; see HashConsEvaluator.
+        """
+        return value
+    def as_pair(self,value,operator_name):
+        if isinstance(value,Quoted):
+            value = value.as_list()
+        if not isinstance(value,Pair):
+            raise Exception(f'{operator_name} arg must be list')
+        return value
+    def op_atom(self,value):
+        if is_atomic(value):
+            return TRUE
+        else:
+            return FALSE
+    def op_eq(self,value1,value2):
+        if value1 is value2 or value1 == value2:
+            return TRUE
+        else:
+            return FALSE
+    def op_car(self,value):
+        value = self.as_pair(value,'car')
+        if value is NIL:
+            raise Exception('car arg must be a non-empty list')
+        return value.car
+    def op_cdr(self,value):
+        return self.as_pair(value,'cdr').cdr
+    def op_cons(self,value1,value2):
+        if self.budget is not None:
+            self.budget.allocate(1)
+        return Pair(value1,self.as_pair(value2,'cons second'))
+    def op_list(self,*values):
+        if self.budget is not None:
+            self.budget.allocate(len(values))
+        return Pair.from_iterable(values)
+    def op_macroexpand_1(self,form):
+        """
+        (macroexpand-1 form): the expansion of form if it is a call to a macro, otherwise form.
+        (macroexpand form) expands until the form is no longer a macro call.
+
+        >>> lisp = Lisp()
+        >>> lisp('''
+        ... (defmacro unless (test form) `(cond (,test '()) ('#t ,form)))
+        ... (defmacro when-not-null (x form) `(unless (null ,x) ,form))
+        ... (macroexpand-1 '(when-not-null xs (car xs)))
+        ... (macroexpand '(when-not-null xs (car xs)))
+        ... (macroexpand '(car xs))
+        ... ''')[2:]
+        [List('(unless (null xs) (car xs))'), List("(cond ((null xs) '()) ('#t (car xs)))"), List('(car xs)')]
+        """
+        if isinstance(form,Pair) and form is not NIL:
+            name = symbol_name(form.car)
+            macro = self.variables.get(name) if name is not None else None
+            if type(macro) is Macro:
+                return macro.expand(self,list(form.cdr))
+        return form
+    def op_macroexpand(self,form):
+        while True:
+            expanded = self.op_macroexpand_1(form)
+            if expanded is form:
+                return form
+            form = expanded
+
+    def as_number(self,value,operator_name):
+        if type(value) not in number_types:
+            raise Exception(f'{operator_name} args must be numbers')
+        return value
+    def op_add(self,*values):
+        total = 0
+        for value in values:
+            total += self.as_number(value,'+')
+        return normalize(total)
+    def op_sub(self,first,*values):
+        result = self.as_number(first,'-')
+        if not values:
+            return -result
+        for value in values:
+            result -= self.as_number(value,'-')
+        return normalize(result)
+    def op_mul(self,*values):
+        product = 1
+        for value in values:
+            product *= self.as_number(value,'*')
+        return normalize(product)
+    def op_div(self,first,*values):
+        result = self.as_number(first,'/')
+        if not values:
+            result,values = 1,(result,)
+        for value in values:
+            value = self.as_number(value,'/')
+            if value == 0:
+                raise Exception('Division by zero')
+            if type(result) is not float and type(value) is not float:
+                #exact division of ints and fractions stays exact
+                result = fractions.Fraction(result)/value
+            else:
+                result /= value
+        return normalize(result)
+    def compare(self,operator_name,test,values):
+        for value in values:
+            self.as_number(value,operator_name)
+        for x,y in zip(values,values[1:]):
+            if not test(x,y):
+                return FALSE
+        return TRUE
+    def op_lt(self,first,*values):
+        return self.compare('<',operator.lt,(first,)+values)
+    def op_gt(self,first,*values):
+        return self.compare('>',operator.gt,(first,)+values)
+    def op_le(self,first,*values):
+        return self.compare('<=',operator.le,(first,)+values)
+    def op_ge(self,first,*values):
+        return self.compare('>=',operator.ge,(first,)+values)
+    def op_num_eq(self,first,*values):
+        return self.compare('=',operator.eq,(first,)+values)
+
+    def as_vector(self,value,operator_name):
+        if isinstance(value,Vector):
+            return value
+        return Vector.from_values(self.as_pair(value,operator_name))
+    def op_vector(self,*values):
+        return Vector.from_values(values)
+    def op_to_vector(self,value):
+        return self.as_vector(value,'to-vector')
+    def op_to_list(self,value):
+        if type(value) is Stream:
+            items = []
+            while value is not NIL:
+                items.append(value.head)
+                value = self.stream_rest(value,'to-list')
+            return self.op_list(*items)
+        if not isinstance(value,Vector):
+            raise Exception('to-list arg must be a vector or a stream')
+        return self.op_list(*value)
+    def op_vector_ref(self,vector,index):
+        if not isinstance(vector,Vector) or type(index) is not int:
+            raise Exception('vector-ref args must be a vector and an int')
+        if not 0 <= index < len(vector):
+            raise Exception(f'vector-ref index {index} out of range')
+        return vector[index]
+    def op_length(self,value):
+        if isinstance(value,Vector):
+            return len(value)
+        return len(self.as_pair(value,'length'))
+    def op_map(self,function,*sequences):
+        """
+        (map f xs ys ...) calls f on the elements of each position. Vectors give a vector back, lists a list.
+        + - * / over packed vectors are batched when that gives the same values; see Vector.batch.
+
+        >>> Lisp()("(map + (vector 1 2 3) (vector 4 5 6)) (map (lambda (x) (* x x)) '(1 2 3)) (sum (vector 1.5 2.5)) (dot '(1 2) '(3 4)) (/ 1 3)")
+        [Vector('#(5 7 9)'), List('(1 4 9)'), 4.0, 11, Fraction(1, 3)]
+        """
+        function = self.as_function(function)
+        if not sequences:
+            raise Exception('map needs at least one list or vector')
+        vectors = all([isinstance(sequence,Vector) for sequence in sequences])
+        if vectors and isinstance(function,Primitive) and function.name in Vector.batched:
+            result = Vector.batch(function.name,sequences)
+            if result is not None:
+                return result
+        columns = [list(sequence) if isinstance(sequence,Vector) else list(self.as_pair(sequence,'map')) for sequence in sequences]
+        if len({len(column) for column in columns}) > 1:
+            raise Exception('map over lists of different lengths')
+        results = [self.call(function,list(args)) for args in zip(*columns)]
+        if vectors:
+            return Vector.from_values(results)
+        return self.op_list(*results)
+    def as_stream(self,value,operator_name):
+        if type(value) is not Stream and value is not NIL:
+            raise Exception(f'{operator_name} arg must be a stream')
+        return value
+    def stream_rest(self,stream,operator_name):
+        """
+        Force the tail of a Stream cell. stream-cons delays its tail unevaluated, so it is only checked here
+        that the tail is another stream or '().
+
+        >>> lisp = Lisp()
+        >>> lisp("(setq s (stream-cons 1 '(2))) (stream-car s)")[1]
+        1
+        >>> for form in ("(to-list s)","(stream-cdr s)","(to-list (stream-map (lambda (x) x) s))","(to-list (stream-take s 3))"):
+        ...     try:
+        ...         lisp(form)
+        ...     except Exception as e:
+        ...         print(e)
+        to-list: the tail of a stream must be a stream or ()
+        stream-cdr: the tail of a stream must be a stream or ()
+        stream-map: the tail of a stream must be a stream or ()
+        stream-take: the tail of a stream must be a stream or ()
+        """
+        rest = stream.tail.force(self)
+        if type(rest) is not Stream and rest is not NIL:
+            raise Exception(f'{operator_name}: the tail of a stream must be a stream or ()')
+        return rest
+    def op_force(self,value):
+        if type(value) is Promise:
+            return value.force(self)
+        return value
+    def op_stream_car(self,stream):
+        if type(stream) is not Stream:
+            raise Exception('stream-car arg must be a non-empty stream')
+        return stream.head
+    def op_stream_cdr(self,stream):
+        if type(stream) is not Stream:
+            raise Exception('stream-cdr arg must be a non-empty stream')
+        return self.stream_rest(stream,'stream-cdr')
+    def op_stream_null(self,stream):
+        return TRUE if self.as_stream(stream,'stream-null') is NIL else FALSE
+    def op_to_stream(self,value):
+        if type(value) is Stream:
+            return value
+        elif isinstance(value,Vector):
+            return Stream.from_iterable(value)
+        return Stream.from_iterable(self.as_pair(value,'to-stream'))
+    def op_file_lines(self,path):
+        if not isinstance(path,str):
+            raise Exception('file-lines arg must be a string')
+        return Stream.from_file(path)
+    def op_dump_data(self,value,path):
+        """
+        (dump-data value path) writes value to the file path in the binary form of dump_data and returns its cell count.
+        (load-data path) opens such a file with map_data: its lists are decoded as they are walked.
+        """
+        if not isinstance(path,str):
+            raise Exception('dump-data path must be a string')
+        return dump_data(value,path)
+    def op_load_data(self,path):
+        if not isinstance(path,str):
+            raise Exception('load-data arg must be a string')
+        return map_data(path)
+    def op_stream_map(self,function,stream):
+        """
+        (stream-map f s), (stream-filter f s) and (stream-take s n) are streams too: each element is
+        computed when the cell before it is forced.
+        """
+        function = self.as_function(function)
+        def mapped(evaluator,stream):
+            if stream is NIL:
+                return NIL
+            return Stream.cell(evaluator,evaluator.call(function,[stream.head]),Promise(lambda evaluator,env: mapped(evaluator,evaluator.stream_rest(stream,'stream-map'))))
+        return mapped(self,self.as_stream(stream,'stream-map'))
+    def op_stream_filter(self,function,stream):
+        function = self.as_function(function)
+        def filtered(evaluator,stream):
+            while stream is not NIL and evaluator.call(function,[stream.head]) is FALSE:
+                stream = evaluator.stream_rest(stream,'stream-filter')
+            if stream is NIL:
+                return NIL
+            return Stream.cell(evaluator,stream.head,Promise(lambda evaluator,env: filtered(evaluator,evaluator.stream_rest(stream,'stream-filter'))))
+        return filtered(self,self.as_stream(stream,'stream-filter'))
+    def op_stream_take(self,stream,count):
+        if type(count) is not int:
+            raise Exception('stream-take count must be an int')
+        def taken(evaluator,stream,count):
+            if stream is NIL or count <= 0:
+                return NIL
+            #the last cell taken does not force the stream past it
+            return Stream.cell(evaluator,stream.head,Promise(lambda evaluator,env: taken(evaluator,evaluator.stream_rest(stream,'stream-take'),count-1) if count > 1 else NIL))
+        return taken(self,self.as_stream(stream,'stream-take'),count)
+    def op_sum(self,value):
+        if isinstance(value,Vector):
+            return value.sum()
+        return self.op_add(*self.as_pair(value,'sum'))
+    def op_dot(self,x,y):
+        return self.as_vector(x,'dot').dot(self.as_vector(y,'dot'))
+    def as_table(self,value,operator_name):
+        if type(value) is not Table:
+            raise Exception(f'{operator_name} arg must be a table')
+        return value
+    def op_make_table(self,alist=NIL):
+        """
+        (make-table) is an empty table and (make-table alist) one holding the (key value) entries of alist;
+        as with assoc, the first entry of a key wins. (table-get t key) is the value of key, or '() (or the
+        default of (table-get t key default)) when it has none. (table-put t key value) changes t and returns it,
+        (table-with t key value) returns a new table and leaves t unchanged. (table-keys t) lists the keys in
+        the order they were first put.
+
+        >>> lisp = Lisp()
+        >>> lisp("(setq t (make-table '((a 1) ((b c) 2) (a 3)))) (table-get t 'a) (table-get t '(b c)) (table-get t 'd 'none)")
+        [Table('#<table (a 1) ((b c) 2)>'), 1, 2, Atom('none')]
+        >>> lisp("(setq u (table-with t 'd 4)) (table-get t 'd) (table-put t 'a 5) (table-keys u) (table-get u 'a)")
+        [Table('#<table (a 1) ((b c) 2) (d 4)>'), List('()'), Table('#<table (a 5) ((b c) 2)>'), List('(a (b c) d)'), 1]
+        >>> lisp.register('py-dict',lambda: {})
+        Primitive('py-dict')
+        >>> lisp("(table-put t (py-dict) 1)")
+        Traceback (most recent call last):
+        ...
+        Exception: A table key must be hashable, got dict
+        """
+        table = Table()
+        for entry in self.as_pair(alist,'make-table'):
+            if Table.key(self.op_car(entry)) not in table.entries:
+                table.put(self.op_car(entry),self.cxr('cadr','da',entry))
+        return table
+    def op_table_get(self,table,key,default=NIL):
+        return self.as_table(table,'table-get').get(key,default)
+    def op_table_put(self,table,key,value):
+        self.as_table(table,'table-put').put(key,value)
+        #memoized results may depend on what the table held
+        self.generation += 1
+        return table
+    def op_table_with(self,table,key,value):
+        return self.as_table(table,'table-with').with_entry(key,value)
+    def op_table_keys(self,table):
+        return self.op_list(*self.as_table(table,'table-keys').keys())
+
+class HashConsEvaluator(Evaluator):
+    """
+    Evaluator that builds every list through cons_table, so structurally equal lists are a single
+    object and eq on them is an identity check instead of a walk over both lists.
+
+    >>> lisp = Lisp(hash_cons=True)
+    >>> a,b,c = lisp("(list 'x '(y z)) (cons 'x (list '(y z))) (list 'x '(y))")
+    >>> a is b, a == c
+    (True, False)
+    """
+    def intern(self,value):
+        return cons_table.canonical(value)
+    def as_pair(self,value,operator_name):
+        return cons_table.canonical(super().as_pair(value,operator_name))
+    def op_cons(self,value1,value2):
+        if self.budget is not None:
+            self.budget.allocate(1)
+        return cons_table.cons(value1,self.as_pair(value2,'cons second'))
+    def op_list(self,*values):
+        if self.budget is not None:
+            self.budget.allocate(len(values))
+        return cons_table.from_iterable(values)
+
+opcodes = ('CONST','LOCAL0','LOCAL1','LOCAL','GLOBAL','CALL','TAIL_CALL','CALL_GLOBAL','TAIL_CALL_GLOBAL','JUMP_IF_FALSE','JUMP','RETURN',
+    'CAR','CDR','CONS','EQ','ATOM','CXR','PRIMITIVE','NODE','SET_LOCAL','SET_GLOBAL','FUNCTION','DEFUN','LABEL','BIND_LABEL','GUARD','ENTER','LEAVE','PYTHON')
+(OP_CONST,OP_LOCAL0,OP_LOCAL1,OP_LOCAL,OP_GLOBAL,OP_CALL,OP_TAIL_CALL,OP_CALL_GLOBAL,OP_TAIL_CALL_GLOBAL,OP_JUMP_IF_FALSE,OP_JUMP,OP_RETURN,
+    OP_CAR,OP_CDR,OP_CONS,OP_EQ,OP_ATOM,OP_CXR,OP_PRIMITIVE,OP_NODE,OP_SET_LOCAL,OP_SET_GLOBAL,OP_FUNCTION,OP_DEFUN,OP_LABEL,OP_BIND_LABEL,OP_GUARD,OP_ENTER,OP_LEAVE,OP_PYTHON) = range(len(opcodes))
+
+class Code():
+    """
+    Compiled form or function body for VMEvaluator: a list of (opcode,operand) instructions run from
+    index 0 until a RETURN. Operands:
+        CONST value, LOCAL0/LOCAL1 index, LOCAL (depth,index), GLOBAL (name,fallback)
+        CALL/TAIL_CALL argument count, CALL_GLOBAL/TAIL_CALL_GLOBAL (name,fallback,argument count)
+        CXR (name,car/cdr operations,tail), JUMP_IF_FALSE/JUMP target index
+        PRIMITIVE (op method,argument count,name), PYTHON (function,argument count,name) for a function
+            called without the evaluator (see Lisp.register), NODE closure
+        SET_LOCAL (depth,index), SET_GLOBAL name, FUNCTION/DEFUN a FunctionTemplate
+        GUARD [name,bound value,call,scope,end index,node], ahead of the inlined code of a call to a macro or,
+            when optimizing, to a function; ENTER argument count, a frame for the arguments of an inlined function, LEAVE
+    fallback is the Primitive for a primitive or c[ad]+r name, used when the global is unbound.
+    """
+    __slots__ = ('name','instructions')
+    def __init__(self,name):
+        self.name = name
+        self.instructions = []
+    def emit(self,opcode,operand=None):
+        self.instructions.append((opcode,operand))
+        return len(self.instructions)-1
+    def patch(self,index,target):
+        self.instructions[index] = (self.instructions[index][0],target)
+    def disassemble(self):
+        lines = [f'{self.name}:']
+        nested = []
+        for index,(opcode,operand) in enumerate(self.instructions):
+            if opcode in (OP_FUNCTION,OP_DEFUN):
+                nested.append(operand.code)
+                operand = operand.code.name
+            elif opcode == OP_CONST:
+                operand = value_expr(operand)
+            elif opcode in (OP_GLOBAL,OP_CALL_GLOBAL,OP_TAIL_CALL_GLOBAL,OP_PRIMITIVE,OP_PYTHON):
+                operand = ' '.join([str(item) for item in operand if not callable(item) and item is not None])
+            elif opcode in (OP_CXR,OP_GUARD):
+                operand = operand[0]
+            elif opcode in (OP_LOCAL,OP_SET_LOCAL):
+                operand = '%d %d' % operand
+            elif opcode == OP_NODE:
+                operand = '<closure>'
+            lines.append(f'{index:4d} {opcodes[opcode]:<17}{"" if operand is None else operand}'.rstrip())
+        for code in nested:
+            lines.append('')
+            lines.append(code.disassemble())
+        return '\n'.join(lines)
+    def __repr__(self):
+        return f'Code({repr(self.name)})'
+
+class CodeNode():
+    """
+    Runs a Code object where a compiled closure is expected, so VM functions work with Function.apply,
+    Evaluator.execute and the tree-walking Evaluator.
+    """
+    __slots__ = ('code',)
+    def __init__(self,code):
+        self.code = code
+    def __call__(self,evaluator,env):
+        return VMEvaluator.run(evaluator,self.code,env)
+
+class FunctionTemplate():
+    """
+    Operand of FUNCTION and DEFUN: everything needed to make the Function, with the body compiled once.
+    """
+    __slots__ = ('name','arg_expr_list','body','parsed_list','scope','code','node','function_type','options')
+    def __init__(self,name,arg_expr_list,body,parsed_list,scope,code,function_type=Function,options=None):
+        self.name = name
+        self.scope = scope
+        self.arg_expr_list = arg_expr_list
+        self.body = body
+        self.parsed_list = parsed_list
+        self.code = code
+        self.node = CodeNode(code)
+        self.function_type = function_type
+        self.options = options or {}
+    def make(self,env):
+        func = self.function_type(self.arg_expr_list,self.body,self.parsed_list,env,**self.options)
+        func.body_node = self.node
+        func.body_scope = self.scope
+        func.name = self.name
+        return func
+
+class VMEvaluator(Evaluator):
+    """
+    Evaluator backend that compiles forms to Code and runs it on a stack machine.
+    Calls to functions compiled by the VM switch the running code in place: a call pushes a
+    (instructions,pc,env) record and RETURN pops it, a tail call pushes nothing, so neither grows the
+    python stack. Special forms without an emit_ method run as closures from Evaluator (NODE).
+
+    >>> check_examples(backend='vm')
+    TestResults(failed=0, attempted=19)
+    >>> print(Lisp(backend='vm').disassemble("(defun second (x) (car (cdr x)))"))
+    <form>:
+       0 DEFUN            second
+       1 RETURN
+    <BLANKLINE>
+    second:
+       0 LOCAL0           0
+       1 CDR
+       2 CAR
+       3 RETURN
+    """
+    def analyze(self,parsed,scope):
+        code = Code('<form>')
+        self.emit(parsed,scope,True,code)
+        code.emit(OP_RETURN)
+        return CodeNode(code)
+
+    def emit(self,parsed,scope,tail,code):
+        """
+        Append the instructions that push the value of parsed. tail is true when the value is returned
+        by the code, so a call can replace the running code.
+        """
+        if isinstance(parsed,Function):
+            code.emit(OP_NODE,Evaluator.analyze(self,parsed,scope))
+        elif isinstance(parsed,(List,Pair)):
+            if parsed.is_atomic():
+                raise Exception('Cannot evaluate an empty list')
+            self.emit_call(parsed,scope,tail,code)
+        elif isinstance(parsed,Quasiquote):
+            self.emit_call(parsed.as_value(),scope,tail,code)
+        elif symbol_name(parsed) is not None:
+            self.emit_variable(symbol_name(parsed),scope,code)
+        elif isinstance(parsed,(Quote,Quoted,Literal)):
+            code.emit(OP_CONST,self.intern(parsed(self)))
+        else:
+            code.emit(OP_CONST,parsed)
+
+    def emit_variable(self,variable_name,scope,code):
+        slot = scope.resolve(variable_name) if scope is not None else None
+        if slot is None and self.primitive(variable_name) is not None:
+            code.emit(OP_CONST,self.primitive(variable_name))
+        elif slot is None:
+            code.emit(OP_GLOBAL,(variable_name,self.fallback(variable_name)))
+        elif slot[0] == 0:
+            code.emit(OP_LOCAL0,slot[1])
+        elif slot[0] == 1:
+            code.emit(OP_LOCAL1,slot[1])
+        else:
+            code.emit(OP_LOCAL,slot)
+
+    def fallback(self,name):
+        primitive = self.primitive(name)
+        if primitive is not None:
+            return primitive
+        elif self.cxr_pattern.search(name) is not None:
+            cxr = name[-2:0:-1]
+            return Primitive(name,lambda evaluator,value: evaluator.cxr(name,cxr,value))
+        return None
+
+    def emit_call(self,parsed_list,scope,tail,code):
+        operator,*args = parsed_list
+        operator_name = symbol_name(operator)
+        if operator_name is None or (scope is not None and scope.resolve(operator_name) is not None and self.primitive(operator_name) is None
+                and getattr(self,'compile_'+operator_name.replace('-','_'),None) is None):
+            self.emit(operator,scope,False,code)
+            for arg in args:
+                self.emit(arg,scope,False,code)
+            code.emit(OP_TAIL_CALL if tail else OP_CALL,len(args))
+            return
+        special_form = getattr(self,'emit_'+operator_name.replace('-','_'),None)
+        if special_form is not None:
+            self.check_special_form(operator_name,getattr(self,'compile_'+operator_name.replace('-','_')),args)
+            return special_form(parsed_list,scope,tail,code,*args)
+        elif getattr(self,'compile_'+operator_name.replace('-','_'),None) is not None:
+            code.emit(OP_NODE,Evaluator.analyze(self,parsed_list,scope))
+            return
+        macro = self.macro(operator_name,scope)
+        if macro is not None:
+            #the expansion runs inline while the name is still bound to this macro
+            self.emit_guarded(parsed_list,scope,code,operator_name,macro,lambda: self.emit(self.expand(parsed_list,macro),scope,tail,code))
+            return
+        primitive = self.primitive(operator_name)
+        if primitive is None and self.optimize:
+            bound = self.variables.get(operator_name)
+            if self.emit_guarded(parsed_list,scope,code,operator_name,bound,lambda: self.emit_inline(parsed_list,scope,tail,code,operator_name,bound)):
+                return
+        start = len(code.instructions)
+        for arg in args:
+            self.emit(arg,scope,False,code)
+        if primitive is not None:
+            apply = lambda evaluator,*values: primitive.apply(evaluator,values)
+            if not primitive.accepts(len(args)):
+                code.emit(OP_PRIMITIVE,(apply,len(args),operator_name))
+                return
+            if self.optimize and primitive.pure and self.emit_fold(apply,start,code):
+                return
+            opcode = {'car':OP_CAR,'cdr':OP_CDR,'cons':OP_CONS,'eq':OP_EQ,'atom':OP_ATOM}.get(operator_name)
+            #inline opcodes only stand in for the base class primitives they copy
+            if (opcode is not None and primitive.function is getattr(Evaluator,'op_'+operator_name) and type(self).as_pair is Evaluator.as_pair
+                    and len(args) == (2 if opcode in (OP_CONS,OP_EQ) else 1)):
+                code.emit(opcode)
+            else:
+                code.emit(OP_PYTHON if primitive.strategy == 'python' else OP_PRIMITIVE,(primitive.function,len(args),operator_name))
+            return
+        if self.cxr_pattern.search(operator_name) is not None and len(args) == 1:
+            code.emit(OP_CXR,(operator_name,operator_name[-2:0:-1],tail))
+            return
+        code.emit(OP_TAIL_CALL_GLOBAL if tail else OP_CALL_GLOBAL,(operator_name,self.fallback(operator_name),len(args)))
+
+    def emit_guarded(self,parsed_list,scope,code,operator_name,bound,emit_body):
+        """
+        Emit a GUARD, then call emit_body to append the code of the call for the value bound to operator_name,
+        see Evaluator.analyze_guarded. If emit_body returns False, nothing is emitted and neither is returned.
+        """
+        start = code.emit(OP_GUARD)
+        if emit_body() is False:
+            del code.instructions[start:]
+            return False
+        code.patch(start,[operator_name,bound,parsed_list,scope,len(code.instructions),None])
+        return True
+
+    def emit_inline(self,parsed_list,scope,tail,code,operator_name,bound):
+        """
+        The code of Evaluator.inline: emit the call to the global operator_name without making it, or return False.
+        """
+        args = list(parsed_list)[1:]
+        start = len(code.instructions)
+        function = self.folder(operator_name,bound)
+        if function is not None:
+            for arg in args:
+                self.emit(arg,scope,False,code)
+            return self.emit_fold(function,start,code)
+        plan = self.inline_plan(operator_name,bound,args,scope,lambda: [self.emit_constant(arg,scope,code) for arg in args])
+        if plan is None:
+            return False
+        body,kept,body_scope = plan
+        if not kept:
+            #only loads of local variables are left, and they are substituted into the body
+            del code.instructions[start:]
+            self.while_inlining(operator_name,lambda: self.emit(body,body_scope,tail,code))
+        else:
+            code.emit(OP_ENTER,len(kept))
+            self.while_inlining(operator_name,lambda: self.emit(body,body_scope,tail,code))
+            code.emit(OP_LEAVE)
+        return True
+
+    def emit_constant(self,parsed,scope,code):
+        """
+        Emit parsed, unless it is a constant: then take its CONST back and return the value, otherwise return not_constant.
+        """
+        start = len(code.instructions)
+        self.emit(parsed,scope,False,code)
+        if len(code.instructions) == start+1 and code.instructions[start][0] == OP_CONST:
+            return code.instructions.pop()[1]
+        return not_constant
+
+    def emit_fold(self,function,start,code):
+        """
+        When the instructions from start are one CONST per argument, replace them by a CONST of
+        function(evaluator,*values) and return True; see Evaluator.fold.
+        """
+        value = self.fold_value(function,[operand if opcode == OP_CONST else not_constant for opcode,operand in code.instructions[start:]])
+        if value is not_constant:
+            return False
+        del code.instructions[start:]
+        code.emit(OP_CONST,value)
+        return True
+
+    def emit_quote(self,parsed_list,scope,tail,code,arg):
+        code.emit(OP_CONST,self.intern(arg.as_value()))
+    def emit_cond(self,parsed_list,scope,tail,code,*args):
+        ends = []
+        for p,e in self.cond_clauses(args):
+            #a quoted predicate needs no test: '#f never matches, anything else always does
+            if isinstance(p,(Quote,Quoted,Literal)):
+                if self.intern(p(self)) is FALSE:
+                    continue
+                self.emit(e,scope,tail,code)
+                break
+            if self.optimize:
+                value = self.emit_constant(p,scope,code)
+                if value is FALSE:
+                    continue
+                elif value is not not_constant:
+                    self.emit(e,scope,tail,code)
+                    break
+            else:
+                self.emit(p,scope,False,code)
+            test = code.emit(OP_JUMP_IF_FALSE)
+            self.emit(e,scope,tail,code)
+            #in tail position the clause returns its value itself instead of jumping to the RETURN
+            ends.append(code.emit(OP_RETURN if tail else OP_JUMP))
+            code.patch(test,len(code.instructions))
+        else:
+            code.emit(OP_CONST,NIL)
+        ends = [end for end in ends if code.instructions[end][0] == OP_JUMP]
+        for end in ends:
+            code.patch(end,len(code.instructions))
+    def emit_lambda(self,parsed_list,scope,tail,code,arglist,body,*,name='lambda'):
+        code.emit(OP_FUNCTION,self.function_template(name,arglist,body,parsed_list,scope))
+    def emit_label(self,parsed_list,scope,tail,code,func_name,func_list):
+        #the label name is bound in a frame of its own that encloses the function
+        code.emit(OP_LABEL)
+        label_scope = Scope([func_name.expr],scope)
+        lambda_args = label_lambda(func_list)
+        if lambda_args is not None:
+            self.emit_lambda(func_list,label_scope,False,code,*lambda_args,name=func_name.expr)
+        else:
+            self.emit(func_list,label_scope,False,code)
+        code.emit(OP_BIND_LABEL)
+    def emit_defun(self,parsed_list,scope,tail,code,func_name,arglist,body,*,function_type=Function,**options):
+        self.definable(func_name.expr)
+        code.emit(OP_DEFUN,self.function_template(func_name.expr,arglist,body,parsed_list,scope,function_type,options))
+    def emit_defun_memo(self,parsed_list,scope,tail,code,func_name,arglist,body,*maxsize):
+        self.emit_defun(parsed_list,scope,tail,code,func_name,arglist,body,function_type=MemoFunction,**self.memo_options(func_name,body,maxsize))
+    def emit_setq(self,parsed_list,scope,tail,code,variable_name,parsed_value):
+        self.emit(parsed_value,scope,False,code)
+        slot = scope.resolve(variable_name.expr) if scope is not None else None
+        if slot is not None:
+            code.emit(OP_SET_LOCAL,slot)
+        else:
+            self.definable(variable_name.expr)
+            code.emit(OP_SET_GLOBAL,variable_name.expr)
+
+    def function_template(self,name,arglist,body,parsed_list,scope,function_type=Function,options=None):
+        arg_expr_list = self.arg_names(arglist)
+        body_scope = Scope(arg_expr_list,scope)
+        body_code = Code(name)
+        self.emit(body,body_scope,True,body_code)
+        body_code.emit(OP_RETURN)
+        return FunctionTemplate(name,arg_expr_list,body,parsed_list,body_scope,body_code,function_type,options)
+
+    def run(self,code,env):
+        """
+        The stack machine. Values live on one list shared by all calls; each call record holds the
+        caller's instructions, pc and env, plus the resume frames of a TailCall the callee came from.
+        """
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        variables = self.variables
+        #a profiling evaluator times every call through apply, so calls are not switched in place
+        profiler = self.profiler
+        budget = self.budget
+        calls = []
+        instructions = code.instructions
+        pc = 0
+        while True:
+            opcode,operand = instructions[pc]
+            pc += 1
+            if opcode == OP_LOCAL0:
+                push(env.slots[operand])
+                continue
+            elif opcode == OP_CONST:
+                push(operand)
+                continue
+            elif opcode == OP_JUMP_IF_FALSE:
+                if pop() is FALSE:
+                    pc = operand
+                continue
+            elif opcode == OP_JUMP:
+                pc = operand
+                continue
+            elif opcode == OP_CAR:
+                value = stack[-1]
+                stack[-1] = value.car if type(value) is Pair else self.op_car(value)
+                continue
+            elif opcode == OP_CDR:
+                value = stack[-1]
+                stack[-1] = value.cdr if type(value) is Pair else self.op_cdr(value)
+                continue
+            elif opcode == OP_EQ:
+                value = pop()
+                stack[-1] = TRUE if stack[-1] is value or stack[-1] == value else FALSE
+                continue
+            elif opcode == OP_ATOM:
+                stack[-1] = TRUE if is_atomic(stack[-1]) else FALSE
+                continue
+            elif opcode == OP_CONS:
+                value = pop()
+                if type(value) is Pair or value is NIL:
+                    if budget is not None:
+                        budget.allocate(1)
+                    stack[-1] = Pair(stack[-1],value)
+                else:
+                    stack[-1] = self.op_cons(stack[-1],value)
+                continue
+            elif opcode == OP_CXR:
+                name,operations,tail = operand
+                if name not in variables:
+                    stack[-1] = self.cxr(name,operations,stack[-1])
+                    continue
+                function = variables[name]
+                args = [pop()]
+            elif opcode == OP_RETURN:
+                if not calls:
+                    return pop()
+                instructions,pc,env,frames = calls.pop()
+                if frames is not None:
+                    push(self.resume_frames(frames,pop()))
+                continue
+            elif opcode == OP_CALL_GLOBAL or opcode == OP_TAIL_CALL_GLOBAL:
+                name,fallback,count = operand
+                function = variables.get(name,fallback)
+                if function is None:
+                    raise Exception('Unbounded variable name: %s' % name)
+                args = stack[len(stack)-count:]
+                del stack[len(stack)-count:]
+                tail = opcode == OP_TAIL_CALL_GLOBAL
+            elif opcode == OP_CALL or opcode == OP_TAIL_CALL:
+                args = stack[len(stack)-operand:]
+                del stack[len(stack)-operand:]
+                function = pop()
+                tail = opcode == OP_TAIL_CALL
+            elif opcode == OP_LOCAL1:
+                push(env.parent.slots[operand])
+                continue
+            elif opcode == OP_LOCAL:
+                depth,index = operand
+                frame = env
+                for _ in range(depth):
+                    frame = frame.parent
+                push(frame.slots[index])
+                continue
+            elif opcode == OP_GLOBAL:
+                name,fallback = operand
+                value = variables.get(name,fallback)
+                if value is None:
+                    raise Exception(f'Unbound variable: {name}')
+                push(value)
+                continue
+            elif opcode == OP_PRIMITIVE:
+                primitive,count,name = operand
+                args = stack[len(stack)-count:]
+                del stack[len(stack)-count:]
+                push(primitive(self,*args))
+                continue
+            elif opcode == OP_PYTHON:
+                function,count,name = operand
+                args = stack[len(stack)-count:]
+                del stack[len(stack)-count:]
+                push(function(*args))
+                continue
+            elif opcode == OP_NODE:
+                push(self.execute(operand,env))
+                continue
+            elif opcode == OP_SET_LOCAL:
+                depth,index = operand
+                frame = env
+                for _ in range(depth):
+                    frame = frame.parent
+                try:
+                    frame.slots[index] = stack[-1]
+                except TypeError:
+                    raise Exception('Cannot setq a variable bound in a frozen Image') from None
+                self.generation += 1
+                continue
+            elif opcode == OP_SET_GLOBAL:
+                variables[operand] = stack[-1]
+                self.generation += 1
+                continue
+            elif opcode == OP_FUNCTION:
+                push(operand.make(env))
+                continue
+            elif opcode == OP_DEFUN:
+                func = operand.make(env)
+                variables[operand.name] = func
+                self.generation += 1
+                push(func)
+                continue
+            elif opcode == OP_LABEL:
+                env = Frame([None],env)
+                continue
+            elif opcode == OP_BIND_LABEL:
+                env.slots[0] = stack[-1]
+                env = env.parent
+                continue
+            elif opcode == OP_GUARD:
+                if variables.get(operand[0]) is not operand[1]:
+                    #the name was rebound: skip the inlined code and run the call from a node that compiles it again;
+                    #that node only runs while the name is bound to something else, so it needs no code for the old value
+                    if operand[5] is None:
+                        operand[5] = Evaluator.analyze_guarded(self,operand[2],operand[3],operand[0],operand[1],None)
+                    push(self.execute(operand[5],env))
+                    pc = operand[4]
+                continue
+            elif opcode == OP_ENTER:
+                args = stack[len(stack)-operand:]
+                del stack[len(stack)-operand:]
+                env = Frame(args,env)
+                continue
+            elif opcode == OP_LEAVE:
+                env = env.parent
+                continue
+            else:
+                raise Exception(f'Bad opcode {opcode}')
+            #a call: switch to the body of a VM function, otherwise apply the function here
+            if profiler is None and type(function) is Function and type(function.body_node) is CodeNode:
+                if len(args) != len(function.arg_expr_list):
+                    raise Exception(f'{function.expr} expects {len(function.arg_expr_list)} arguments, got {len(args)}')
+                if budget is not None:
+                    budget.step()
+                if not tail:
+                    calls.append((instructions,pc,env,None))
+                instructions = function.body_node.code.instructions
+                pc = 0
+                env = Frame(args,function.env)
+                continue
+            if not isinstance(function,(Function,Primitive)):
+                function = self.as_function(function)
+            value = function.apply(self,args) if profiler is None else self.apply(function,args)
+            if type(value) is TailCall:
+                if type(value.node) is CodeNode:
+                    if budget is not None:
+                        budget.step()
+                    if not tail or value.frames is not None:
+                        #after a tail call, the instructions at pc only return
+                        calls.append((instructions,pc,env,value.frames))
+                    instructions = value.node.code.instructions
+                    pc = 0
+                    env = value.env
+                    continue
+                value = self.execute(lambda evaluator,env,tail_call=value: tail_call,None)
+            push(value)
+
+    def resume_frames(self,frames,value):
+        for frame in frames:
+            value = frame(value)
+            if type(value) is TailCall:
+                value = self.execute(lambda evaluator,env,tail_call=value: tail_call,None)
+        return value
+
+class HashConsVMEvaluator(HashConsEvaluator,VMEvaluator):
+    pass
+
+#evaluator class for each (backend,hash_cons) option of Lisp
+evaluator_types = {
+    ('tree',False):Evaluator,
+    ('tree',True):HashConsEvaluator,
+    ('vm',False):VMEvaluator,
+    ('vm',True):HashConsVMEvaluator,
+    }
+
+class ProfileRow():
+    """
+    Totals of one function or primitive. calls counts every call, primitive_calls only those that were not
+    recursive, as in pstats; cumulative_time is only added up over those. callers maps a caller name to
+    [calls,primitive_calls,self_time,cumulative_time] of the calls it made.
+    """
+    __slots__ = ('calls','primitive_calls','self_time','cumulative_time','callers')
+    def __init__(self):
+        self.calls = 0
+        self.primitive_calls = 0
+        self.self_time = 0.0
+        self.cumulative_time = 0.0
+        self.callers = {}
+    def __repr__(self):
+        return f'ProfileRow(calls={self.calls}, self_time={self.self_time:.6f}, cumulative_time={self.cumulative_time:.6f})'
+
+class Profiler():
+    """
+    Call counts and times recorded by a ProfilingEvaluator, keyed by defun/label name, native prelude
+    name or op_ method name, plus the time Lisp spent reading forms and evaluating them.
+    Each distinct call stack is a path, kept as (parent path,name) so entering a call is one dict lookup;
+    the self time of each path gives the folded stacks.
+
+    >>> lisp = Lisp(native_prelude=False)
+    >>> profiler = lisp.start_profile()
+    >>> lisp("(concat '(a) '(b))")
+    [List('(a b)')]
+    >>> profiler is lisp.stop_profile()
+    True
+    >>> {name:row.calls for name,row in profiler.rows.items()}
+    {'op_eq': 2, 'null': 2, 'op_car': 1, 'op_cdr': 1, 'concat': 2, 'op_cons': 1}
+    >>> for line in profiler.folded().splitlines():
+    ...     print(line.rsplit(' ',1)[0])
+    concat
+    concat;null
+    concat;null;op_eq
+    concat;op_car
+    concat;op_cdr
+    concat;concat
+    concat;concat;null
+    concat;concat;null;op_eq
+    concat;op_cons
+    >>> import pstats; stats = pstats.Stats(profiler); stats.total_calls,stats.prim_calls
+    (9, 8)
+    """
+    def __init__(self,clock=time.perf_counter):
+        self.clock = clock
+        self.rows = {}
+        #[name,start,time of the calls made so far,path] of each call in progress
+        self.stack = []
+        self.active = collections.Counter()
+        self.paths = {}
+        self.path_keys = []
+        self.path_times = []
+        self.parse_time = 0.0
+        self.eval_time = 0.0
+        self.stats = {}
+    def enter(self,name):
+        parent = self.stack[-1][3] if self.stack else None
+        path = self.paths.get((parent,name))
+        if path is None:
+            path = self.paths[(parent,name)] = len(self.path_keys)
+            self.path_keys.append((parent,name))
+            self.path_times.append(0.0)
+        self.active[name] += 1
+        self.stack.append([name,self.clock(),0.0,path])
+    def exit(self):
+        name,start,child_time,path = self.stack.pop()
+        elapsed = self.clock()-start
+        self_time = elapsed-child_time
+        self.path_times[path] += self_time
+        self.active[name] -= 1
+        outermost = self.active[name] == 0
+        row = self.rows.get(name)
+        if row is None:
+            row = self.rows[name] = ProfileRow()
+        caller = self.stack[-1][0] if self.stack else None
+        if caller is not None:
+            self.stack[-1][2] += elapsed
+            caller_row = row.callers.get(caller)
+            if caller_row is None:
+                caller_row = row.callers[caller] = [0,0,0.0,0.0]
+            caller_row[0] += 1
+            caller_row[2] += self_time
+            if outermost:
+                caller_row[1] += 1
+                caller_row[3] += elapsed
+        row.calls += 1
+        row.self_time += self_time
+        if outermost:
+            row.primitive_calls += 1
+            row.cumulative_time += elapsed
+    def exit_frame(self,result):
+        """
+        Resume frame that ends a call when the TailCall of its body has produced the result.
+        """
+        self.exit()
+        return result
+    def unwind(self,depth):
+        """
+        End the calls still open above depth, which an exception skipped over.
+        """
+        while len(self.stack) > depth:
+            self.exit()
+
+    def run(self,forms,evaluate):
+        """
+        evaluate(form) each form, adding the time spent reading forms to parse_time and the rest to eval_time.
+        """
+        clock = self.clock
+        values = []
+        forms = iter(forms)
+        while True:
+            start = clock()
+            form = next(forms,None)
+            parsed = clock()
+            self.parse_time += parsed-start
+            if form is None:
+                return values
+            values.append(evaluate(form))
+            self.eval_time += clock()-parsed
+
+    def table(self,sort='cumulative',limit=None):
+        """
+        The rows as text, sorted by 'cumulative', 'self', 'calls' or 'name'. Calls shows total/non-recursive when they differ.
+        """
+        keys = {
+            'cumulative':lambda item: -item[1].cumulative_time,
+            'self':lambda item: -item[1].self_time,
+            'calls':lambda item: -item[1].calls,
+            'name':lambda item: item[0],
+            }
+        if sort not in keys:
+            raise Exception(f'Unknown sort key: {sort}')
+        lines = [f'parse {self.parse_time:.6f}s, eval {self.eval_time:.6f}s',
+            f'{"calls":>11} {"self":>10} {"cumulative":>10} {"per call":>10}  name']
+        for name,row in sorted(self.rows.items(),key=keys[sort])[:limit]:
+            calls = str(row.calls) if row.calls == row.primitive_calls else f'{row.calls}/{row.primitive_calls}'
+            lines.append(f'{calls:>11} {row.self_time:10.6f} {row.cumulative_time:10.6f} {row.cumulative_time/row.primitive_calls:10.6f}  {name}')
+        return '\n'.join(lines)
+
+    def create_stats(self):
+        """
+        Fill stats in the layout of cProfile.Profile.stats, so pstats.Stats(profiler) reads the rows.
+        Lisp functions are filed under '<lisp>' and primitives under '<primitive>', at line 0.
+        """
+        def key(name):
+            return ('<primitive>' if name.startswith('op_') else '<lisp>',0,name)
+        self.stats = {key(name):(row.primitive_calls,row.calls,row.self_time,row.cumulative_time,
+                {key(caller):tuple(totals) for caller,totals in row.callers.items()}) for name,row in self.rows.items()}
+    def dump_stats(self,path):
+        """
+        Write the rows in the marshal format of cProfile.Profile.dump_stats, for pstats.Stats(path) or snakeviz.
+        """
+        self.create_stats()
+        with open(path,'wb') as file:
+            marshal.dump(self.stats,file)
+
+    def folded(self):
+        """
+        The self time of each call stack in microseconds, as 'outer;inner time' lines: the input format of
+        flamegraph.pl, inferno and speedscope.
+        """
+        lines = []
+        for path,(parent,name) in enumerate(self.path_keys):
+            names = [name]
+            while parent is not None:
+                parent,caller = self.path_keys[parent]
+                names.append(caller)
+            lines.append(f'{";".join(reversed(names))} {round(self.path_times[path]*1e6)}')
+        return '\n'.join(lines)
+    def dump_folded(self,path):
+        with open(path,'w') as file:
+            file.write(self.folded()+'\n')
+
+def profiled_primitive(primitive):
+    """
+    A copy of a Primitive whose function is wrapped to time its calls while the evaluator running it has a profiler.
+    """
+    function = primitive.function
+    name = getattr(function,'__name__',primitive.name)
+    python = primitive.strategy == 'python'
+    @functools.wraps(function)
+    def profiled(evaluator,*values):
+        profiler = evaluator.profiler
+        if profiler is None:
+            return function(*values) if python else function(evaluator,*values)
+        profiler.enter(name)
+        value = function(*values) if python else function(evaluator,*values)
+        profiler.exit()
+        return value
+    profiled_copy = copy.copy(primitive)
+    profiled_copy.function = profiled
+    profiled_copy.strategy = 'evaluator'
+    return profiled_copy
+
+class ProfilingEvaluator(Evaluator):
+    """
+    Evaluator that records into its profiler; Lisp.start_profile switches to one.
+    Primitives resolve to copies whose functions are timing wrappers, and every call goes through apply, which times it
+    until the body has returned. The bodies of functions are compiled again by this evaluator, so the
+    primitives they use are timed too. The plain evaluators contain none of this, so they pay nothing
+    for profiling. A tail call stays open in its caller's entry, so profiled tail recursion grows the
+    continuation stack.
+    """
+    profiled_primitives = {}
+    def __call__(self,parsed_list,env=None):
+        depth = len(self.profiler.stack)
+        try:
+            return super().__call__(parsed_list,env)
+        finally:
+            self.profiler.unwind(depth)
+    def primitive(self,operator_name):
+        primitive = super().primitive(operator_name)
+        if primitive is None:
+            return None
+        if primitive not in self.profiled_primitives:
+            self.profiled_primitives[primitive] = profiled_primitive(primitive)
+        return self.profiled_primitives[primitive]
+    def apply(self,function,values):
+        if type(function) is Primitive and hasattr(function.function,'__wrapped__'):
+            #timed by the wrapper itself
+            return function.apply(self,values)
+        profiler = self.profiler
+        profiler.enter(function.name)
+        value = function.apply(self,values)
+        if type(value) is not TailCall:
+            profiler.exit()
+            return value
+        if isinstance(function,Function) and function.body_scope is not None:
+            value.node = self.compile(function.body,function.body_scope)
+        return value.suspend(profiler.exit_frame)
+
+class ProfilingHashConsEvaluator(ProfilingEvaluator,HashConsEvaluator):
+    pass
+class ProfilingVMEvaluator(ProfilingEvaluator,VMEvaluator):
+    pass
+class ProfilingHashConsVMEvaluator(ProfilingEvaluator,HashConsVMEvaluator):
+    pass
+
+#profiling evaluator class for each evaluator class of Lisp
+profiling_types = {
+    Evaluator:ProfilingEvaluator,
+    HashConsEvaluator:ProfilingHashConsEvaluator,
+    VMEvaluator:ProfilingVMEvaluator,
+    HashConsVMEvaluator:ProfilingHashConsVMEvaluator,
+    }
+
+class BatchResult():
+    """
+    Outcome of one program of Lisp.map_eval: its index in the batch, then either values, the exprs of the
+    values of its forms, or error, the type and message of the exception it raised. Values are sent back
+    as text because functions, which hold their compiled bodies, cannot leave their process.
+    """
+    __slots__ = ('index','values','error')
+    def __init__(self,index,values=None,error=None):
+        self.index = index
+        self.values = values
+        self.error = error
+    def __repr__(self):
+        if self.error is not None:
+            return f'BatchResult({self.index}, error={repr(self.error)})'
+        return f'BatchResult({self.index}, {repr(self.values)})'
+
+#(options,globals,setup error) of the interpreter of a map_eval worker process, set by batch_worker_init
+batch_worker = None
+
+def batch_worker_init(options,setup):
+    #an initializer that raises makes the pool start a new worker forever, so the error is kept for batch_eval
+    global batch_worker
+    lisp = Lisp(**options)
+    try:
+        if setup is not None:
+            lisp(setup)
+        image = lisp.freeze()
+    except Exception as e:
+        batch_worker = (None,f'setup: {type(e).__name__}: {e}')
+        return
+    batch_worker = (image,None)
+
+def batch_eval(item):
+    index,source = item
+    image,error = batch_worker
+    if error is not None:
+        return BatchResult(index,error=error)
+    lisp = image.session()
+    try:
+        return BatchResult(index,[value_expr(value) for value in lisp(source)])
+    except Exception as e:
+        return BatchResult(index,error=f'{type(e).__name__}: {e}')
+
+
+#Native versions of the prelude functions.
+#Each follows its lisp definition in Lisp.prelude step for step, through the same primitives, so results and
+#errors are the same; recursion down the cdr of a list and calls in tail position become loops, and the
+#recursion of subst down the car and of eval into subexpressions runs on a stack of their own.
+def native_null(evaluator,x):
+    return evaluator.op_eq(x,NIL)
+
+def native_and(evaluator,x,y):
+    if x is not FALSE and y is not FALSE:
+        return TRUE
+    return FALSE
+
+def native_or(evaluator,x,y):
+    if x is FALSE and y is FALSE:
+        return FALSE
+    return TRUE
+
+def native_not(evaluator,x):
+    if x is not FALSE:
+        return FALSE
+    return TRUE
+
+def native_concat(evaluator,x,y):
+    items = []
+    while native_null(evaluator,x) is FALSE:
+        items.append(evaluator.op_car(x))
+        x = evaluator.op_cdr(x)
+    for item in reversed(items):
+        y = evaluator.op_cons(item,y)
+    return y
+
+def native_zip(evaluator,x,y):
+    #(and (null x) (null y)) and running out of clauses both give '()
+    items = []
+    while not is_atomic(x) and not is_atomic(y):
+        items.append(evaluator.op_list(evaluator.op_car(x),evaluator.op_car(y)))
+        x = evaluator.op_cdr(x)
+        y = evaluator.op_cdr(y)
+    return evaluator.op_list(*items)
+
+def native_assoc(evaluator,x,y):
+    if evaluator.alist_index is not None:
+        return evaluator.alist_index.assoc(evaluator,x,y)
+    return walk_assoc(evaluator,x,y)
+
+def walk_assoc(evaluator,x,y,count=None):
+    """
+    assoc by walking the list, or when count is given, by walking at most count entries: then None means
+    the list goes on with no match so far.
+    """
+    while not is_atomic(y):
+        if count is not None:
+            if count == 0:
+                return None
+            count -= 1
+        if evaluator.op_eq(evaluator.cxr('caar','aa',y),x) is TRUE:
+            return evaluator.cxr('cadar','ada',y)
+        y = evaluator.op_cdr(y)
+    return x
+
+class AlistLayer():
+    """
+    Part of an AlistIndex: entries maps the eq_key of each key held by the cells from cell on to the first
+    of those cells holding it. The cells go on at the layer tail, or end with the cell stop, whose entry
+    is not a list or has a key that can't be hashed, or with the end of the list when both are None.
+    """
+    __slots__ = ('cell','entries','tail','stop')
+    def __init__(self,cell,entries,tail,stop):
+        self.cell = cell
+        self.entries = entries
+        self.tail = tail
+        self.stop = stop
+
+class AlistIndex():
+    """
+    Hash indexes of association lists, used by assoc (and so by eval looking variables up in its environment)
+    under Lisp(indexed_assoc=True). A list is indexed the first time assoc walks walk_length of its entries
+    with no match; after that a lookup is a dict lookup per AlistLayer of the list. A list made by consing
+    entries onto an indexed one, as eval does with the bindings of each call, only indexes the new entries
+    and goes on at the layer of the old list; a layer absorbs the layer after it when that one is at most
+    twice its size, so chains stay short. Results are those of the list walk: a match is read out of the
+    matching cell by the same cadar, and past a cell whose entry is not a list the walk takes over, so it
+    raises where the walk would. Keys match as eq matches them, through eq_key; from a key that can't be
+    hashed on, and for such a key, assoc walks the list.
+
+    >>> lisp = Lisp(indexed_assoc=True)
+    >>> lisp("(setq env (zip '(a b c d e f g h i j) '(1 2 3 4 5 6 7 8 9 10))) (assoc 'j env) (assoc 'z env)")[1:]
+    [10, Atom('z')]
+    >>> lisp("(assoc 'j (cons '(j shadowed) env)) (eval '(cond ((eq a b) c) ('#t j)) env) (assoc 'j (concat env '(k)))")
+    [Atom('shadowed'), 10, 10]
+    >>> lisp("(assoc 'k (concat env '(k)))")
+    Traceback (most recent call last):
+    ...
+    Exception: caar arg must be list
+    >>> lisp("(setq f (lambda (x) x)) (setq env (concat (zip '(a b c d e f g h i) '(1 2 3 4 5 6 7 8 9)) (cons (list f 'fn) env))) (assoc 'j env) (assoc f env)")[2:]
+    [10, Atom('fn')]
+    >>> lisp.register('py-dict',lambda: {})
+    Primitive('py-dict')
+    >>> lisp("(setq py (py-dict)) (assoc 'j (cons (list py 0) env)) (assoc py (cons (list py 0) env))")[1:]
+    [10, 0]
+    >>> index = lisp.evaluator.alist_index
+    >>> index.max_entries = 100
+    >>> lisp("(defun pairs (n) (cond ((= n 0) '()) ('#t (cons (list n n) (pairs (- n 1)))))) (assoc 1 (pairs 60)) (assoc 1 (pairs 60))")[1:]
+    [1, 1]
+    >>> index.size <= 100,len(index.layers)
+    (True, 1)
+    """
+    #entries assoc walks before it indexes a list
+    walk_length = 8
+    #the most entries kept over all layers, as each pins the cells it indexes; the least recently used layers are dropped first
+    max_entries = 1<<20
+    def __init__(self):
+        self.layers = collections.OrderedDict()
+        self.size = 0
+    def cached(self,cell):
+        layer = self.layers.get(id(cell))
+        if layer is None or layer.cell is not cell:
+            return None
+        self.layers.move_to_end(id(cell))
+        return layer
+    def assoc(self,evaluator,x,y):
+        layer = self.cached(y)
+        if layer is None:
+            value = walk_assoc(evaluator,x,y,self.walk_length)
+            if value is not None:
+                return value
+            if not isinstance(y,Pair):
+                return walk_assoc(evaluator,x,y)
+            layer = self.index(evaluator,y)
+        key = eq_key(x)
+        try:
+            hash(key)
+        except TypeError:
+            return walk_assoc(evaluator,x,y)
+        while layer is not None:
+            cell = layer.entries.get(key)
+            if cell is not None:
+                return evaluator.cxr('cadar','ada',cell)
+            elif layer.stop is not None:
+                return walk_assoc(evaluator,x,layer.stop)
+            layer = layer.tail
+        return x
+    def index(self,evaluator,y):
+        entries = {}
+        cell,tail,stop = y,None,None
+        while not is_atomic(cell):
+            tail = self.cached(cell)
+            if tail is not None:
+                break
+            try:
+                key = eq_key(evaluator.cxr('caar','aa',cell))
+                hash(key)
+            except Exception:
+                stop = cell
+                break
+            entries.setdefault(key,cell)
+            cell = cell.cdr
+        if stop is None:
+            while tail is not None and tail.stop is None and len(tail.entries) <= 2*len(entries):
+                merged = dict(tail.entries)
+                merged.update(entries)
+                entries,tail = merged,tail.tail
+        old = self.layers.pop(id(y),None)
+        if old is not None:
+            self.size -= len(old.entries)
+        layer = self.layers[id(y)] = AlistLayer(y,entries,tail,stop)
+        self.size += len(entries)
+        while self.size > self.max_entries and len(self.layers) > 1:
+            self.size -= len(self.layers.popitem(last=False)[1].entries)
+        return layer
+
+def native_subst(evaluator,x,y,z):
+    """
+    >>> lisp = Lisp()
+    >>> lisp("(defun nest (n) (cond ((= n 0) 'c) ('#t (list 'a 'b (nest (- n 1)))))) (setq tree (nest 5000))")[0]
+    Function("(defun nest (n) (cond ((= n 0) 'c) ('#t (list 'a 'b (nest (- n 1))))))")
+    >>> lisp("(defun depth (x) (cond ((atom x) 0) ('#t (+ 1 (depth (car (cdr (cdr x)))))))) (depth (subst 'm 'b tree)) (car (cdr (subst 'm 'b tree)))")[1:]
+    [5000, Atom('m')]
+    >>> lisp('''(length (eval '((label depth (lambda (x) (cond ((atom x) nil) ('#t (cons (car x) (depth (car (cdr (cdr x))))))))) tree)
+    ...     (list (list 'tree (nest 1500)) (list 'nil '()))))''')
+    [1500]
+    """
+    #each entry is the items of a list already substituted and the rest of the list, for the lists being
+    #walked down to the car now in z, so the depth of the tree does not use up python's stack
+    stack = []
+    items = []
+    while True:
+        if not is_atomic(z):
+            stack.append((items,evaluator.op_cdr(z)))
+            items,z = [],evaluator.op_car(z)
+            continue
+        if evaluator.op_eq(z,y) is TRUE:
+            z = x
+        for item in reversed(items):
+            z = evaluator.op_cons(item,z)
+        if not stack:
+            return z
+        items,rest = stack.pop()
+        items.append(z)
+        z = rest
+
+def native_evcon(evaluator,c,a):
+    return native_eval(evaluator,evcon_clause(evaluator,c,a),a)
+
+def evcon_clause(evaluator,c,a):
+    while native_eval(evaluator,evaluator.cxr('caar','aa',c),a) is FALSE:
+        c = evaluator.op_cdr(c)
+    return evaluator.cxr('cadar','ada',c)
+
+def native_evlis(evaluator,m,a):
+    values = []
+    while native_null(evaluator,m) is FALSE:
+        values.append(native_eval(evaluator,evaluator.op_car(m),a))
+        m = evaluator.op_cdr(m)
+    return evaluator.op_list(*values)
+
+def native_eval(evaluator,e,a):
+    """
+    Evaluation of the arguments of atom, eq, car, cdr and cons, of cond tests and of lambda arguments pushes
+    what is left to do with their value on a stack, so deep expressions and deep non-tail recursion in the
+    evaluated program do not use up python's stack. Each entry starts with the operator it belongs to.
+    """
+    cxr = evaluator.cxr
+    budget = evaluator.budget
+    stack = []
+    while True:
+        if budget is not None:
+            budget.step()
+        if is_atomic(e):
+            value = native_assoc(evaluator,e,a)
+        else:
+            operator = evaluator.op_car(e)
+            if is_atomic(operator):
+                if operator is QUOTE:
+                    value = cxr('cadr','da',e)
+                elif operator is ATOM or operator is CAR or operator is CDR:
+                    stack.append((operator,))
+                    e = cxr('cadr','da',e)
+                    continue
+                elif operator is EQ or operator is CONS:
+                    #the second argument is read once the first has been evaluated
+                    stack.append((operator,e,a))
+                    e = cxr('cadr','da',e)
+                    continue
+                elif operator is COND:
+                    c = evaluator.op_cdr(e)
+                    stack.append((COND,c,a))
+                    e = cxr('caar','aa',c)
+                    continue
+                else:
+                    e = evaluator.op_cons(native_assoc(evaluator,operator,a),evaluator.op_cdr(e))
+                    continue
+            elif evaluator.op_car(operator) is LABEL:
+                e,a = evaluator.op_cons(cxr('caddar','adda',e),evaluator.op_cdr(e)),evaluator.op_cons(evaluator.op_list(cxr('cadar','ada',e),operator),a)
+                continue
+            elif evaluator.op_car(operator) is LAMBDA:
+                body = cxr('caddar','adda',e)
+                names = cxr('cadar','ada',e)
+                m = evaluator.op_cdr(e)
+                if native_null(evaluator,m) is FALSE:
+                    stack.append((LAMBDA,body,names,[],m,a))
+                    e = evaluator.op_car(m)
+                    continue
+                a = native_concat(evaluator,native_zip(evaluator,names,evaluator.op_list()),a)
+                e = body
+                continue
+            else:
+                value = NIL
+        #hand the value to the entries waiting for it, until one needs another expression evaluated
+        while True:
+            if not stack:
+                return value
+            entry = stack.pop()
+            operator = entry[0]
+            if operator is ATOM:
+                value = evaluator.op_atom(value)
+            elif operator is CAR:
+                value = evaluator.op_car(value)
+            elif operator is CDR:
+                value = evaluator.op_cdr(value)
+            elif operator is EQ or operator is CONS:
+                if len(entry) == 3:
+                    stack.append((operator,value))
+                    e,a = cxr('caddr','dda',entry[1]),entry[2]
+                    break
+                value = evaluator.op_eq(entry[1],value) if operator is EQ else evaluator.op_cons(entry[1],value)
+            elif operator is COND:
+                c,a = entry[1],entry[2]
+                if value is FALSE:
+                    c = evaluator.op_cdr(c)
+                    stack.append((COND,c,a))
+                    e = cxr('caar','aa',c)
+                else:
+                    e = cxr('cadar','ada',c)
+                break
+            else:
+                body,names,values,m,a = entry[1:]
+                values.append(value)
+                m = evaluator.op_cdr(m)
+                if native_null(evaluator,m) is FALSE:
+                    stack.append((LAMBDA,body,names,values,m,a))
+                    e = evaluator.op_car(m)
+                else:
+                    a = native_concat(evaluator,native_zip(evaluator,names,evaluator.op_list(*values)),a)
+                    e = body
+                break
+
+def paper_examples():
+    """
+    The lisp sources of the examples in this module's docstring.
+    """
+    examples = doctest.DocTestParser().get_examples(__doc__)
+    return [ast.literal_eval(ast.parse(example.source).body[-1].value.args[0]) for example in examples if example.source.startswith('lisp(')]
+
+def random_programs(count,seed=0):
+    """
+    Calls of each prelude function on random data, including quoted atoms inside lists and eval of random
+    expressions over random environments. Some programs fail on purpose, e.g. car of an atom.
+    """
+    rng = random.Random(seed)
+    symbols = ['a','b','c','d','e',"'a","'b",'#t','#f']
+    def tree(depth):
+        if depth == 0 or rng.random() < 0.3:
+            return rng.choice(symbols+['()'])
+        return '('+' '.join([tree(depth-1) for _ in range(rng.randrange(4))])+')'
+    def flat():
+        return '('+' '.join([rng.choice(symbols) for _ in range(rng.randrange(5))])+')'
+    def alist(names):
+        return '('+' '.join([f'({name} {tree(2)})' for name in names])+')'
+    def expression(depth,names):
+        choice = rng.randrange(9) if depth > 0 else rng.randrange(2)
+        if choice == 0:
+            return rng.choice(names)
+        elif choice == 1:
+            return f"'{tree(2)}"
+        elif choice in (2,3):
+            return f"({rng.choice(['atom','car','cdr'])} {expression(depth-1,names)})"
+        elif choice in (4,5):
+            return f"({rng.choice(['eq','cons'])} {expression(depth-1,names)} {expression(depth-1,names)})"
+        elif choice == 6:
+            clauses = ' '.join([f'({expression(depth-1,names)} {expression(depth-1,names)})' for _ in range(rng.randrange(1,3))])
+            return f"(cond {clauses} ('#t {expression(depth-1,names)}))"
+        else:
+            params = rng.sample(['p','q','r'],rng.randrange(1,3))
+            args = ' '.join([expression(depth-1,names) for _ in params])
+            return f"((lambda ({' '.join(params)}) {expression(depth-1,names+params)}) {args})"
+    programs = []
+    for _ in range(count):
+        choice = rng.randrange(8)
+        if choice == 0:
+            programs.append(f"(subst '{tree(1)} '{tree(1)} '{tree(4)})")
+        elif choice == 1:
+            programs.append(f"(concat '{rng.choice([flat(),tree(2)])} '{tree(2)})")
+        elif choice == 2:
+            programs.append(f"(zip '{flat()} '{flat()})")
+        elif choice == 3:
+            programs.append(f"(assoc '{rng.choice(symbols)} '{alist(rng.sample(symbols,3))})")
+        elif choice == 4:
+            programs.append(f"({rng.choice(['null','not'])} '{tree(1)})")
+        elif choice == 5:
+            programs.append(f"({rng.choice(['and','or'])} '{tree(1)} '{tree(1)})")
+        elif choice == 6:
+            programs.append(f"(evlis '({expression(2,['x','y'])} {expression(2,['x','y'])}) '{alist(['x','y'])})")
+        else:
+            programs.append(f"(eval '{expression(4,['x','y'])} '{alist(['x','y'])})")
+    return programs
+
+def compare_lisps(sources,options1,options2):
+    """
+    Evaluate each source with a Lisp(**options1) and a Lisp(**options2) and return the (source,result1,result2)
+    of each mismatch. A result is the value exprs, or the exception type if the source raised.
+    """
+    def run(lisp,source):
+        try:
+            return [value_expr(value) for value in lisp(source)]
+        except Exception as e:
+            return type(e)
+    mismatches = []
+    for source in sources:
+        result1 = run(Lisp(**options1),source)
+        result2 = run(Lisp(**options2),source)
+        if result1 != result2:
+            mismatches.append((source,result1,result2))
+    return mismatches
+
+def compare_preludes(sources,**options):
+    """
+    Differential test of the native prelude against the lisp one. Options are passed to Lisp.
+
+    >>> compare_preludes(paper_examples()+random_programs(300))
+    []
+    """
+    return compare_lisps(sources,dict(options,native_prelude=True),dict(options,native_prelude=False))
+
+def compare_backends(sources,**options):
+    """
+    Differential test of the VM against the tree-walking evaluator, by default running the lisp prelude.
+
+    >>> compare_backends(paper_examples()+random_programs(300))
+    []
+    """
+    options.setdefault('native_prelude',False)
+    return compare_lisps(sources,dict(options,backend='vm'),dict(options,backend='tree'))
+
+def compare_optimizer(sources,**options):
+    """
+    Differential test of optimized compilation against plain compilation, by default running the lisp prelude.
+
+    >>> sources = paper_examples()+random_programs(300)
+    >>> compare_optimizer(sources),compare_optimizer(sources,backend='vm'),compare_optimizer(sources,native_prelude=True)
+    ([], [], [])
+    """
+    options.setdefault('native_prelude',False)
+    return compare_lisps(sources,dict(options,optimize=True),dict(options,optimize=False))
+
+def compare_indexed(sources,walk_length=0,**options):
+    """
+    Differential test of assoc through an AlistIndex against the list walk. By default every list is indexed,
+    however short, see AlistIndex.walk_length.
+
+    >>> sources = paper_examples()+random_programs(300)+["(assoc 'c '((a 1) b (c 2)))","(assoc 'a '((a 1) b))","(assoc 'x '(() (x 1)))",
+    ...     "(assoc '(1 2) '((a 0) ((1 2) x) ((1 2) y)))","(assoc 'a '((a)))","(assoc 1 '((1.0 x)))","(assoc 'b '((a . 1) (b 2)))"]
+    >>> compare_indexed(sources),compare_indexed(sources,native_prelude=False),compare_indexed(sources,backend='vm',hash_cons=True)
+    ([], [], [])
+    """
+    default,AlistIndex.walk_length = AlistIndex.walk_length,walk_length
+    try:
+        return compare_lisps(sources,dict(options,indexed_assoc=True),dict(options,indexed_assoc=False))
+    finally:
+        AlistIndex.walk_length = default
+
+def check_examples(**options):
+    """
+    Run the examples of this module's docstring with Lisp(**options) in place of Lisp() and return doctest's TestResults.
+    """
+    test = doctest.DocTestParser().get_doctest(__doc__,{'Lisp':lambda: Lisp(**options)},'examples',__file__,0)
+    runner = doctest.DocTestRunner()
+    runner.run(test)
+    return runner.summarize(verbose=False)
 
 
 if __name__ == '__main__':